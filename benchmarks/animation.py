@@ -0,0 +1,68 @@
+"""Frame rate of a Map animation compared to one visualize() per frame.
+
+All benchmarks run offline on synthetic data.
+"""
+from __future__ import division
+
+import time
+
+import numpy as np
+import matplotlib as mpl
+import matplotlib.pyplot as plt
+
+from salem import Grid, wgs84
+
+from cleo import Map
+from cleo.animation import MapAnimation
+
+
+class Animation(object):
+
+    nframes = 10
+
+    def setup(self):
+        self.grid = Grid(nxny=(200, 150), dxdy=(0.05, 0.05),
+                         ll_corner=(5, 43), proj=wgs84, pixel_ref='corner')
+        rs = np.random.RandomState(0)
+        self.frames = [rs.randn(150, 200) for _ in range(self.nframes)]
+
+    def _map(self):
+        m = Map(self.grid, nx=400, countries=False,
+                cmap=mpl.cm.get_cmap('viridis'), levels=np.linspace(-3, 3, 13))
+        m.set_data(self.frames[0], crs=self.grid)
+        return m
+
+    def track_fps_visualize(self):
+        m = self._map()
+        t0 = time.time()
+        for data in self.frames:
+            m.set_data(data, crs=self.grid)
+            fig, ax = plt.subplots(1)
+            m.visualize(ax=ax)
+            fig.canvas.draw()
+            plt.close(fig)
+        return self.nframes / (time.time() - t0)
+    track_fps_visualize.unit = 'frames/s'
+
+    def track_fps_animation(self):
+        anim = MapAnimation(self._map(), crs=self.grid)
+        t0 = time.time()
+        for _ in anim.iter_rgba(self.frames):
+            pass
+        return self.nframes / (time.time() - t0)
+    track_fps_animation.unit = 'frames/s'
+
+    def track_fps_animation_prefetch(self):
+        # frames read from "disk" (I/O bound) while the others are rendered
+        def loader(data):
+            def read():
+                time.sleep(0.02)
+                return data
+            return read
+        anim = MapAnimation(self._map(), crs=self.grid)
+        t0 = time.time()
+        for _ in anim.iter_rgba([loader(d) for d in self.frames],
+                                prefetch=4):
+            pass
+        return self.nframes / (time.time() - t0)
+    track_fps_animation_prefetch.unit = 'frames/s'
@@ -0,0 +1,48 @@
+"""Benchmarks of the color normalization.
+
+All benchmarks run offline on synthetic data.
+"""
+from __future__ import division
+
+import numpy as np
+import matplotlib as mpl
+
+from cleo.colors import ExtendedNorm, get_norm
+
+
+class ExtendedNormCall(object):
+
+    params = ([100, 1000, 3000], [8, 64, 256], ['neither', 'both'])
+    param_names = ['size', 'nlevels', 'extend']
+
+    def setup(self, size, nlevels, extend):
+        self.data = np.random.RandomState(0).randn(size, size)
+        self.masked = np.ma.masked_greater(self.data, 2)
+        levels = np.linspace(-2, 2, nlevels)
+        self.norm = ExtendedNorm(levels, mpl.cm.get_cmap('viridis').N,
+                                 extend=extend)
+
+    def time_call(self, size, nlevels, extend):
+        self.norm(self.data)
+
+    def time_call_masked(self, size, nlevels, extend):
+        self.norm(self.masked)
+
+    def peakmem_call(self, size, nlevels, extend):
+        self.norm(self.data)
+
+
+class ExtendedNormInit(object):
+
+    params = ([8, 64, 256], ['neither', 'both'])
+    param_names = ['nlevels', 'extend']
+
+    def setup(self, nlevels, extend):
+        self.levels = np.linspace(-2, 2, nlevels)
+        self.ncolors = mpl.cm.get_cmap('viridis').N
+
+    def time_init(self, nlevels, extend):
+        ExtendedNorm(self.levels, self.ncolors, extend=extend)
+
+    def time_get_norm(self, nlevels, extend):
+        get_norm(self.levels, self.ncolors, extend=extend)
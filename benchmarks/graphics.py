@@ -0,0 +1,181 @@
+"""Benchmarks of DataLevels and Map, from construction to rendering.
+
+All benchmarks run offline on synthetic grids. The bundled shapefiles
+are used when available.
+"""
+from __future__ import division
+
+import os
+import tempfile
+import shutil
+
+import numpy as np
+import matplotlib as mpl
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from salem import Grid, wgs84
+from salem.utils import empty_cache
+from salem.grids import local_mercator_grid
+
+from cleo import DataLevels, Map, files, shapes
+
+
+def _synthetic_topo(ny, nx):
+    """Something smooth looking like a topography."""
+    y, x = np.mgrid[0:ny, 0:nx]
+    return 2000 * np.exp(-((x - nx / 2)**2 + (y - ny / 2)**2) /
+                         (0.1 * nx * ny)) + 10 * np.sin(x / 5.)
+
+
+class DataLevelsToRGB(object):
+
+    params = [100, 1000, 3000]
+    param_names = ['size']
+
+    def setup(self, size):
+        data = np.random.RandomState(0).randn(size, size)
+        self.dl = DataLevels(data, nlevels=12,
+                             cmap=mpl.cm.get_cmap('viridis'))
+
+    def time_to_rgb(self, size):
+        self.dl.to_rgb()
+
+    def peakmem_to_rgb(self, size):
+        self.dl.to_rgb()
+
+
+class MapInit(object):
+
+    params = [False, True]
+    param_names = ['countries']
+
+    def setup(self, countries):
+        if countries and not os.path.exists(files['world_borders']):
+            raise NotImplementedError('world borders not available')
+        self.grid = local_mercator_grid(center_ll=(11.38, 47.26),
+                                        extent=(2000000, 2000000))
+        # Fill the shapefile cache
+        Map(self.grid, countries=countries)
+
+    def time_init(self, countries):
+        Map(self.grid, countries=countries)
+
+    def peakmem_init(self, countries):
+        Map(self.grid, countries=countries)
+
+
+class MapShapefile(object):
+
+    params = (['world_borders', 'oceans', 'rivers'], [False, True])
+    param_names = ['shape', 'cached']
+    number = 1
+
+    def setup(self, shape, cached):
+        if not os.path.exists(files[shape]):
+            raise NotImplementedError(shape + ' not available')
+        grid = local_mercator_grid(center_ll=(11.38, 47.26),
+                                   extent=(2000000, 2000000))
+        self.m = Map(grid, countries=False)
+        if cached:
+            self.m.set_shapefile(files[shape])
+        else:
+            empty_cache()
+            shutil.rmtree(shapes._compiled_dir(files[shape]),
+                          ignore_errors=True)
+
+    def time_set_shapefile(self, shape, cached):
+        self.m.set_shapefile(files[shape])
+
+
+class MapTopography(object):
+
+    params = [200, 500, 1000]
+    param_names = ['nx']
+
+    def setup(self, nx):
+        self.grid = local_mercator_grid(center_ll=(11.38, 47.26),
+                                        extent=(nx * 100, nx * 100), nx=nx)
+        self.topo = _synthetic_topo(nx, nx)
+        self.m = Map(self.grid, nx=nx, countries=False,
+                     cmap=mpl.cm.get_cmap('terrain'))
+        self.m.set_data(self.topo)
+        self.m.set_topography(self.topo)
+
+    def time_set_topography(self, nx):
+        self.m.set_topography(self.topo)
+
+    def peakmem_set_topography(self, nx):
+        self.m.set_topography(self.topo)
+
+    def time_to_rgb_shading(self, nx):
+        self.m.invalidate()
+        self.m.to_rgb()
+
+    def peakmem_to_rgb_shading(self, nx):
+        self.m.invalidate()
+        self.m.to_rgb()
+
+    def time_to_rgb_cached(self, nx):
+        self.m.to_rgb()
+
+    def time_to_png_cached(self, nx):
+        self.m.to_png()
+
+
+class MapVisualize(object):
+
+    params = [200, 500, 1000]
+    param_names = ['nx']
+
+    def setup(self, nx):
+        self.testdir = tempfile.mkdtemp()
+        grid = Grid(nxny=(nx, nx), dxdy=(0.01, 0.01), ll_corner=(5, 43),
+                    proj=wgs84, pixel_ref='corner')
+        self.m = Map(grid, nx=nx, countries=False,
+                     cmap=mpl.cm.get_cmap('terrain'))
+        topo = _synthetic_topo(nx, nx)
+        self.m.set_data(topo)
+        self.m.set_topography(topo)
+
+    def teardown(self, nx):
+        shutil.rmtree(self.testdir)
+        plt.close('all')
+
+    def _visualize(self):
+        self.m.invalidate()
+        fig, ax = plt.subplots(1)
+        self.m.visualize(ax=ax)
+        fig.savefig(os.path.join(self.testdir, 'map.png'))
+        plt.close(fig)
+
+    def time_visualize_savefig(self, nx):
+        self._visualize()
+
+    def peakmem_visualize_savefig(self, nx):
+        self._visualize()
+
+
+class MapDraw(object):
+    """Cost of a figure draw with a map much larger than the axes."""
+
+    params = [True, False]
+    param_names = ['downsample']
+
+    def setup(self, downsample):
+        nx = 4000
+        grid = Grid(nxny=(nx, nx), dxdy=(0.001, 0.001), ll_corner=(5, 43),
+                    proj=wgs84, pixel_ref='corner')
+        self.m = Map(grid, nx=nx, countries=False, downsample=downsample,
+                     cmap=mpl.cm.get_cmap('terrain'))
+        self.m.set_data(_synthetic_topo(nx, nx))
+        self.fig = mpl.figure.Figure(figsize=(6, 6), dpi=100)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot(1, 1, 1)
+        self.m.plot(self.ax)
+
+    def time_draw(self, downsample):
+        self.fig.canvas.draw()
+
+    def time_plot(self, downsample):
+        self.m.plot(self.ax)
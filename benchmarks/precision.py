@@ -0,0 +1,53 @@
+"""Memory and speed of the float32 pipeline compared to the default one.
+
+All benchmarks run offline on synthetic data.
+"""
+from __future__ import division
+
+import numpy as np
+import matplotlib as mpl
+
+from salem import Grid, wgs84
+
+from cleo import Map
+
+
+class MapPrecision(object):
+
+    params = [None, 'float32']
+    param_names = ['dtype']
+
+    def setup(self, dtype):
+        nx = 1000
+        self.grid = Grid(nxny=(nx, nx), dxdy=(0.01, 0.01),
+                         ll_corner=(0, 40), proj=wgs84, pixel_ref='corner')
+        rs = np.random.RandomState(0)
+        self.data = rs.randn(nx, nx)
+        self.topo = np.cumsum(np.cumsum(rs.randn(nx, nx), axis=0), axis=1)
+        self.m = Map(self.grid, nx=nx, countries=False, dtype=dtype,
+                     cmap=mpl.cm.get_cmap('viridis'))
+        self.m.set_data(self.data)
+        self.m.set_topography(self.topo)
+
+    def _full_pipeline(self, dtype):
+        m = Map(self.grid, nx=self.grid.nx, countries=False, dtype=dtype,
+                cmap=mpl.cm.get_cmap('viridis'))
+        m.set_data(self.data)
+        m.set_topography(self.topo)
+        return m.to_rgb()
+
+    def time_to_rgb(self, dtype):
+        self.m.invalidate()
+        self.m.to_rgb()
+
+    def peakmem_to_rgb(self, dtype):
+        self.m.invalidate()
+        self.m.to_rgb()
+
+    def peakmem_full_pipeline(self, dtype):
+        self._full_pipeline(dtype)
+
+    def track_retained_bytes(self, dtype):
+        m = self.m
+        return m.data.nbytes + m.slope.nbytes + m.to_rgb().nbytes
+    track_retained_bytes.unit = 'bytes'
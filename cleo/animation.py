@@ -0,0 +1,266 @@
+"""Efficient rendering of time series of data on a Map.
+
+The frames can be read and remapped in background threads while the
+current frame is rendered (see the prefetch keyword). This is useful when
+the frames are read from disk, e.g. lazily from a NetCDF file::
+
+    anim = MapAnimation(m, crs=grid)
+    frames = (ds.variable[t] for t in range(nt))
+    anim.save_frames(frames, 'frames', prefetch=4)
+
+Copyright: Fabien Maussion, 2014-2015
+
+License: GPLv3+
+"""
+from __future__ import division, absolute_import, unicode_literals
+# Builtins
+import os
+import copy
+import itertools
+import threading
+try:
+    import asyncio
+except ImportError:  # pragma: no cover (py2)
+    asyncio = None
+# External libs
+import numpy as np
+from six.moves import zip
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+# Locals
+from cleo import utils
+from cleo.graphics import DataLevels
+
+
+class MapAnimation(object):
+    """Renders a sequence of data arrays on the same Map.
+
+    The figure (image, colorbar, shapefiles, contours, geometries, ticks...)
+    is set up only once: for each frame, only the data of the image is
+    updated, which is much faster than calling Map.visualize for each frame.
+
+    The animation works on its own copy of the map (MapAnimation.map): the
+    map given at setup is not modified. The levels and the extend of the
+    copy are fixed at setup (from the map's current data if they are not
+    set explicitly), so that the colors of all frames stay consistent with
+    the colorbar.
+    """
+
+    def __init__(self, m, ax=None, crs=None, interp='nearest', title=None,
+                 addcbar=True, figsize=None, dpi=None):
+        """Instanciate.
+
+        Parameters
+        ----------
+        m: the cleo.Map to animate
+        ax: the axis to plot on (optional: a new figure is made if not set)
+        crs: the coordinate reference system of the frames' data (see
+        Map.set_data)
+        interp: the interpolation algorithm (see Map.set_data)
+        title: the initial title of the plot
+        addcbar: add a colorbar to the plot
+        figsize: the size of the figure (if ax is not set)
+        dpi: the resolution of the figure (if ax is not set)
+        """
+
+        # Our own copy: the frames are set on it. The arrays and artists
+        # are shared, but they are replaced, not modified
+        m = copy.copy(m)
+        m._versions = dict(m._versions)
+        m.invalidate()
+        self.map = m
+        self.crs = crs
+        self.interp = interp
+
+        # Freeze the colors
+        levels, extend = m.levels, m.extend
+        m.set_levels(levels)
+        m.set_extend(extend)
+
+        # Our own figure, independant of pyplot
+        _do_tight_layout = False
+        if ax is None:
+            fig = Figure(figsize=figsize, dpi=dpi)
+            FigureCanvasAgg(fig)
+            ax = fig.add_subplot(1, 1, 1)
+            _do_tight_layout = True
+        self.fig = ax.figure
+        self.ax = ax
+
+        m.visualize(ax=ax, title=title, addcbar=addcbar)
+        if _do_tight_layout:
+            self.fig.tight_layout()
+        self.image = ax.images[-1]
+
+    def _remap(self, data):
+        """Read a frame and remap it on the map grid (thread-safe)."""
+        if callable(data):
+            data = data()
+        return self.map._check_data(data, crs=self.crs, interp=self.interp)
+
+    def _show(self, data, title=None):
+        """Set the remapped data of the next frame."""
+        DataLevels.set_data(self.map, data)
+        self.image.set_data(self.map.to_rgb(copy=False))
+        if title is not None:
+            self.ax.set_title(title)
+
+    def update(self, data, title=None):
+        """Set the data of the next frame.
+
+        Parameters
+        ----------
+        data: the data array (2d), or a function returning it
+        title: the new title of the plot (optional)
+        """
+
+        self._show(self._remap(data), title=title)
+
+    def _iter_updates(self, frames, titles=None, prefetch=0):
+        """Update the figure for each frame."""
+        if titles is None:
+            titles = itertools.repeat(None)
+        if prefetch > 0:
+            frames = utils.prefetch(self._remap, frames, ahead=prefetch)
+        else:
+            frames = (self._remap(data) for data in frames)
+        try:
+            for i, (data, title) in enumerate(zip(frames, titles)):
+                self._show(data, title=title)
+                yield i
+        finally:
+            # stop the prefetching if we are interrupted
+            frames.close()
+
+    def iter_rgba(self, frames, titles=None, prefetch=0):
+        """A generator of the rendered frames as RGBA uint8 arrays.
+
+        Useful to stream the frames to any encoder.
+
+        Parameters
+        ----------
+        frames: an iterable of data arrays (2d), or of functions returning
+        them (e.g. reading a file)
+        titles: a sequence of titles, one per frame (optional)
+        prefetch: the number of frames to read and remap in background
+        threads while the current one is rendered (default: none)
+        """
+
+        for _ in self._iter_updates(frames, titles=titles,
+                                    prefetch=prefetch):
+            self.fig.canvas.draw()
+            w, h = self.fig.canvas.get_width_height()
+            rgba = np.frombuffer(self.fig.canvas.buffer_rgba(),
+                                 dtype=np.uint8)
+            yield rgba.reshape((h, w, 4)).copy()
+
+    def pipeline(self, frames, titles=None, prefetch=2):
+        """The rendered frames as a FramePipeline.
+
+        Same as iter_rgba(), but the frames can also be consumed from an
+        asyncio coroutine (``async for rgba in anim.pipeline(frames)``).
+        """
+        return FramePipeline(self.iter_rgba(frames, titles=titles,
+                                            prefetch=prefetch))
+
+    def save_frames(self, frames, directory, titles=None,
+                    fname='frame_{:04d}.png', prefetch=0, **kwargs):
+        """Write the frames as images in a directory.
+
+        Parameters
+        ----------
+        frames: an iterable of data arrays (2d), or of functions returning
+        them
+        directory: where to write the images
+        titles: a sequence of titles, one per frame (optional)
+        fname: the file name template (formatted with the frame number)
+        prefetch: the number of frames to read and remap in advance (see
+        iter_rgba)
+        kwargs: all keywords accepted by savefig()
+
+        Returns
+        -------
+        the list of written files
+        """
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        out = []
+        for i in self._iter_updates(frames, titles=titles,
+                                    prefetch=prefetch):
+            path = os.path.join(directory, fname.format(i))
+            self.fig.savefig(path, **kwargs)
+            out.append(path)
+        return out
+
+    def save_movie(self, frames, writer, outfile, titles=None, dpi=None,
+                   prefetch=0):
+        """Encode the frames with a matplotlib MovieWriter.
+
+        Parameters
+        ----------
+        frames: an iterable of data arrays (2d), or of functions returning
+        them
+        writer: a matplotlib.animation.MovieWriter instance
+        (e.g. FFMpegWriter(fps=10))
+        outfile: the path to the movie file
+        titles: a sequence of titles, one per frame (optional)
+        dpi: the resolution of the movie
+        prefetch: the number of frames to read and remap in advance (see
+        iter_rgba)
+        """
+
+        if dpi is None:
+            dpi = self.fig.dpi
+        with writer.saving(self.fig, outfile, dpi):
+            for _ in self._iter_updates(frames, titles=titles,
+                                        prefetch=prefetch):
+                writer.grab_frame()
+
+
+class FramePipeline(object):
+    """An iterator of rendered frames, which can also be consumed from
+    asyncio.
+
+    With ``async for``, each frame is rendered in the default executor of
+    the event loop, so that the loop is never blocked. The frames are
+    rendered one at a time, in order.
+    """
+
+    def __init__(self, frames):
+        """Instanciate.
+
+        Parameters
+        ----------
+        frames: a generator of rendered frames (e.g. MapAnimation.iter_rgba)
+        """
+        self._frames = frames
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._lock:
+            return next(self._frames)
+
+    next = __next__  # py2
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(None, self._next_async)
+
+    def _next_async(self):
+        try:
+            return self.__next__()
+        except StopIteration:
+            # StopIteration cannot go through a future
+            raise StopAsyncIteration
+
+    def close(self):
+        """Stop the rendering (and the prefetching)."""
+        with self._lock:
+            self._frames.close()
@@ -6,12 +6,18 @@ License: GPLv3+
 """
 from __future__ import division
 # Builtins
+import threading
 # External libs
 import numpy as np
 from numpy import ma
 import matplotlib as mpl
 from matplotlib.colors import LinearSegmentedColormap
 # Locals
+from cleo import utils
+
+# The norms are shared by everyone asking for the same one (see get_norm)
+_norms = utils.LRUCache(64)
+_norms_lock = threading.Lock()
 
 
 class ExtendedNorm(mpl.colors.BoundaryNorm):
@@ -42,25 +48,100 @@ class ExtendedNorm(mpl.colors.BoundaryNorm):
             self._interp = False
         else:
             self._interp = True
-
-    def __call__(self, value):
-        xx, is_scalar = self.process_value(value)
-        mask = ma.getmaskarray(xx)
-        xx = np.atleast_1d(xx.filled(self.vmax + 1))
-        iret = np.zeros(xx.shape, dtype=np.int16)
-        for i, b in enumerate(self._b):
-            iret[xx >= b] = i
+        # color index of each interval
         if self._interp:
             scalefac = float(self.Ncmap - 1) / (self._N - 2)
-            iret = (iret * scalefac).astype(np.int16)
+            self._lut = (np.arange(self._N) * scalefac).astype(np.int16)
+        else:
+            self._lut = np.arange(self._N, dtype=np.int16)
+
+    def __call__(self, value):
+        if utils.has_invalid(value):
+            xx, is_scalar = self.process_value(value)
+            mask = ma.getmaskarray(xx)
+            xx = np.atleast_1d(xx.filled(self.vmax + 1))
+        else:
+            # Fast path: no need to copy the data and to allocate a mask
+            is_scalar = not np.iterable(value)
+            xx = np.atleast_1d(ma.getdata(value))
+            mask = None
+        # index of the last boundary below each value (0 if none)
+        iret = np.searchsorted(self._b, xx, side='right') - 1
+        iret = self._lut[np.maximum(iret, 0, out=iret)]
         iret[xx < self.vmin] = -1
         iret[xx >= self.vmax] = self.Ncmap
-        ret = ma.array(iret, mask=mask)
+        if mask is None:
+            ret = iret
+        else:
+            ret = ma.array(iret, mask=mask)
         if is_scalar:
             ret = int(ret[0])  # assume python scalar
         return ret
 
 
+def get_norm(boundaries, ncolors, extend='neither'):
+    """An ExtendedNorm, shared by all callers asking for the same one.
+
+    The norms are cached by boundaries, number of colors and extend: the
+    returned norm should not be modified.
+
+    Parameters
+    ----------
+    boundaries, ncolors, extend: see ExtendedNorm
+    """
+
+    b = np.atleast_1d(boundaries).astype(float)
+    key = (b.tobytes(), ncolors, extend)
+    with _norms_lock:
+        norm = _norms.get(key)
+    if norm is None:
+        norm = ExtendedNorm(b, ncolors, extend=extend)
+        with _norms_lock:
+            _norms[key] = norm
+    return norm
+
+
+def fingerprint(cmap):
+    """A cheap identifier of the colors of a colormap.
+
+    It changes with the in-place modifications of the colormap (e.g.
+    set_bad()), which update its color table.
+    """
+
+    if not cmap._isinit:
+        cmap._init()
+    return cmap.name, cmap.N, hash(cmap._lut.tobytes())
+
+
+def lookup(cmap, idx, dtype=None):
+    """The RGBA colors of a colormap at the indices given by a norm.
+
+    Same as cmap(idx), but the colors are taken out of a copy of the
+    colormap table in the requested precision: with float32, the float64
+    image is never created.
+
+    Parameters
+    ----------
+    cmap: a matplotlib colormap
+    idx: the color indices (integers, masked where the data is invalid)
+    dtype: the floating point precision of the colors (default: float64)
+    """
+
+    dtype = np.float64 if dtype is None else dtype
+    if np.ma.getdata(idx).dtype.kind not in ['i', 'u']:
+        return cmap(idx).astype(dtype, copy=False)
+    if not cmap._isinit:
+        cmap._init()
+    xa = np.array(np.ma.getdata(idx), dtype=np.intp)
+    # the over-range before the under-range, like matplotlib
+    xa[xa > cmap.N - 1] = cmap._i_over
+    xa[xa < 0] = cmap._i_under
+    mask = np.ma.getmask(idx)
+    if mask is not np.ma.nomask:
+        xa[mask] = cmap._i_bad
+    return cmap._lut.astype(dtype).take(xa, axis=0)
+
+
 def _topo():
     """Topographical colormap.
 
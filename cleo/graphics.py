@@ -9,22 +9,53 @@ import six
 from six import string_types
 # Builtins
 import copy
+import io
 import os
+import threading
 import warnings
 # External libs
 import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
-from shapely.geometry import MultiPoint
-from descartes.patch import PolygonPatch
+from descartes.patch import PolygonPatch, PolygonPath
+from matplotlib.artist import Artist
+from matplotlib.image import AxesImage
+from matplotlib.patches import PathPatch
+from matplotlib.text import Text
+from matplotlib.path import Path
 from matplotlib.collections import PatchCollection, LineCollection
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import shapely.geometry as shpg
 import salem
 from salem import wgs84
 from scipy.misc import imresize
 # Locals
 import cleo.colors
-from cleo import files
+from cleo import files, utils, profiling, shapes
+from cleo.mosaic import Mosaic
+
+# Geometries are clipped to the map extent plus this margin (fraction of the
+# map size), so that the clipping edges stay out of sight with thick lines
+_CLIP_MARGIN = 0.02
+
+# Interpolation modes which aggregate all data pixels within a map pixel
+_AGGREGATIONS = ['mean', 'max', 'mode']
+
+# The aggregation plans are shared by all maps with the same grid (and by
+# the threads remapping data)
+_aggregation_plans = utils.LRUCache(16)
+_aggregation_lock = threading.Lock()
+
+# Lazy data (xarray, dask...) is read in chunks of this number of elements
+_LAZY_CHUNK = 2**22
+
+# Maximum number of vertices projected in one call
+_TRANSFORM_CHUNK = 2**20
+
+# Dimension of the simple geometry types
+_GEOM_DIMS = {'Point': 0, 'LineString': 1, 'LinearRing': 1, 'Polygon': 2}
 
 
 class DataLevels(object):
@@ -36,13 +67,16 @@ class DataLevels(object):
     """
 
     def __init__(self, data=None, levels=None, nlevels=None, vmin=None,
-                 vmax=None, extend=None, cmap=None):
+                 vmax=None, extend=None, cmap=None, dtype=None,
+                 downsample=True):
         """Instanciate.
 
         Parameters
         ----------
         see the set_* functions
         """
+        self._versions = dict()
+        self.set_dtype(dtype)
         self.set_data(data)
         self.set_levels(levels)
         self.set_nlevels(nlevels)
@@ -50,6 +84,7 @@ class DataLevels(object):
         self.set_vmax(vmax)
         self.set_extend(extend)
         self.set_cmap(cmap)
+        self.set_downsample(downsample)
 
     def update(self, d):
         """
@@ -62,28 +97,65 @@ class DataLevels(object):
                 raise AttributeError('Unknown property %s' % k)
             func(v)
 
+    def _changed(self, *inputs):
+        """Mark some inputs of the rendering as modified.
+
+        Each input ('data', 'levels', 'cmap'...) has a version number which
+        is increased by the set_* functions.
+        """
+        for k in inputs:
+            self._versions[k] = self._versions.get(k, 0) + 1
+
+    def set_dtype(self, dtype=None):
+        """Floating point precision of the data and of the RGB image.
+
+        Default is to keep the data as it comes and to work with float64.
+        Setting np.float32 halves the memory footprint of the data, slope
+        and image arrays.
+        """
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        if getattr(self, 'data', None) is not None:
+            self.data = self._as_dtype(self.data)
+        self._changed('dtype')
+
+    def _as_dtype(self, a):
+        """Cast an array to the working precision (no copy if possible)."""
+        if self.dtype is None:
+            return a
+        return a.astype(self.dtype, copy=False)
+
     def set_data(self, data=None):
-        """Any kind of data array (also masked)."""
+        """Any kind of data array (also masked).
+
+        Valid data is stored as a plain array: a mask is created only if
+        there are invalid values to hide.
+        """
         if data is not None:
-            self.data = np.ma.masked_invalid(np.atleast_1d(data), copy=False)
+            data = self._as_dtype(np.atleast_1d(data))
+            self.data = utils.lazy_masked_invalid(data)
         else:
-            self.data = np.ma.asarray([0., 1.])
+            self.data = self._as_dtype(np.asarray([0., 1.]))
+        self._changed('data')
 
     def set_levels(self, levels=None):
         """Levels you define. Must be monotically increasing."""
         self._levels = levels
+        self._changed('levels')
 
     def set_nlevels(self, nlevels=None):
         """Automatic N levels. Ignored if set_levels has been set."""
         self._nlevels = nlevels
+        self._changed('levels')
 
     def set_vmin(self, val=None):
         """Mininum level value. Ignored if set_levels has been set."""
         self._vmin = val
+        self._changed('levels')
 
     def set_vmax(self, val=None):
         """Maximum level value. Ignored if set_levels has been set."""
         self._vmax = val
+        self._changed('levels')
 
     def set_cmap(self, cm=None):
         """Set a colormap."""
@@ -91,10 +163,37 @@ class DataLevels(object):
             self.cmap = cm
         else:
             self.cmap = mpl.colors.ListedColormap(['white'])
+        self._changed('cmap')
 
     def set_extend(self, extend=None):
         """Colorbar extensions: 'neither' | 'both' | 'min' | 'max'"""
         self._extend = extend
+        self._changed('levels')
+
+    def set_downsample(self, downsample=True):
+        """Reduce the image to its size on screen before drawing it.
+
+        An image with more pixels than its size on screen is averaged by
+        blocks of pixels to this size at each draw (with the layout and dpi
+        of that draw), so that matplotlib does not resample the full image.
+        """
+        self.downsample = downsample
+
+    def _imshow(self, ax, img, origin):
+        """Add the image to the axes (see set_downsample)."""
+        ny, nx = img.shape[:2]
+        extent = _image_extent(nx, ny, origin)
+        if not self.downsample:
+            return ax.imshow(img, interpolation='none', origin=origin,
+                             extent=extent)
+        im = _DownsampledImage(ax, interpolation='none', origin=origin,
+                               extent=extent)
+        ax.set_aspect(mpl.rcParams['image.aspect'])
+        im.set_data(img)
+        im.set_clip_path(ax.patch)
+        im.set_extent(extent)
+        ax.add_image(im)
+        return im
 
     def set_plot_params(self, levels=None, nlevels=None, vmin=None, vmax=None,
                         extend=None):
@@ -115,8 +214,9 @@ class DataLevels(object):
         levels = self._levels
         nlevels = self._nlevels
         if levels is not None:
-            self.set_vmin(levels[0])
-            self.set_vmax(levels[-1])
+            # not set_vmin(): this is not a change of the levels
+            self._vmin = levels[0]
+            self._vmax = levels[-1]
             return levels
         else:
             if nlevels is None:
@@ -174,11 +274,17 @@ class DataLevels(object):
             warnings.warn('Minimum data out of bounds.', RuntimeWarning)
         if e not in ['both', 'max'] and (np.max(l) < np.max(self.data)):
             warnings.warn('Maximum data out of bounds.', RuntimeWarning)
-        return cleo.colors.ExtendedNorm(l, self.cmap.N, extend=e)
+        return cleo.colors.get_norm(l, self.cmap.N, extend=e)
 
     def to_rgb(self):
         """Transform the data to RGB triples."""
-        return self.cmap(self.norm(self.data))
+        with profiling.stage('DataLevels.to_rgb') as s:
+            s.add(**profiling.array_info(self.data))
+            with profiling.stage('DataLevels.norm'):
+                idx = self.norm(self.data)
+            with profiling.stage('DataLevels.colormap'):
+                out = cleo.colors.lookup(self.cmap, idx, dtype=self.dtype)
+        return out
 
     def colorbarbase(self, cax, **kwargs):
         """Returns a ColorbarBase to add to the cax axis. All keywords are
@@ -188,7 +294,9 @@ class DataLevels(object):
         # This is a discutable choice: with more than 60 colors (could be
         # less), we assume a continuous colorbar.
         if self.nlevels < 60:
-            norm = self.norm
+            # not the shared self.norm: the colorbar may modify its norm
+            norm = cleo.colors.ExtendedNorm(self.levels, self.cmap.N,
+                                            extend=self.extend)
         else:
             norm = mpl.colors.Normalize(vmin=self.vmin, vmax=self.vmax)
         return mpl.colorbar.ColorbarBase(cax, extend=self.extend,
@@ -219,8 +327,9 @@ class DataLevels(object):
         More useful for child classes if you ask me but still.
         """
         data = np.atleast_2d(self.data)
-        toplot = self.cmap(self.norm(data))
-        ax.imshow(toplot, interpolation='none', origin='lower')
+        toplot = cleo.colors.lookup(self.cmap, self.norm(data),
+                                    dtype=self.dtype)
+        self._imshow(ax, toplot, 'lower')
 
     def visualize(self, ax=None, title=None, orientation='vertical',
                   add_values=False, addcbar=True):
@@ -231,7 +340,10 @@ class DataLevels(object):
         ax: the axis to add the plot to (optinal)
         title: the plot title
         orientation: the colorbar's orientation
-        add_values: add the data values as text in the pixels (for testing)
+        add_values: add the data values as text in the pixels (for testing).
+        If the pixels are too small for the text, only one pixel out of N
+        is annotated.
+        addcbar: add a colorbar (not if all the data has the same value)
         """
 
         # Do we make our own fig?
@@ -241,24 +353,22 @@ class DataLevels(object):
             _do_tight_layout = True
 
         # Plot
-        self.plot(ax)
+        name = type(self).__name__
+        with profiling.stage(name + '.plot'):
+            self.plot(ax)
 
         # Colorbar
-        addcbar = self.vmin != self.vmax
-        if addcbar:
-            if orientation == 'horizontal':
-                self.append_colorbar(ax, "top", size=0.2, pad=0.5)
-            else:
-                self.append_colorbar(ax, "right", size="5%", pad=0.2)
+        if addcbar and self.vmin != self.vmax:
+            with profiling.stage(name + '.colorbar'):
+                if orientation == 'horizontal':
+                    self.append_colorbar(ax, "top", size=0.2, pad=0.5)
+                else:
+                    self.append_colorbar(ax, "right", size="5%", pad=0.2)
 
         # Mini add-on
         if add_values:
-            data = np.atleast_2d(self.data)
-            x, y = np.meshgrid(np.arange(data.shape[1]),
-                               np.arange(data.shape[0]))
-            for v, i, j in zip(data.flatten(), x.flatten(), y.flatten()):
-                ax.text(i, j, v, horizontalalignment='center',
-                        verticalalignment='center')
+            with profiling.stage(name + '.add_values'):
+                _add_values(ax, np.atleast_2d(self.data))
 
         # Details
         if title is not None:
@@ -304,49 +414,213 @@ class Map(DataLevels):
 
         self._collections = []
         self._geometries = []
+        self._points = []
         self._text = []
+        self._labels = []
+        self._ll_corners = None
+        self._ll_edges = None
         self.set_shapefile(countries=countries)
         self.set_lonlat_contours()
         self._shading_base()
         self._rgb = None
+        self.set_render_cache()
         self._contourf_data = None
+        self._contourf_paths = None
+        self._contourf_thread = None
 
     def _check_data(self, data=None, crs=None, interp='nearest',
                     overplot=False):
         """Interpolates the data to the map grid."""
 
-        data = np.ma.fix_invalid(np.squeeze(data))
+        if utils.is_lazy(data):
+            return self._check_lazy_data(data, crs=crs, interp=interp,
+                                         overplot=overplot)
+
+        data = np.squeeze(data)
+        if utils.has_invalid(data):
+            data = np.ma.fix_invalid(data)
+        else:
+            data = np.ma.getdata(data)
         shp = data.shape
         if len(shp) != 2:
             raise ValueError('Data should be 2D.')
 
-        crs = salem.gis.check_crs(crs)
-        if crs is None:
-            # Reform case, but with a sanity check
-            if not np.isclose(shp[0] / shp[1], self.grid.ny / self.grid.nx,
-                              atol=1e-2):
-                raise ValueError('Dimensions of data do not match the map.')
-
-            # need to resize if not same
-            if not ((shp[0] == self.grid.ny) and (shp[1] == self.grid.nx)):
-                if interp.lower() == 'linear':
-                    interp = 'bilinear'
-                if interp.lower() == 'spline':
-                    interp = 'cubic'
-                # TODO: this does not work well with masked arrays
-                data = imresize(data.filled(np.NaN),
-                                (self.grid.ny, self.grid.nx),
-                                interp=interp, mode='F')
-        elif isinstance(crs, salem.Grid):
-            # Remap
-            if overplot:
-                data = self.grid.map_gridded_data(data, crs, interp=interp,
-                                                  out=self.data)
+        with profiling.stage('Map._check_data', interp=interp) as stage:
+            crs = salem.gis.check_crs(crs)
+            if crs is None:
+                # Reform case, but with a sanity check
+                if not np.isclose(shp[0] / shp[1], self.grid.ny / self.grid.nx,
+                                  atol=1e-2):
+                    raise ValueError('Dimensions of data do not match the '
+                                     'map.')
+
+                # need to resize if not same
+                if not ((shp[0] == self.grid.ny) and (shp[1] == self.grid.nx)):
+                    if interp.lower() in _AGGREGATIONS:
+                        data = self._aggregate(data, None, interp.lower(),
+                                               overplot=overplot)
+                    else:
+                        if interp.lower() == 'linear':
+                            interp = 'bilinear'
+                        if interp.lower() == 'spline':
+                            interp = 'cubic'
+                        # TODO: this does not work well with masked arrays
+                        data = imresize(np.ma.filled(data, np.NaN),
+                                        (self.grid.ny, self.grid.nx),
+                                        interp=interp, mode='F')
+                elif not np.ma.isMaskedArray(data):
+                    # valid data is not copied above: we don't want to keep
+                    # the caller's array (overplot writes into self.data)
+                    data = data.copy()
+            elif isinstance(crs, salem.Grid):
+                # Remap
+                if interp.lower() in _AGGREGATIONS:
+                    data = self._aggregate(data, crs, interp.lower(),
+                                           overplot=overplot)
+                elif overplot:
+                    data = self.grid.map_gridded_data(data, crs, interp=interp,
+                                                      out=self.data)
+                else:
+                    data = self.grid.map_gridded_data(data, crs, interp=interp)
             else:
-                data = self.grid.map_gridded_data(data, crs, interp=interp)
+                raise ValueError('crs not understood')
+            stage.add(**profiling.array_info(data))
+        return self._as_dtype(data)
+
+    def _aggregation_plan(self, shape, crs=None):
+        """Which map pixel each data pixel falls into (computed once).
+
+        Returns the flat index of the data pixels which are in the map,
+        sorted by map pixel, the flat index of their map pixel, and the
+        start of each map pixel in these arrays.
+        """
+
+        gk = utils.grid_key(self.grid)
+        key = (gk, shape) if crs is None else (gk, utils.grid_key(crs))
+        with _aggregation_lock:
+            plan = _aggregation_plans.get(key)
+        if plan is not None:
+            return plan
+
+        ny, nx = shape
+        if crs is None:
+            # data on the map extent, at another resolution
+            i = np.floor((np.arange(nx) + 0.5) * self.grid.nx / nx)
+            j = np.floor((np.arange(ny) + 0.5) * self.grid.ny / ny)
+            i, j = np.meshgrid(i, j)
+        else:
+            i, j = np.meshgrid(np.arange(nx), np.arange(ny))
+            i, j = self.grid.transform(i, j, crs=crs.center_grid,
+                                       nearest=True)
+        i = np.asarray(i, dtype=np.int64).ravel()
+        j = np.asarray(j, dtype=np.int64).ravel()
+        valid = (i >= 0) & (i < self.grid.nx) & (j >= 0) & (j < self.grid.ny)
+        sel = np.flatnonzero(valid)
+        targets = (j * self.grid.nx + i)[sel]
+        order = np.argsort(targets, kind='mergesort')
+        sel, targets = sel[order], targets[order]
+        starts = np.flatnonzero(np.r_[True, targets[1:] != targets[:-1]])
+        plan = (sel, targets, starts)
+        with _aggregation_lock:
+            _aggregation_plans[key] = plan
+        return plan
+
+    def _aggregate(self, data, crs, how, overplot=False):
+        """Reduce all the data pixels within each map pixel."""
+
+        sel, targets, starts = self._aggregation_plan(data.shape, crs=crs)
+        size = self.grid.nx * self.grid.ny
+        out = np.full(size, np.NaN)
+        d = np.ma.getdata(data).ravel()[sel].astype(np.float64)
+        ok = np.isfinite(d) & ~np.ma.getmaskarray(data).ravel()[sel]
+        if len(sel) == 0:
+            pass
+        elif how == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                out = np.bincount(targets, weights=np.where(ok, d, 0),
+                                  minlength=size) / \
+                    np.bincount(targets[ok], minlength=size)
+        elif how == 'max':
+            dmax = np.maximum.reduceat(np.where(ok, d, -np.inf), starts)
+            out[targets[starts]] = np.where(np.isinf(dmax), np.NaN, dmax)
         else:
-            raise ValueError('crs not understood')
-        return data
+            # count the (map pixel, value) pairs
+            t, d = targets[ok], d[ok]
+            o = np.lexsort((d, t))
+            t, d = t[o], d[o]
+            first = np.flatnonzero(np.r_[True, (t[1:] != t[:-1]) |
+                                         (d[1:] != d[:-1])])
+            counts = np.diff(np.r_[first, len(t)])
+            t, d = t[first], d[first]
+            # the most frequent per map pixel (the smallest on ties)
+            o = np.lexsort((-counts, t))
+            t, d = t[o], d[o]
+            first = np.r_[True, t[1:] != t[:-1]]
+            out[t[first]] = d[first]
+
+        out = np.ma.masked_invalid(out.reshape((self.grid.ny,
+                                                self.grid.nx)))
+        if overplot:
+            out = self._overplot(out)
+        return out
+
+    def _overplot(self, out):
+        """Data on top of the current one, like
+        map_gridded_data(out=self.data)."""
+        ok = ~np.ma.getmaskarray(out)
+        res = np.ma.array(self.data, dtype=np.float64, copy=True)
+        res[ok] = out[ok]
+        return res
+
+    def _check_lazy_data(self, data, crs=None, interp='nearest',
+                         overplot=False):
+        """Like _check_data, for lazy arrays (xarray, dask, netCDF4...).
+
+        Only the data window covering the map is read. For the 'nearest' and
+        'linear' interpolations, it is read and remapped in chunks of rows.
+        """
+
+        if data.ndim < 2 or any(s != 1 for s in data.shape[:-2]):
+            raise ValueError('Data should be 2D.')
+        lead = (0,) * (data.ndim - 2)
+        crs = salem.gis.check_crs(crs)
+        if not isinstance(crs, salem.Grid):
+            # the whole data is needed
+            return self._check_data(utils.materialize(data[lead]), crs=crs,
+                                    interp=interp, overplot=overplot)
+
+        j0, j1, i0, i1 = _data_window(self.grid, crs)
+        interp = interp.lower()
+        if interp not in ['nearest', 'linear']:
+            data = utils.materialize(data[lead + (slice(j0, j1),
+                                                  slice(i0, i1))])
+            return self._check_data(data, crs=_grid_window(crs, i0, i1,
+                                                           j0, j1),
+                                    interp=interp, overplot=overplot)
+
+        with profiling.stage('Map._check_data', interp=interp,
+                             lazy=True) as stage:
+            mosaic = Mosaic(self.grid, interp=interp)
+            nrows = max(2, _LAZY_CHUNK // (i1 - i0))
+            nrows -= nrows % 2
+            r0 = j0
+            while True:
+                r1 = min(r0 + nrows, j1)
+                if j1 - r1 < 2:
+                    # no chunk of a single row
+                    r1 = j1
+                chunk = data[lead + (slice(r0, r1), slice(i0, i1))]
+                mosaic.add(utils.materialize(chunk),
+                           _grid_window(crs, i0, i1, r0, r1))
+                if r1 >= j1:
+                    break
+                # the linear interpolation needs the neighbouring rows
+                r0 = r1 - 1 if interp == 'linear' else r1
+            out = mosaic.data
+            if overplot:
+                out = self._overplot(out)
+            stage.add(**profiling.array_info(out))
+        return self._as_dtype(out)
 
     def set_data(self, data=None, crs=None, interp='nearest',
                  overplot=False):
@@ -356,48 +630,95 @@ class Map(DataLevels):
 
         Parameters
         ----------
-        data: the data array (2d)
+        data: the data array (2d). Lazy arrays (xarray, dask, netCDF4
+        variables...) are read only where they cover the map
         crs: the data coordinate reference system
-        interp: 'nearest' (default) or 'linear', the interpolation algorithm
+        interp: 'nearest' (default) or 'linear', the interpolation algorithm.
+        For data with a higher resolution than the map, 'mean', 'max' or
+        'mode' reduce all the data pixels within each map pixel (the pixels
+        where there is no data are masked)
         overplot: add the data to an existing plot (useful for mosaics for
         example)
         """
 
         # Check input
         if data is None:
-            self.data = np.ma.zeros((self.grid.ny, self.grid.nx))
+            self.data = np.zeros((self.grid.ny, self.grid.nx),
+                                 dtype=self.dtype)
+            self._changed('data')
             return
         data = self._check_data(data=data, crs=crs, interp=interp,
                                 overplot=overplot)
         DataLevels.set_data(self, data)
 
-    def set_contourf(self, data=None, crs=None, interp='nearest', **kwargs):
+    def set_contourf(self, data=None, crs=None, interp='nearest',
+                     background=False, **kwargs):
         """Adds data to contour on the map.
 
+        The contours are computed once, here, and re-used by all calls to
+        plot().
+
         Parameters
         ----------
         mask: bool array (2d)
         crs: the data coordinate reference system
         interp: 'nearest' (default) or 'linear', the interpolation algorithm
+        background: compute the contours in a background thread. The
+        function returns immediately and plot() waits for the contours
         kwargs: anything accepted by contourf
         """
 
-
         # Check input
         if data is None:
             self._contourf_data = None
+            self._contourf_paths = None
+            self._contourf_thread = None
             return
 
-        self._contourf_data = self._check_data(data=data, crs=crs,
-                                               interp=interp)
+        data = self._check_data(data=data, crs=crs, interp=interp)
+        self._contourf_data = data
         self._contourf_kw = kwargs
+        self._contourf_paths = None
+        self._contourf_thread = None
+        if not background:
+            self._contourf_paths = contourf_paths(data, **kwargs)
+            return
+
+        out = []
+
+        def _run():
+            try:
+                out.append(contourf_paths(data, **kwargs))
+            except Exception as e:
+                out.append(e)
+
+        t = threading.Thread(target=_run)
+        t.daemon = True
+        t.start()
+        self._contourf_thread = (t, out)
+
+    @property
+    def _contourf_geometry(self):
+        """The contours of set_contourf (waits for them if needed)."""
+
+        if self._contourf_thread is not None:
+            t, out = self._contourf_thread
+            t.join()
+            self._contourf_thread = None
+            if isinstance(out[0], Exception):
+                raise out[0]
+            self._contourf_paths = out[0]
+        return self._contourf_paths
 
     def set_geometry(self, geometry=None, crs=salem.wgs84, text=None,
-                     text_delta=(0.01, 0.01), text_kwargs=dict(), **kwargs):
+                     text_delta=(0.01, 0.01), text_kwargs=None, **kwargs):
         """Adds any Shapely geometry to the map (including polygons,
         points, etc.) If called without arguments, it removes all previous
         geometries.
 
+        The geometry is clipped to the map extent: the parts out of sight
+        are not kept.
+
         Parameters
         ----------
         geometry: a Shapely gometry object (must be a scalar!)
@@ -418,6 +739,7 @@ class Map(DataLevels):
         # Reset?
         if geometry is None:
             self._geometries = []
+            self._points = []
             return
 
         # Transform
@@ -425,28 +747,148 @@ class Map(DataLevels):
                                             to_crs=self.grid.center_grid)
 
         # Text
+        text_kwargs = dict() if text_kwargs is None else text_kwargs
         if text is not None:
             x, y = geom.centroid.xy
-            x = x[0] + text_delta[0] * self.grid.nx
-            sign = self.grid.dy / np.abs(self.grid.dy)
-            y = y[0] + text_delta[1] * self.grid.ny * sign
-            self.set_text(x, y, text, crs=self.grid.center_grid,
-                          **text_kwargs)
-
-        # Save
-        if 'Multi' in geom.type:
+            self._set_delta_text(x[0], y[0], text, text_delta, text_kwargs)
+
+        # Save, with the others of same style if possible
+        geoms = self._clip_geometry(geom)
+        points = [g for g in geoms if g.type == 'Point']
+        if len(points) > 0:
+            self._add_points(np.array([g.x for g in points]),
+                             np.array([g.y for g in points]),
+                             _scatter_kwargs(kwargs))
+        for g in geoms:
+            if g.type == 'Polygon':
+                rings = [np.asarray(g.exterior.coords)]
+                rings += [np.asarray(r.coords) for r in g.interiors]
+                self._add_geometry('polygon', kwargs, (PolygonPath(g), rings))
+            elif g.type in ['LineString', 'LinearRing']:
+                kind = 'line'
+                if not all(hasattr(LineCollection, 'set_' + k)
+                           for k in kwargs):
+                    # Line2D only keywords (e.g. markers)
+                    kind = 'line2d'
+                self._add_geometry(kind, kwargs, np.asarray(g.coords))
+
+    def _clip_extent(self):
+        """The (xmin, ymin, xmax, ymax) of the visible area plus margin, in
+        map coordinates."""
+        nx, ny = self.grid.nx, self.grid.ny
+        margin = _CLIP_MARGIN * max(nx, ny)
+        return (-0.5 - margin, -0.5 - margin, nx - 0.5 + margin,
+                ny - 0.5 + margin)
+
+    def _clip_geometry(self, geom):
+        """Clip a geometry (in map coordinates) to the map extent.
+
+        Returns a list of simple geometries (no Multi*): empty if the
+        geometry is out of sight, the geometry itself if it is entirely
+        visible, the visible parts of it otherwise.
+        """
+
+        if geom.is_empty:
+            return []
+        xmin, ymin, xmax, ymax = self._clip_extent()
+        gx0, gy0, gx1, gy1 = geom.bounds
+        if gx0 > xmax or gx1 < xmin or gy0 > ymax or gy1 < ymin:
+            return []
+
+        if 'Multi' in geom.type or geom.type == 'GeometryCollection':
+            out = []
             for g in geom:
-                self._geometries.append((g, kwargs))
-                # dirty solution: I should use collections instead
-                if 'label' in kwargs:
-                    kwargs = kwargs.copy()
-                    del kwargs['label']
+                out.extend(self._clip_geometry(g))
+            return out
+
+        if gx0 >= xmin and gx1 <= xmax and gy0 >= ymin and gy1 <= ymax:
+            return [geom]
+
+        # Partly visible: keep the parts of the same dimension only (a
+        # polygon touching the box may also give points or lines)
+        dim = _GEOM_DIMS[geom.type]
+        clipped = geom.intersection(shpg.box(xmin, ymin, xmax, ymax))
+        if 'Multi' in clipped.type or clipped.type == 'GeometryCollection':
+            parts = list(clipped)
         else:
-            self._geometries.append((geom, kwargs))
+            parts = [clipped]
+        return [g for g in parts if not g.is_empty and
+                _GEOM_DIMS.get(g.type) == dim]
+
+    def _add_geometry(self, kind, kwargs, item):
+        """Add a geometry to the group of the same kind and style."""
+        for k, gkw, items in self._geometries:
+            if k == kind and _same_style(kwargs, gkw):
+                items.append(item)
+                return
+        self._geometries.append((kind, kwargs, [item]))
+
+    def _add_points(self, x, y, kwargs):
+        """Add points to the group of the same style."""
+        for i, (px, py, pkw) in enumerate(self._points):
+            if _same_style(kwargs, pkw):
+                self._points[i] = (np.append(px, x), np.append(py, y), pkw)
+                return
+        self._points.append((x, y, kwargs))
+
+    def _set_delta_text(self, x, y, text, text_delta, text_kwargs):
+        """Add a text shifted from a position in map coordinates."""
+        x = x + text_delta[0] * self.grid.nx
+        sign = self.grid.dy / np.abs(self.grid.dy)
+        y = y + text_delta[1] * self.grid.ny * sign
+        self.set_text(x, y, text, crs=self.grid.center_grid, **text_kwargs)
+
+    def set_points(self, x=None, y=None, crs=salem.wgs84, text=None,
+                   text_delta=(0.01, 0.01), text_kwargs=None, **kwargs):
+        """Add points to the map. If called without arguments, it removes
+        all previous points.
+
+        Unlike set_geometry(), the coordinates are transformed all at once
+        and kept as arrays. Points added with the same style are drawn
+        with a single call to scatter(). Points out of sight are not kept.
+
+        Parameters
+        ----------
+        x: the x coordinates of the points (array)
+        y: the y coordinates of the points (array)
+        crs: the associated coordinate reference system (default wgs84)
+        text: if you want to add a text to the points (it's position is
+        based on the points' centroid)
+        text_delta: it can be useful to shift the text of a certain amount
+        when annotating points. units are percentage of data coordinates.
+        text_kwargs: the keyword arguments to pass to the test() function
+        kwargs: all keywords accepted by scatter(): marker, s, edgecolor,
+        facecolor...
+        """
+
+        # Reset?
+        if x is None:
+            self._points = []
+            return
+
+        # Transform
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+        x, y = self.grid.center_grid.transform(x, y, crs=crs)
+        x = np.atleast_1d(x)
+        y = np.atleast_1d(y)
+
+        # Text
+        text_kwargs = dict() if text_kwargs is None else text_kwargs
+        if text is not None:
+            self._set_delta_text(np.mean(x), np.mean(y), text, text_delta,
+                                 text_kwargs)
+
+        # Clip
+        xmin, ymin, xmax, ymax = self._clip_extent()
+        visible = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+        if not np.all(visible):
+            x, y = x[visible], y[visible]
+            if len(x) == 0:
+                return
 
-    def set_points(self, x, y, **kwargs):
-        """Shortcut for set_geometry() accepting coordinates as input."""
-        self.set_geometry(MultiPoint(np.array([x, y]).T), **kwargs)
+        # Save, with the others of same style if possible
+        self._add_points(x, y, _scatter_kwargs(kwargs))
 
     def set_text(self, x=None, y=None, text='', crs=salem.wgs84, **kwargs):
         """Add a text to the map.
@@ -463,6 +905,56 @@ class Map(DataLevels):
         x, y = self.grid.center_grid.transform(x, y, crs=crs)
         self._text.append((x, y, text, kwargs))
 
+    def set_labels(self, x=None, y=None, texts=None, crs=salem.wgs84,
+                   priority=None, **kwargs):
+        """Add many text labels to the map (e.g. place names). If called
+        without arguments, it removes all previous labels.
+
+        Unlike set_text(), the labels which would overlap others are not
+        drawn: at draw time, the labels are placed by decreasing priority
+        and only those which do not collide with an already placed label
+        are drawn. The label sizes are estimated from the font size and
+        the number of characters.
+
+        Parameters
+        ----------
+        x: the x coordinates of the labels (array)
+        y: the y coordinates of the labels (array)
+        texts: the labels (list of strings)
+        crs: the associated coordinate reference system (default wgs84)
+        priority: the labels with higher priority are placed first (array,
+        default: in input order)
+        kwargs: all keywords accepted by mpl's text() function
+        """
+
+        # Reset?
+        if x is None:
+            self._labels = []
+            return
+
+        # Transform
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+        x, y = self.grid.center_grid.transform(x, y, crs=crs)
+        x = np.atleast_1d(x)
+        y = np.atleast_1d(y)
+        texts = np.asarray(texts, dtype=object).reshape(x.shape)
+        if priority is None:
+            priority = np.zeros(x.shape)
+        priority = np.broadcast_to(np.asarray(priority, dtype=float),
+                                   x.shape).copy()
+
+        # Clip
+        xmin, ymin, xmax, ymax = self._clip_extent()
+        visible = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+        if not np.all(visible):
+            x, y = x[visible], y[visible]
+            texts, priority = texts[visible], priority[visible]
+            if len(x) == 0:
+                return
+
+        self._labels.append((x, y, texts, priority, kwargs))
+
     def set_shapefile(self, shape=None, countries=False, oceans=False,
                       rivers=False, **kwargs):
         """Add a shapefile to the plot.
@@ -471,6 +963,8 @@ class Map(DataLevels):
         oceans and rivers (set one at the time!)
 
         set_shapefile() without argument will reset the map to zero shapefiles.
+        The shapes are clipped to the map extent. The shapefiles shipped with
+        cleo are read from a compiled binary format (see cleo.shapes).
 
         Parameters
         ----------
@@ -503,33 +997,279 @@ class Map(DataLevels):
             return
 
         # Transform
-        shape = salem.utils.read_shapefile_to_grid(shape, grid=self.grid)
-        if len(shape) == 0:
+        with profiling.stage('Map.set_shapefile', shape=shape) as stage:
+            if shape in files.values() and os.path.exists(shape):
+                shp, crs = shapes.load_shapes(shape), wgs84
+                stage.add(compiled=True)
+            else:
+                shp, crs = self._read_shapefile(shape)
+            kind, geoms = self._project_shapes(shp, crs)
+            stage.add(n_vertices=len(shp['vertices']), n_shapes=len(geoms))
+        if kind is None:
             return
 
         # Different collection for each type
-        geomtype = shape.iloc[0].geometry.type
-        if 'Polygon' in geomtype:
-            patches = []
-            for g in shape.geometry:
-                if 'Multi' in g.type:
-                    for gg in g:
-                        patches.append(PolygonPatch(gg))
-                else:
-                    patches.append(PolygonPatch(g))
+        if kind == 'polygon':
+            patches = [PathPatch(p) for p in geoms]
             kwargs.setdefault('facecolor', 'none')
             self._collections.append(PatchCollection(patches, **kwargs))
-        elif 'LineString' in geomtype:
-            lines = []
-            for g in shape.geometry:
-                if 'Multi' in g.type:
-                    for gg in g:
-                        lines.append(np.array(gg))
+        else:
+            self._collections.append(LineCollection(geoms, **kwargs))
+
+    def _read_shapefile(self, shape):
+        """Read a shapefile with salem, in its own reference system.
+
+        Returns
+        -------
+        the shapes as flat arrays (see cleo.shapes.from_geometries) and their
+        reference system
+        """
+
+        shape = salem.utils.read_shapefile(shape)
+        crs = salem.gis.check_crs(shape.crs)
+        if salem.gis.proj_is_same(crs, wgs84):
+            crs = wgs84
+        return shapes.from_geometries(shape.geometry), crs
+
+    def _transform_vertices(self, vertices, idx, crs):
+        """Map coordinates of the vertices[idx], projected in chunks."""
+
+        out = np.empty((len(idx), 2))
+        for i in range(0, len(idx), _TRANSFORM_CHUNK):
+            sel = idx[i:i + _TRANSFORM_CHUNK]
+            x, y = self.grid.transform(vertices[sel, 0], vertices[sel, 1],
+                                       crs=crs)
+            out[i:i + len(sel), 0] = x
+            out[i:i + len(sel), 1] = y
+        return out
+
+    def _lonlat_box(self):
+        """The (lon_min, lat_min, lon_max, lat_max) of the map plus margin.
+
+        None if the box cannot be computed from the map edges (a pole is in
+        the map, or the map crosses the dateline).
+        """
+
+        lon0, lon1, lat0, lat1 = self._ll_minmax()
+        if lon1 - lon0 > 180:
+            return None
+        px, py = self.grid.transform(np.array([0., 0.]),
+                                     np.array([90., -90.]), crs=wgs84)
+        xmin, ymin, xmax, ymax = self._clip_extent()
+        with np.errstate(invalid='ignore'):
+            if np.any((px >= xmin) & (px <= xmax) &
+                      (py >= ymin) & (py <= ymax)):
+                return None
+        pad = 0.1 * max(lon1 - lon0, lat1 - lat0)
+        return lon0 - pad, lat0 - pad, lon1 + pad, lat1 + pad
+
+    def _project_shapes(self, shp, crs=wgs84):
+        """The visible shapes in map coordinates, clipped.
+
+        The vertices of all rings are projected at once (in chunks), and the
+        rings are rebuilt out of their offsets. In lon, lat, the rings which
+        cannot be visible are discarded before the projection.
+
+        Parameters
+        ----------
+        shp: the shapes as flat arrays (see cleo.shapes)
+        crs: the reference system of the vertices
+
+        Returns
+        -------
+        the kind of geometry ('line', 'polygon' or None if there is no shape)
+        and the list of the visible lines ((N, 2) arrays) or polygons
+        (matplotlib paths)
+        """
+
+        kind, lonlat = shp['kind'], shp['vertices']
+        rings, parts, bbox = shp['rings'], shp['parts'], shp['bbox']
+
+        # Parts, then rings, which may be visible
+        box = self._lonlat_box() if crs is wgs84 else None
+        if box is None:
+            psel = np.arange(len(parts) - 1)
+        else:
+            psel = np.flatnonzero((bbox[:, 0] <= box[2]) &
+                                  (bbox[:, 2] >= box[0]) &
+                                  (bbox[:, 1] <= box[3]) &
+                                  (bbox[:, 3] >= box[1]))
+        if len(psel) == 0:
+            return kind, []
+        rsel = _ranges(parts[psel], parts[psel + 1])
+        first = np.zeros(len(rsel), dtype=bool)
+        first[np.cumsum(parts[psel + 1] - parts[psel])[:-1]] = True
+        first[0] = True
+        if box is not None and kind == 'polygon':
+            # the holes out of sight can be ignored
+            vsel = _ranges(rings[rsel], rings[rsel + 1])
+            r0, _ = _offsets(rings[rsel + 1] - rings[rsel])
+            lon, lat = lonlat[vsel, 0], lonlat[vsel, 1]
+            keep = first | ((np.minimum.reduceat(lon, r0) <= box[2]) &
+                            (np.maximum.reduceat(lon, r0) >= box[0]) &
+                            (np.minimum.reduceat(lat, r0) <= box[3]) &
+                            (np.maximum.reduceat(lat, r0) >= box[1]))
+            rsel, first = rsel[keep], first[keep]
+
+        # Project everything at once
+        vsel = _ranges(rings[rsel], rings[rsel + 1])
+        xy = self._transform_vertices(lonlat, vsel, crs)
+        r0, r1 = _offsets(rings[rsel + 1] - rings[rsel])
+
+        # Where are the rings?
+        xmin, ymin, xmax, ymax = self._clip_extent()
+        with np.errstate(invalid='ignore'):
+            rx0 = np.minimum.reduceat(xy[:, 0], r0)
+            rx1 = np.maximum.reduceat(xy[:, 0], r0)
+            ry0 = np.minimum.reduceat(xy[:, 1], r0)
+            ry1 = np.maximum.reduceat(xy[:, 1], r0)
+            finite = (np.isfinite(rx0) & np.isfinite(rx1) &
+                      np.isfinite(ry0) & np.isfinite(ry1))
+            visible = (finite & (rx0 <= xmax) & (rx1 >= xmin) &
+                       (ry0 <= ymax) & (ry1 >= ymin))
+            inside = (visible & (rx0 >= xmin) & (rx1 <= xmax) &
+                      (ry0 >= ymin) & (ry1 <= ymax))
+
+        out = []
+        pstart = np.flatnonzero(first)
+        for p0, p1 in zip(pstart, np.append(pstart[1:], len(rsel))):
+            if not finite[p0] and box is not None:
+                # some vertices cannot be projected (e.g. too far away from
+                # the map): the shape is clipped in lon, lat first
+                lls = [lonlat[rings[r]:rings[r + 1]] for r in rsel[p0:p1]]
+                out.extend(self._project_clipped(kind, lls, box))
+                continue
+            if not visible[p0]:
+                continue
+            ext = xy[r0[p0]:r1[p0]]
+            if kind == 'line':
+                if inside[p0]:
+                    out.append(ext)
                 else:
-                    lines.append(np.array(g))
-            self._collections.append(LineCollection(lines, **kwargs))
+                    geoms = self._clip_geometry(shpg.LineString(ext))
+                    out.extend(np.asarray(g.coords) for g in geoms)
+                continue
+            holes = [xy[r0[r]:r1[r]] for r in range(p0 + 1, p1)
+                     if visible[r]]
+            if inside[p0]:
+                out.append(_rings_path([ext] + holes))
+            else:
+                geoms = self._clip_geometry(shpg.Polygon(ext, holes))
+                out.extend(PolygonPath(g) for g in geoms)
+        return kind, out
+
+    def _project_clipped(self, kind, rings, box, n=32):
+        """Clip a shape to a lon, lat box, then project and clip it to the
+        map extent.
+
+        Parameters
+        ----------
+        kind: 'line' or 'polygon'
+        rings: the line, or the exterior and holes of the polygon (lon, lat)
+        box: the (lon_min, lat_min, lon_max, lat_max) box (see _lonlat_box)
+        n: the number of vertices per side of the box, so that its sides
+        stay out of sight once projected
+
+        Returns
+        -------
+        the visible lines ((N, 2) arrays) or polygons (matplotlib paths)
+        """
+
+        x = np.linspace(box[0], box[2], n)
+        y = np.linspace(box[1], box[3], n)
+        bx = np.concatenate([x, x * 0 + box[2], x[::-1], x * 0 + box[0]])
+        by = np.concatenate([y * 0 + box[1], y, y * 0 + box[3], y[::-1]])
+        if kind == 'line':
+            geom = shpg.LineString(rings[0])
+        else:
+            geom = shpg.Polygon(rings[0], rings[1:])
+            if not geom.is_valid:
+                geom = geom.buffer(0)
+        geom = geom.intersection(shpg.Polygon(np.stack([bx, by], axis=1)))
+        if 'Multi' in geom.type or geom.type == 'GeometryCollection':
+            parts = list(geom)
         else:
-            raise NotImplementedError(geomtype)
+            parts = [geom]
+
+        out = []
+        dim = 1 if kind == 'line' else 2
+        for g in parts:
+            if g.is_empty or _GEOM_DIMS.get(g.type) != dim:
+                continue
+            if kind == 'line':
+                g = shpg.LineString(self._project_ring(g.coords))
+            else:
+                g = shpg.Polygon(self._project_ring(g.exterior.coords),
+                                 [self._project_ring(h.coords)
+                                  for h in g.interiors])
+            for c in self._clip_geometry(g):
+                out.append(np.asarray(c.coords) if kind == 'line' else
+                           PolygonPath(c))
+        return out
+
+    def _project_ring(self, coords):
+        """Map coordinates of a (lon, lat) sequence, as a (N, 2) array."""
+        lonlat = np.asarray(coords)
+        return self._transform_vertices(lonlat, np.arange(len(lonlat)), wgs84)
+
+    @property
+    def _pixcorner_ll(self):
+        """The lon, lat coordinates of the pixel corners (computed once).
+
+        They are stored with the precision of the map (see set_dtype).
+        """
+        if self._ll_corners is None:
+            xx, yy = self.grid.pixcorner_ll_coordinates
+            self._ll_corners = (self._as_dtype(xx), self._as_dtype(yy))
+        return self._ll_corners
+
+    @property
+    def _pixcorner_ll_edges(self):
+        """The lon, lat coordinates of the pixel corners on the map edges.
+
+        A dict with the (lon, lat) arrays of the first and last rows ('row0',
+        'row1') and of the first and last columns ('col0', 'col1'). Unlike
+        _pixcorner_ll, this costs O(nx + ny) projections only.
+        """
+
+        if self._ll_edges is None:
+            nx, ny = self.grid.nx, self.grid.ny
+            if self._ll_corners is not None:
+                xx, yy = self._ll_corners
+                rows = dict(row0=0, row1=-1)
+                cols = dict(col0=0, col1=-1)
+                out = dict()
+                for k, r in rows.items():
+                    out[k] = (xx[r, :], yy[r, :])
+                for k, c in cols.items():
+                    out[k] = (xx[:, c], yy[:, c])
+            else:
+                cg = self.grid.corner_grid
+                ii = np.arange(nx + 1)
+                jj = np.arange(ny + 1)
+                edges = dict(row0=(ii, ii * 0), row1=(ii, ii * 0 + ny),
+                             col0=(jj * 0, jj), col1=(jj * 0 + nx, jj))
+                out = dict()
+                for k, (i, j) in edges.items():
+                    x = cg.x0 + i * cg.dx
+                    y = cg.y0 + j * cg.dy
+                    lon, lat = salem.gis.transform_proj(self.grid.proj,
+                                                        wgs84, x, y)
+                    out[k] = (self._as_dtype(np.asarray(lon)),
+                              self._as_dtype(np.asarray(lat)))
+            self._ll_edges = out
+        return self._ll_edges
+
+    def _ll_minmax(self):
+        """Min and max of the lon, lat on the map edges.
+
+        The extrema are assumed to be on the edges (this is not the case
+        if a pole is in the map).
+        """
+        e = self._pixcorner_ll_edges
+        xx = np.concatenate([v[0] for v in e.values()])
+        yy = np.concatenate([v[1] for v in e.values()])
+        return np.min(xx), np.max(xx), np.min(yy), np.max(yy)
 
     def _find_interval(self):
         """Quick n dirty function to find a suitable lonlat interval."""
@@ -537,12 +1277,10 @@ class Map(DataLevels):
                       0.01, 0.02, 0.05,
                       0.1, 0.2, 0.5,
                       1, 2, 5, 10, 20]
-        xx, yy = self.grid.pixcorner_ll_coordinates
+        xmin, xmax, ymin, ymax = self._ll_minmax()
         for inter in candidates:
-            _xx = xx / inter
-            _yy = yy / inter
-            mm_x = [np.ceil(np.min(_xx)), np.floor(np.max(_xx))]
-            mm_y = [np.ceil(np.min(_yy)), np.floor(np.max(_yy))]
+            mm_x = [np.ceil(xmin / inter), np.floor(xmax / inter)]
+            mm_y = [np.ceil(ymin / inter), np.floor(ymax / inter)]
             nx = mm_x[1]-mm_x[0]+1
             ny = mm_y[1]-mm_y[0]+1
             if np.max([nx, ny]) <= 8:
@@ -573,11 +1311,9 @@ class Map(DataLevels):
             yinterval = interval
 
         # Change XY into interval coordinates, and back after rounding
-        xx, yy = self.grid.pixcorner_ll_coordinates
-        _xx = xx / xinterval
-        _yy = yy / yinterval
-        mm_x = [np.ceil(np.min(_xx)), np.floor(np.max(_xx))]
-        mm_y = [np.ceil(np.min(_yy)), np.floor(np.max(_yy))]
+        xmin, xmax, ymin, ymax = self._ll_minmax()
+        mm_x = [np.ceil(xmin / xinterval), np.floor(xmax / xinterval)]
+        mm_y = [np.ceil(ymin / yinterval), np.floor(ymax / yinterval)]
         self.xtick_levs = (mm_x[0] + np.arange(mm_x[1]-mm_x[0]+1)) * xinterval
         self.ytick_levs = (mm_y[0] + np.arange(mm_y[1]-mm_y[0]+1)) * yinterval
 
@@ -591,7 +1327,9 @@ class Map(DataLevels):
         self.ytick_pos = []
         self.ytick_val = []
         if add_tick_labels:
-            _xx = xx[0 if self.origin == 'lower' else -1, :]
+            edges = self._pixcorner_ll_edges
+            # the lons of the bottom row
+            _xx = edges['row0' if self.origin == 'lower' else 'row1'][0]
             _xi = np.arange(self.grid.nx+1)
             for xl in self.xtick_levs:
                 if (xl > _xx[-1]) or (xl < _xx[0]):
@@ -603,7 +1341,7 @@ class Map(DataLevels):
                     label = '0'
                 self.xtick_val.append(label)
 
-            _yy = np.sort(yy[:, 0])
+            _yy = np.sort(edges['col0'][1])
             _yi = np.arange(self.grid.ny+1)
             if self.origin == 'upper':
                 _yi = _yi[::-1]
@@ -626,6 +1364,7 @@ class Map(DataLevels):
         """Compute the shading factor out of the slope."""
 
         # reset?
+        self._changed('slope')
         if slope is None:
             self.slope = None
             return
@@ -660,14 +1399,16 @@ class Map(DataLevels):
         if isinstance(topo, string_types):
             _, ext = os.path.splitext(topo)
             if ext.lower() == '.tif':
-                g = salem.datasets.GeoTiff(topo)
-                # Spare memory
-                ex = self.grid.extent_in_crs(crs=wgs84)  # l, r, b, t
-                g.set_subset(corners=((ex[0], ex[2]), (ex[1], ex[3])),
-                             crs=wgs84, margin=10)
-                z = g.get_vardata()
-                z[z < -999] = 0
-                z = self.grid.map_gridded_data(z, g.grid, **kwargs)
+                with profiling.stage('Map.set_topography.read', file=topo):
+                    g = salem.datasets.GeoTiff(topo)
+                    # Spare memory
+                    ex = self.grid.extent_in_crs(crs=wgs84)  # l, r, b, t
+                    g.set_subset(corners=((ex[0], ex[2]), (ex[1], ex[3])),
+                                 crs=wgs84, margin=10)
+                    z = g.get_vardata()
+                    z[z < -999] = 0
+                    z = self.grid.map_gridded_data(z, g.grid, **kwargs)
+                    z = self._as_dtype(z)
             else:
                 raise ValueError('File extension not recognised: {}'
                                  .format(ext))
@@ -675,16 +1416,18 @@ class Map(DataLevels):
             z = self._check_data(topo, crs=crs, **kwargs)
 
         # Gradient in m m-1
-        ddx = self.grid.dx
-        ddy = self.grid.dy
-        if self.grid.proj.is_latlong():
-            # we make a coarse approx of the avg dx on a sphere
-            _, lat = self.grid.ll_coordinates
-            ddx = np.mean(ddx * 111200 * np.cos(lat * np.pi / 180))
-            ddy *= 111200
-
-        dy, dx = np.gradient(z, ddy, ddx)
-        self._shading_base(dx - dy, relief_factor=relief_factor)
+        with profiling.stage('Map.set_topography.gradient') as stage:
+            ddx = self.grid.dx
+            ddy = self.grid.dy
+            if self.grid.proj.is_latlong():
+                # we make a coarse approx of the avg dx on a sphere
+                _, lat = self.grid.ll_coordinates
+                ddx = np.mean(ddx * 111200 * np.cos(lat * np.pi / 180))
+                ddy *= 111200
+
+            dy, dx = np.gradient(z, ddy, ddx)
+            self._shading_base(dx - dy, relief_factor=relief_factor)
+            stage.add(**profiling.array_info(self.slope))
         return z
 
     def set_rgb(self, img=None, crs=None):
@@ -697,36 +1440,110 @@ class Map(DataLevels):
         out = []
         for i in [0, 1, 2]:
             out.append(self._check_data(img[..., i], crs=crs))
-        self._rgb = np.dstack(out)
+        self._rgb = self._as_dtype(np.dstack(out))
+        self._changed('rgb')
 
-    def to_rgb(self):
-        """Transform the data to a RGB image and add topographical shading."""
+    def set_render_cache(self, max_bytes=2**28):
+        """Size of the render cache.
 
-        if self._rgb is None:
-            toplot = DataLevels.to_rgb(self)
-        else:
-            toplot = self._rgb
+        The last image computed by to_rgb() (and the last PNG of to_png())
+        is kept and returned again as long as the map inputs (data, levels,
+        colormap, topography, rgb) are not changed with the set_* functions
+        and the colors of the colormap are unchanged.
 
-        # Shading
-        if self.slope is not None:
-            # remove alphas?
-            try:
-                pno = np.where(toplot[:, :, 3] == 0.)
-                for i in [0, 1, 2]:
-                    toplot[pno[0], pno[1], i] = 1
-                toplot[:, :, 3] = 1
-            except IndexError:
-                pass
-
-            # Actual shading
-            level = 1.0 - 0.1 * self.relief_factor
-            sens = 1 + 0.7 * self.relief_factor * self.slope
-            for i in [0, 1, 2]:
-                toplot[:, :, i] = np.clip(level * toplot[:, :, i] * sens, 0, 1)
+        Parameters
+        ----------
+        max_bytes: the maximum memory used by the cache (0 to disable it)
+        """
+        self._render_max_bytes = max_bytes
+        self.invalidate()
+
+    def invalidate(self):
+        """Empty the render cache.
+
+        The map cannot notice in-place modifications of its arrays: call
+        invalidate() after these.
+        """
+        self._render_cache = dict()
+
+    def _cached(self, kind, func):
+        """Get a rendering result from the cache, or compute it."""
+
+        key = (tuple(sorted(self._versions.items())),
+               cleo.colors.fingerprint(self.cmap))
+        cache = self._render_cache
+        if cache.get('key') != key:
+            cache.clear()
+            cache['key'] = key
+        if kind in cache:
+            return cache[kind]
+
+        out = func()
+        size = sum(len(v) if isinstance(v, bytes) else v.nbytes
+                   for k, v in cache.items() if k != 'key')
+        size += len(out) if isinstance(out, bytes) else out.nbytes
+        if size <= self._render_max_bytes:
+            if isinstance(out, np.ndarray):
+                # the cached image is shared by all callers
+                out.flags.writeable = False
+            cache[kind] = out
+        return out
+
+    def to_rgb(self, copy=True):
+        """Transform the data to a RGB image and add topographical shading.
+
+        Parameters
+        ----------
+        copy: return a copy of the image (default). With copy=False, the
+        cached image itself is returned (see set_render_cache): it is
+        read-only.
+        """
+        out = self._cached('rgb', self._to_rgb)
+        if copy and not out.flags.writeable:
+            # a new image (not cached) is already the caller's
+            out = out.copy()
+        return out
+
+    def snapshot(self):
+        """A frozen copy of the map, which can be plotted by several threads
+        at once (see MapSnapshot)."""
+        return MapSnapshot(self)
+
+    def to_png(self):
+        """The image of to_rgb() encoded as PNG (bytes, cached)."""
+
+        def _encode():
+            buf = io.BytesIO()
+            mpl.image.imsave(buf, self.to_rgb(copy=False), format='png',
+                             origin=self.origin)
+            return buf.getvalue()
+
+        return self._cached('png', _encode)
+
+    def _to_rgb(self):
+        """The actual work of to_rgb()."""
+
+        with profiling.stage('Map.to_rgb'):
+            if self._rgb is None:
+                toplot = DataLevels.to_rgb(self)
+            else:
+                # the shading works in place
+                toplot = self._rgb.copy()
+
+            # Shading
+            if self.slope is not None:
+                with profiling.stage('Map.shading'):
+                    _remove_alpha(toplot)
+                    shade_rgb(toplot, self.slope,
+                              relief_factor=self.relief_factor)
 
         # OK!
         return toplot
 
+    def _collection_artists(self):
+        """New artists for the shapefile collections."""
+        return [copy.copy(col) for col in self._collections]
+
     def plot(self, ax):
         """Add the map plot to an axis.
 
@@ -735,19 +1552,20 @@ class Map(DataLevels):
         """
 
         # Image is the easiest
-        ax.imshow(self.to_rgb(), interpolation='none', origin=self.origin)
+        self._imshow(ax, self.to_rgb(copy=False), self.origin)
         ax.autoscale(False)
 
         # Stippling
         if self._contourf_data is not None:
-            ax.contourf(self._contourf_data, **self._contourf_kw)
+            for vertices, codes, kwargs in self._contourf_geometry:
+                ax.add_patch(PathPatch(Path(vertices, codes), **kwargs))
 
         # Shapefiles
-        for col in self._collections:
-            ax.add_collection(copy.copy(col))
+        for col in self._collection_artists():
+            ax.add_collection(col)
 
         # Lon lat contours
-        lon, lat = self.grid.pixcorner_ll_coordinates
+        lon, lat = self._pixcorner_ll
         if len(self.xtick_levs) > 0:
             ax.contour(lon, levels=self.xtick_levs,
                        extent=(-0.5, self.grid.nx-0.5, -0.5, self.grid.ny),
@@ -757,40 +1575,45 @@ class Map(DataLevels):
                        extent=(-0.5, self.grid.nx, -0.5, self.grid.ny-0.5),
                        **self.ll_contour_kw)
 
-        # Geometries
-        for g, kwargs in self._geometries:
-            if g.type == 'Polygon':
+        # Geometries: one or two collections per style
+        for kind, kwargs, items in self._geometries:
+            kwargs = kwargs.copy()
+            if kind == 'polygon':
                 kwargs.setdefault('facecolor', 'none')
-                plot_polygon(ax, g, **kwargs)  # was g.buffer(0). Why?
-            if g.type in ['LineString', 'LinearRing']:
-                a = np.array(g)
+                edgecolor = kwargs.pop('edgecolor', 'black')
+                patches = [PathPatch(path, **kwargs) for path, _ in items]
+                # match_original does not take care of these
+                extra = dict((k, kwargs[k]) for k in ['hatch', 'zorder',
+                                                      'label', 'alpha']
+                             if k in kwargs)
+                ax.add_collection(PatchCollection(patches, match_original=True,
+                                                  **extra))
+                rings = [r for _, rs in items for r in rs]
+                ax.add_collection(LineCollection(rings, colors=edgecolor,
+                                                 zorder=2))
+            elif kind == 'line':
                 kwargs.setdefault('color', 'k')
-                ax.plot(a[:, 0], a[:, 1], **kwargs)
-            if g.type == 'Point':
-                kwargs.setdefault('marker', 'o')
-                kwargs.setdefault('s', 60)
-                kwargs.setdefault('facecolor', 'w')
-                kwargs.setdefault('edgecolor', 'k')
-                kwargs.setdefault('linewidths', 1)
-                if 'markersize' in kwargs:
-                    # For those tempted to use the whole kw
-                    kwargs['s'] = kwargs['markersize']
-                    del kwargs['markersize']
-                if 'color' in kwargs:
-                    # For those tempted to use the whole kw
-                    kwargs['facecolor'] = kwargs['color']
-                    kwargs['edgecolor'] = kwargs['color']
-                if 'c' in kwargs:
-                    # For those tempted to use the whole kw
-                    kwargs['facecolor'] = kwargs['c']
-                    kwargs['edgecolor'] = kwargs['c']
-                    del kwargs['c']
-                ax.scatter(g.x, g.y, **kwargs)
+                kwargs.setdefault('zorder', 2)
+                ax.add_collection(LineCollection(items, **kwargs))
+            else:
+                # one Line2D: the lines are separated by NaNs
+                kwargs.setdefault('color', 'k')
+                gap = np.full((1, 2), np.NaN)
+                xy = np.concatenate([p for a in items for p in (a, gap)])
+                ax.plot(xy[:-1, 0], xy[:-1, 1], **kwargs)
+
+        # Points
+        for x, y, kwargs in self._points:
+            ax.scatter(x, y, **kwargs)
 
         # Texts
         for x, y, s, kwargs in self._text:
             ax.text(x, y, s, **kwargs)
 
+        # Labels: only those which do not overlap, chosen at draw time
+        if len(self._labels) > 0:
+            ax.add_artist(_LabelCollection(list(self._labels)))
+
         # Ticks
         if (len(self.xtick_pos) > 0) or (len(self.ytick_pos) > 0):
             ax.xaxis.set_ticks(np.array(self.xtick_pos)-0.5)
@@ -802,6 +1625,656 @@ class Map(DataLevels):
             ax.yaxis.set_ticks([])
 
 
+def _read_only(a):
+    """A read-only copy of an array (also masked)."""
+    a = a.copy()
+    for arr in [a, np.ma.getmask(a)]:
+        if isinstance(arr, np.ndarray):
+            arr.flags.writeable = False
+    return a
+
+
+class MapSnapshot(Map):
+    """A frozen copy of a Map, for concurrent rendering.
+
+    All the layers of the map (image, shapefiles, contours, geometries,
+    labels, ticks...) are copied and everything the rendering needs is
+    computed at creation. The snapshot cannot be modified: its arrays are
+    read-only and the set_* methods raise an AttributeError. Each call to
+    plot() makes its own artists, so that the same snapshot can be plotted
+    by several threads at once, on different figures::
+
+        snap = m.snapshot()
+        pool.map(lambda title: snap.render_png(title=title), titles)
+
+    Changing the map afterwards does not change the snapshot.
+    """
+
+    def __init__(self, m):
+        """Instanciate.
+
+        Parameters
+        ----------
+        m: the cleo.Map to freeze
+        """
+
+        with profiling.stage('Map.snapshot'):
+            # compute everything which is lazy
+            rgb = m.to_rgb(copy=False)
+            m._pixcorner_ll
+            m._pixcorner_ll_edges
+            m._contourf_geometry
+
+            state = dict()
+            for k, v in m.__dict__.items():
+                if k in ['_render_cache', '_contourf_thread', '_collections']:
+                    continue
+                if k in ['grid', '_shared_memory']:
+                    # immutable, or a handle which must not be re-opened
+                    state[k] = v
+                elif isinstance(v, np.ndarray):
+                    state[k] = _read_only(v)
+                elif isinstance(v, tuple) and len(v) > 0 and \
+                        all(isinstance(a, np.ndarray) for a in v):
+                    state[k] = tuple(_read_only(a) for a in v)
+                else:
+                    state[k] = copy.deepcopy(v)
+            state['_contourf_thread'] = None
+            state['_collection_specs'] = []
+            for col in m._collections:
+                kind, style, arrays = _collection_to_arrays(col)
+                arrays = dict((n, _read_only(a)) for n, a in arrays.items())
+                state['_collection_specs'].append((kind, style, arrays))
+
+            # the colors, computed once
+            state['_snapshot_rgb'] = _read_only(rgb)
+            state['_snapshot_levels'] = _read_only(np.asarray(m.levels))
+            state['_snapshot_vmin'] = m.vmin
+            state['_snapshot_vmax'] = m.vmax
+            state['_snapshot_extend'] = m.extend
+            # our own norm, not the shared one: the colorbars may write to it
+            state['_snapshot_norm'] = cleo.colors.ExtendedNorm(
+                state['_snapshot_levels'], state['cmap'].N,
+                extend=state['_snapshot_extend'])
+            # the colormaps are initialized lazily
+            state['cmap'](0.)
+            state['_snapshot_png'] = None
+            state['_snapshot_lock'] = threading.Lock()
+            self.__dict__.update(state)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('A MapSnapshot cannot be modified.')
+
+    @property
+    def levels(self):
+        return self._snapshot_levels
+
+    @property
+    def vmin(self):
+        return self._snapshot_vmin
+
+    @property
+    def vmax(self):
+        return self._snapshot_vmax
+
+    @property
+    def extend(self):
+        return self._snapshot_extend
+
+    @property
+    def norm(self):
+        return self._snapshot_norm
+
+    def to_rgb(self, copy=False):
+        """The RGB image of the map (read-only, unless copy is set)."""
+        return self._snapshot_rgb.copy() if copy else self._snapshot_rgb
+
+    def to_png(self):
+        """The image of to_rgb() encoded as PNG (bytes, computed once)."""
+
+        with self._snapshot_lock:
+            if self._snapshot_png is None:
+                buf = io.BytesIO()
+                mpl.image.imsave(buf, self.to_rgb(copy=False), format='png',
+                                 origin=self.origin)
+                self.__dict__['_snapshot_png'] = buf.getvalue()
+        return self._snapshot_png
+
+    def _collection_artists(self):
+        return [_collection_from_arrays(kind, style, **arrays)
+                for kind, style, arrays in self._collection_specs]
+
+    def render(self, figsize=None, dpi=None, **kwargs):
+        """Plot the map on a new figure (not managed by pyplot).
+
+        Parameters
+        ----------
+        figsize: the size of the figure
+        dpi: the resolution of the figure
+        kwargs: all keywords accepted by visualize() (title, addcbar...)
+
+        Returns
+        -------
+        the matplotlib Figure
+        """
+
+        fig = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(1, 1, 1)
+        self.visualize(ax=ax, **kwargs)
+        fig.tight_layout()
+        return fig
+
+    def render_png(self, figsize=None, dpi=None, **kwargs):
+        """Like render(), but returns the figure encoded as PNG (bytes)."""
+
+        buf = io.BytesIO()
+        self.render(figsize=figsize, dpi=dpi, **kwargs).savefig(buf,
+                                                                format='png')
+        return buf.getvalue()
+
+
+def _image_extent(nx, ny, origin):
+    """The default extent of imshow, also valid for reduced images."""
+    if origin == 'upper':
+        return -0.5, nx - 0.5, ny - 0.5, -0.5
+    return -0.5, nx - 0.5, -0.5, ny - 0.5
+
+
+def _block_mean(img, fx, fy):
+    """Average of an image by blocks of fx x fy pixels (float)."""
+
+    # No overflow with integer images
+    dtype = np.float64 if img.dtype.kind in ['i', 'u'] else img.dtype
+    out = img
+    for axis, f in [(0, fy), (1, fx)]:
+        n = img.shape[axis]
+        if f == 1:
+            continue
+        # Sum of the strided views: much faster than np.add.reduceat
+        sl = [slice(None)] * img.ndim
+        sl[axis] = slice(0, None, f)
+        acc = np.array(out[tuple(sl)], dtype=dtype)
+        for k in range(1, f):
+            sl[axis] = slice(k, None, f)
+            part = out[tuple(sl)]
+            tsl = [slice(None)] * img.ndim
+            tsl[axis] = slice(0, part.shape[axis])
+            acc[tuple(tsl)] += part
+        sizes = np.diff(np.append(np.arange(0, n, f), n))
+        shp = [1] * img.ndim
+        shp[axis] = len(sizes)
+        out = acc / sizes.reshape(shp).astype(dtype)
+    return np.asarray(out, dtype=dtype)
+
+
+def downsample(img, fx, fy):
+    """Average an image by blocks of fx x fy pixels.
+
+    The colors of an RGBA image are weighted by their alpha (premultiplied
+    alpha): the color of the transparent pixels does not bleed into their
+    neighbors.
+
+    Parameters
+    ----------
+    img: the image array (2d, or 3d with the color channels last)
+    fx: the block size along x (columns)
+    fy: the block size along y (rows)
+    """
+
+    if fx == 1 and fy == 1:
+        return img
+    alpha = None
+    if img.ndim == 3 and img.shape[2] == 4:
+        alpha = img[..., 3]
+        if alpha.min() == alpha.max():
+            # opaque (or uniform): nothing to weight
+            alpha = None
+    if alpha is None:
+        out = _block_mean(img, fx, fy)
+    else:
+        w = np.array(img, dtype=np.result_type(img.dtype, np.float32))
+        w[..., :3] *= w[..., 3:]
+        out = _block_mean(w, fx, fy)
+        a = out[..., 3:]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out[..., :3] = np.where(a > 0, out[..., :3] / a, 0)
+    return out.astype(img.dtype, copy=False)
+
+
+def _factors(img, bbox):
+    """The largest block sizes keeping the image larger than bbox."""
+    ny, nx = img.shape[:2]
+    fx = max(1, int(nx // max(abs(bbox.width), 1)))
+    fy = max(1, int(ny // max(abs(bbox.height), 1)))
+    return fx, fy
+
+
+def downsample_to_axes(ax, img):
+    """Reduce an image to the size of the axes on screen.
+
+    The image is averaged by blocks of N x M pixels, with N and M the
+    largest integers keeping the image at least as large as the axes. The
+    image is returned unchanged if it is not larger than the axes.
+
+    Parameters
+    ----------
+    ax: the axes where the image will be shown
+    img: the image array (2d, or 3d with the color channels last)
+    """
+    fx, fy = _factors(img, ax.get_window_extent())
+    return downsample(img, fx, fy)
+
+
+class _DownsampledImage(AxesImage):
+    """An image reduced to its size on screen at each draw.
+
+    The full image is kept, and averaged by blocks (see downsample())
+    with the size the image has in this draw: the layout, zoom and dpi
+    (e.g. of savefig) are the final ones.
+    """
+
+    def __init__(self, ax, **kwargs):
+        super(_DownsampledImage, self).__init__(ax, **kwargs)
+        self._full = None
+        self._shown = None
+
+    def set_data(self, A):
+        """Set the full image."""
+        self._full = A
+        self._shown = None
+        super(_DownsampledImage, self).set_data(A)
+
+    def draw(self, renderer, *args, **kwargs):
+        """Reduces the image to its size on screen, and draws it."""
+
+        if self._full is not None:
+            factors = _factors(self._full, self.get_window_extent(renderer))
+            if self._shown != factors:
+                out = downsample(self._full, *factors)
+                AxesImage.set_data(self, out)
+                self._shown = factors
+        super(_DownsampledImage, self).draw(renderer, *args, **kwargs)
+
+
+def _add_values(ax, data, fontsize=None):
+    """Write the values of a 2d array in the pixels, as a single artist.
+
+    The pixels are decimated so that the texts do not overlap at the current
+    figure size. Each distinct text is converted to a path once, and all
+    texts are drawn by one PathCollection (one artist instead of one Text
+    per pixel).
+    """
+
+    ny, nx = data.shape
+    size = mpl.font_manager.FontProperties(size=fontsize)
+    size = size.get_size_in_points()
+
+    # Room available per pixel (in points) and decimation
+    o, dx, dy = ax.transData.transform([[0, 0], [1, 0], [0, 1]])
+    topoints = 72 / ax.figure.dpi
+    cellw = np.abs(dx[0] - o[0]) * topoints
+    cellh = np.abs(dy[1] - o[1]) * topoints
+    stepy = max(1, int(np.ceil(1.5 * size / cellh)))
+    vals = np.ma.filled(data[::stepy, :].astype(np.float64), np.NaN)
+    texts = np.char.mod('%g', vals)
+    nchar = np.char.str_len(texts).max()
+    stepx = max(1, int(np.ceil(0.6 * size * (nchar + 1) / cellw)))
+    texts = texts[:, ::stepx]
+    ii, jj = np.meshgrid(np.arange(0, nx, stepx), np.arange(0, ny, stepy))
+    valid = texts != 'nan'
+    if not np.any(valid):
+        return
+    texts, ii, jj = texts[valid], ii[valid], jj[valid]
+
+    # One centered path per distinct text
+    uniq, inverse = np.unique(texts, return_inverse=True)
+    paths = []
+    for t in uniq:
+        p = mpl.textpath.TextPath((0, 0), t, size=size)
+        (x0, y0), (x1, y1) = p.get_extents().get_points()
+        paths.append(mpl.path.Path(p.vertices - [(x0 + x1) / 2,
+                                                 (y0 + y1) / 2], p.codes))
+    paths = [paths[k] for k in inverse.ravel()]
+
+    kwargs = dict(offsets=np.column_stack((ii, jj)),
+                  transform=mpl.transforms.Affine2D().scale(1 / 72) +
+                  ax.figure.dpi_scale_trans,
+                  facecolors='k', edgecolors='none')
+    try:
+        col = mpl.collections.PathCollection(paths,
+                                             offset_transform=ax.transData,
+                                             **kwargs)
+    except (AttributeError, TypeError):  # matplotlib < 3.6
+        col = mpl.collections.PathCollection(paths, transOffset=ax.transData,
+                                             **kwargs)
+    ax.add_collection(col, autolim=False)
+
+
+def _label_boxes(ax, x, y, texts, kwargs):
+    """Estimated (xmin, ymin, xmax, ymax) of text labels in display units.
+
+    Computing the real extents would need a renderer and a text layout per
+    label: we use the average proportions of a character instead.
+    """
+
+    size = kwargs.get('fontsize', kwargs.get('size', None))
+    size = mpl.font_manager.FontProperties(size=size).get_size_in_points()
+    size *= ax.figure.dpi / 72
+    lines = [six.text_type(t).split('\n') for t in texts]
+    w = np.array([max(len(l) for l in ls) for ls in lines]) * 0.6 * size
+    h = np.array([len(ls) for ls in lines]) * 1.2 * size
+
+    px, py = ax.transData.transform(np.column_stack((x, y))).T
+    ha = kwargs.get('ha', kwargs.get('horizontalalignment', 'left'))
+    va = kwargs.get('va', kwargs.get('verticalalignment', 'baseline'))
+    x0 = px - dict(left=0, center=0.5, right=1)[ha] * w
+    if va == 'bottom':
+        y0 = py
+    elif va == 'top':
+        y0 = py - h
+    elif va in ['center', 'center_baseline']:
+        y0 = py - h / 2
+    else:  # baseline: room for the descenders
+        y0 = py - 0.2 * size
+    return np.column_stack((x0, y0, x0 + w, y0 + h))
+
+
+class _LabelCollection(Artist):
+    """Text labels of which only the non-overlapping ones are drawn.
+
+    The culling is done at each draw, with the axes layout of that draw
+    (colorbars, tight_layout, savefig dpi, zoom...).
+    """
+
+    zorder = 3
+
+    def __init__(self, labels):
+        """Instanciate.
+
+        Parameters
+        ----------
+        labels: list of (x, y, texts, priority, kwargs), as in Map._labels
+        """
+        super(_LabelCollection, self).__init__()
+        self._labels = labels
+        self.texts = []
+
+    def draw(self, renderer):
+        """Culls the labels and draws the remaining ones."""
+
+        if not self.get_visible():
+            return
+        ax = self.axes
+        boxes = [_label_boxes(ax, x, y, t, kw)
+                 for x, y, t, _, kw in self._labels]
+        priority = [p for _, _, _, p, _ in self._labels]
+        keep = utils.non_overlapping(np.concatenate(boxes),
+                                     priority=np.concatenate(priority))
+        self.texts = []
+        start = 0
+        for x, y, t, _, kwargs in self._labels:
+            n = len(x)
+            for i in keep[(keep >= start) & (keep < start + n)] - start:
+                text = Text(x[i], y[i], t[i], **kwargs)
+                text.set_figure(self.figure)
+                text.axes = ax
+                text.set_transform(ax.transData)
+                self.texts.append(text)
+            start += n
+        for text in self.texts:
+            text.draw(renderer)
+        self.stale = False
+
+
+def _collection_to_arrays(col):
+    """Flat vertex arrays and style of a shapefile collection."""
+
+    paths = col.get_paths()
+    vertices = []
+    codes = []
+    for p in paths:
+        v = np.asarray(p.vertices, dtype=np.float64)
+        vertices.append(v)
+        if p.codes is None:
+            c = np.full(len(v), Path.LINETO, dtype=np.uint8)
+            c[0] = Path.MOVETO
+        else:
+            c = np.asarray(p.codes, dtype=np.uint8)
+        codes.append(c)
+    offsets = np.cumsum([0] + [len(v) for v in vertices]).astype(np.int64)
+    if len(vertices) > 0:
+        vertices = np.concatenate(vertices)
+        codes = np.concatenate(codes)
+    else:
+        vertices = np.zeros((0, 2))
+        codes = np.zeros(0, dtype=np.uint8)
+
+    if isinstance(col, LineCollection):
+        kind = 'line'
+    elif isinstance(col, PatchCollection):
+        kind = 'patch'
+    else:
+        raise NotImplementedError(type(col).__name__)
+    # matplotlib scales the dashes with the linewidth: we need the unscaled
+    # ones (private attribute, which only exists in recent versions)
+    linestyles = getattr(col, '_us_linestyles', None)
+    if linestyles is None:
+        linestyles = col.get_linestyle()
+    style = dict(facecolors=np.asarray(col.get_facecolor()).tolist(),
+                 edgecolors=np.asarray(col.get_edgecolor()).tolist(),
+                 linewidths=np.asarray(col.get_linewidth()).tolist(),
+                 linestyles=linestyles,
+                 alpha=col.get_alpha(), zorder=col.get_zorder(),
+                 label=col.get_label())
+    arrays = dict(vertices=vertices, codes=codes, offsets=offsets)
+    return kind, style, arrays
+
+
+def _collection_from_arrays(kind, style, vertices, codes, offsets):
+    """Rebuild a shapefile collection (the vertices are not copied)."""
+
+    style = style.copy()
+    facecolors = style.pop('facecolors')
+    if kind == 'line':
+        segments = [vertices[s:e] for s, e in zip(offsets[:-1], offsets[1:])]
+        return LineCollection(segments, colors=style.pop('edgecolors'),
+                              **style)
+    patches = [PathPatch(Path(vertices[s:e], codes[s:e]))
+               for s, e in zip(offsets[:-1], offsets[1:])]
+    return PatchCollection(patches, facecolors=facecolors, **style)
+
+
+def _data_window(grid, crs, margin=2):
+    """The (j0, j1, i0, i1) window of a data grid (crs) covering a grid.
+
+    The window is at least 2x2 pixels large, even if the data does not
+    overlap the grid. It starts at even indices: the nearest neighbour
+    interpolation rounds half to even, which gives the same pixels on the
+    window as on the whole data.
+    """
+
+    ex, ey = utils.grid_outline(grid)
+    x, y = crs.center_grid.transform(ex, ey, crs=grid.corner_grid)
+    x, y = np.asarray(x), np.asarray(y)
+    nx, ny = crs.nx, crs.ny
+    if not (np.all(np.isfinite(x)) and np.all(np.isfinite(y))):
+        return 0, ny, 0, nx
+
+    i0 = max(0, int(np.floor(np.min(x))) - margin)
+    i1 = min(nx, int(np.ceil(np.max(x))) + margin + 1)
+    j0 = max(0, int(np.floor(np.min(y))) - margin)
+    j1 = min(ny, int(np.ceil(np.max(y))) + margin + 1)
+    if i0 == 0 and i1 == nx:
+        # the grid may contain a pole of the data grid (e.g. lon, lat),
+        # which is not on the outline
+        j0, j1 = 0, ny
+    i0 = min(i0, max(0, nx - 2))
+    i1 = min(max(i1, i0 + 2), nx)
+    j0 = min(j0, max(0, ny - 2))
+    j1 = min(max(j1, j0 + 2), ny)
+    return j0 - j0 % 2, j1, i0 - i0 % 2, i1
+
+
+def _grid_window(grid, i0, i1, j0, j1):
+    """The salem.Grid of a window of a grid (pixel centers)."""
+
+    cg = grid.corner_grid
+    corner = (cg.x0 + i0 * cg.dx, cg.y0 + j0 * cg.dy)
+    kwargs = dict(nxny=(i1 - i0, j1 - j0), dxdy=(cg.dx, cg.dy),
+                  proj=cg.proj, pixel_ref='corner')
+    if cg.dy < 0:
+        kwargs['ul_corner'] = corner
+    else:
+        kwargs['ll_corner'] = corner
+    return salem.Grid(**kwargs).center_grid
+
+
+def _offsets(lengths):
+    """The start and end offsets of consecutive chunks of given lengths."""
+    ends = np.cumsum(lengths)
+    return ends - lengths, ends
+
+
+def _ranges(starts, ends):
+    """np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])"""
+    lengths = ends - starts
+    offsets, _ = _offsets(lengths)
+    return np.arange(np.sum(lengths)) + np.repeat(starts - offsets, lengths)
+
+
+def _rings_path(rings):
+    """A matplotlib path out of closed rings ((N, 2) arrays)."""
+    codes = []
+    for r in rings:
+        c = np.full(len(r), Path.LINETO, dtype=Path.code_type)
+        c[0] = Path.MOVETO
+        c[-1] = Path.CLOSEPOLY
+        codes.append(c)
+    return Path(np.concatenate(rings), np.concatenate(codes))
+
+
+def _scatter_kwargs(kwargs):
+    """Defaults and aliases of the scatter() keywords (returns a copy)."""
+
+    kwargs = kwargs.copy()
+    kwargs.setdefault('marker', 'o')
+    kwargs.setdefault('s', 60)
+    kwargs.setdefault('facecolor', 'w')
+    kwargs.setdefault('edgecolor', 'k')
+    kwargs.setdefault('linewidths', 1)
+    if 'markersize' in kwargs:
+        # For those tempted to use the whole kw
+        kwargs['s'] = kwargs['markersize']
+        del kwargs['markersize']
+    if 'color' in kwargs:
+        # For those tempted to use the whole kw
+        kwargs['facecolor'] = kwargs['color']
+        kwargs['edgecolor'] = kwargs['color']
+    if 'c' in kwargs:
+        # For those tempted to use the whole kw
+        kwargs['facecolor'] = kwargs['c']
+        kwargs['edgecolor'] = kwargs['c']
+        del kwargs['c']
+    return kwargs
+
+
+def _same_style(kw1, kw2):
+    """Can two groups of points be drawn with the same scatter() call?
+
+    Not if one of the keywords is given per point (e.g. sizes or colors).
+    """
+
+    for kw in [kw1, kw2]:
+        for v in kw.values():
+            if isinstance(v, (np.ndarray, list)):
+                return False
+    return kw1 == kw2
+
+
+def contourf_paths(data, **kwargs):
+    """Computes the filled contours of a 2d array, once for all.
+
+    Parameters
+    ----------
+    data: the 2d array to contour
+    kwargs: anything accepted by contourf
+
+    Returns
+    -------
+    a list of (vertices, codes, kwargs) tuples, one per contour level. The
+    kwargs are those of the corresponding PathPatch.
+    """
+
+    ax = mpl.figure.Figure().add_subplot(1, 1, 1)
+    cs = ax.contourf(data, **kwargs)
+    if isinstance(cs, mpl.collections.Collection):
+        # matplotlib >= 3.8: one compound path per level
+        paths = cs.get_paths()
+        facecolors = cs.get_facecolor()
+        hatches = cs.hatches
+        alpha = cs.get_alpha()
+        levels = [([p], facecolors[i % len(facecolors)],
+                   hatches[i % len(hatches)]) for i, p in enumerate(paths)]
+    else:
+        alpha = cs.alpha
+        levels = []
+        for col in cs.collections:
+            fc = col.get_facecolor()
+            levels.append((col.get_paths(), fc[0] if len(fc) else 'none',
+                           col.get_hatch()))
+
+    out = []
+    for paths, facecolor, hatch in levels:
+        vertices = []
+        codes = []
+        for p in paths:
+            if len(p.vertices) == 0:
+                continue
+            vertices.append(np.asarray(p.vertices, dtype=np.float64))
+            if p.codes is None:
+                c = np.full(len(p.vertices), Path.LINETO, dtype=np.uint8)
+                c[0] = Path.MOVETO
+            else:
+                c = np.asarray(p.codes, dtype=np.uint8)
+            codes.append(c)
+        if len(vertices) == 0:
+            continue
+        pkw = dict(facecolor=facecolor, hatch=hatch, linewidth=0,
+                   alpha=alpha, zorder=kwargs.get('zorder', 1))
+        out.append((np.concatenate(vertices), np.concatenate(codes), pkw))
+    return out
+
+
+def _remove_alpha(rgb):
+    """Make the transparent pixels of an RGBA image white and opaque (in
+    place), as done before the shading. RGB images are left unchanged."""
+
+    if rgb.ndim < 3 or rgb.shape[2] < 4:
+        return rgb
+    pno = np.where(rgb[:, :, 3] == 0.)
+    for i in [0, 1, 2]:
+        rgb[pno[0], pno[1], i] = 1
+    rgb[:, :, 3] = 1
+    return rgb
+
+
+def shade_rgb(rgb, slope, relief_factor=0.7):
+    """Apply the topographical shading to an RGB(A) image (in place).
+
+    Parameters
+    ----------
+    rgb: the image, of shape (ny, nx, 3) or (ny, nx, 4)
+    slope: the shading factor as computed by Map.set_topography
+    relief_factor: how strong should the shading be?
+    """
+    level = 1.0 - 0.1 * relief_factor
+    sens = 1 + 0.7 * relief_factor * slope
+    for i in [0, 1, 2]:
+        rgb[:, :, i] = np.clip(level * rgb[:, :, i] * sens, 0, 1)
+    return rgb
+
+
 def plot_polygon(ax, poly, edgecolor='black', **kwargs):
     """ Plot a single Polygon geometry """
 
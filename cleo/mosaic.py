@@ -0,0 +1,227 @@
+"""Mosaics of many gridded tiles on a map grid.
+
+Map.set_data(..., overplot=True) remaps each tile on the full map grid. The
+Mosaic only considers the map pixels which are covered by a tile, and keeps
+the remap plans in memory for the tiles which are added again later (e.g.
+the same DEM tiles for several maps)::
+
+    mos = Mosaic(m.grid, rule='mean')
+    mos.add_many(zip(tiles_data, tiles_grids))
+    m.set_data(mos.data)
+
+Copyright: Fabien Maussion, 2014-2015
+
+License: GPLv3+
+"""
+from __future__ import division, absolute_import, unicode_literals
+# Builtins
+import threading
+from multiprocessing.pool import ThreadPool
+# External libs
+import numpy as np
+# Locals
+from cleo import utils
+
+
+class Mosaic(object):
+    """Accumulates gridded tiles on a target grid.
+
+    Where tiles overlap, the value of the mosaic is given by the rule:
+      - 'first': the value of the first tile added
+      - 'last': the value of the last tile added
+      - 'mean': the average of all tiles
+    The pixels which are covered by no tile are masked.
+    """
+
+    def __init__(self, grid, rule='last', interp='nearest',
+                 plan_cache_size=256):
+        """Instanciate.
+
+        Parameters
+        ----------
+        grid: the salem.Grid of the mosaic (e.g. a Map's grid)
+        rule: 'first', 'last' (default) or 'mean', what to do with the
+        pixels covered by several tiles
+        interp: 'nearest' (default) or 'linear', the interpolation algorithm
+        plan_cache_size: the maximum number of remap plans to keep in memory
+        """
+
+        if rule not in ['first', 'last', 'mean']:
+            raise ValueError('Rule not understood: {}'.format(rule))
+        if interp not in ['nearest', 'linear']:
+            raise ValueError('Interpolation not understood: '
+                             '{}'.format(interp))
+        self.grid = grid.center_grid
+        self.rule = rule
+        self.interp = interp
+        self._plans = utils.LRUCache(plan_cache_size)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Empty the mosaic. The remap plans are kept."""
+
+        shp = (self.grid.ny, self.grid.nx)
+        self._sum = np.zeros(shp)
+        self._count = np.zeros(shp, dtype=np.int32)
+
+    @property
+    def data(self):
+        """The mosaic (masked where no tile was added)."""
+
+        count = self._count
+        if self.rule == 'mean':
+            out = self._sum / np.where(count > 0, count, 1)
+        else:
+            out = self._sum.copy()
+        return np.ma.masked_array(out, mask=(count == 0))
+
+    @property
+    def count(self):
+        """The number of tiles which contributed to each pixel."""
+        return self._count.copy()
+
+    def _plan(self, grid):
+        """The map window covered by a tile and the (fractional) tile
+        coordinates of the window pixels."""
+
+        key = utils.grid_key(grid)
+        with self._lock:
+            plan = self._plans.get(key)
+        if plan is not None:
+            return plan
+        plan = _remap_plan(self.grid, grid)
+        with self._lock:
+            self._plans[key] = plan
+        return plan
+
+    def _remap(self, data, grid):
+        """The window, values and validity of a tile on the map grid."""
+
+        data = np.squeeze(data)
+        if data.shape != (grid.ny, grid.nx):
+            raise ValueError('Dimensions of data do not match the grid.')
+        return _resample(data, self._plan(grid), interp=self.interp)
+
+    def _accumulate(self, window, values, valid):
+        """Add a remapped tile to the mosaic, following the rule."""
+
+        if window is None:
+            return
+        j0, j1, i0, i1 = window
+        s = self._sum[j0:j1, i0:i1]
+        c = self._count[j0:j1, i0:i1]
+        if self.rule == 'mean':
+            s[valid] += values[valid]
+        elif self.rule == 'first':
+            new = valid & (c == 0)
+            s[new] = values[new]
+        else:
+            s[valid] = values[valid]
+        c += valid
+
+    def add(self, data, grid):
+        """Add a tile to the mosaic.
+
+        Parameters
+        ----------
+        data: the tile data (2d)
+        grid: the salem.Grid of the tile
+        """
+
+        self._accumulate(*self._remap(data, grid))
+
+    def add_many(self, tiles, processes=None):
+        """Add tiles to the mosaic, remapping them in parallel.
+
+        The tiles are remapped by a pool of threads, but they are added to
+        the mosaic in the input order: the result is the same as calling
+        add() for each tile.
+
+        Parameters
+        ----------
+        tiles: iterable of (data, grid) tuples
+        processes: the number of threads (default: the number of CPUs)
+        """
+
+        pool = ThreadPool(processes)
+        try:
+            for r in pool.imap(lambda t: self._remap(*t), tiles):
+                self._accumulate(*r)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def _remap_plan(target, grid):
+    """The window of a target grid covered by a grid, and the (fractional)
+    grid coordinates of the window pixels.
+
+    Returns (None, None, None) if the grids do not overlap.
+    """
+
+    target = target.center_grid
+
+    # Outline of the grid in the target grid
+    ex, ey = utils.grid_outline(grid)
+    ex, ey = target.transform(ex, ey, crs=grid.corner_grid)
+    ok = np.isfinite(ex) & np.isfinite(ey)
+    if not np.any(ok):
+        return None, None, None
+    i0 = max(0, int(np.floor(np.min(ex[ok]))))
+    i1 = min(target.nx, int(np.ceil(np.max(ex[ok]))) + 1)
+    j0 = max(0, int(np.floor(np.min(ey[ok]))))
+    j1 = min(target.ny, int(np.ceil(np.max(ey[ok]))) + 1)
+    if i0 >= i1 or j0 >= j1:
+        return None, None, None
+
+    ii, jj = np.meshgrid(np.arange(i0, i1, dtype=float),
+                         np.arange(j0, j1, dtype=float))
+    sx, sy = grid.center_grid.transform(ii, jj, crs=target)
+    return (j0, j1, i0, i1), np.asarray(sx), np.asarray(sy)
+
+
+def _resample(data, plan, interp='nearest'):
+    """The window, values and validity of gridded data on a target grid.
+
+    Parameters
+    ----------
+    data: the data (2d)
+    plan: the plan of the data grid on the target grid (see _remap_plan)
+    interp: 'nearest' or 'linear'
+    """
+
+    window, sx, sy = plan
+    if window is None:
+        return None, None, None
+
+    invalid = np.ma.getmaskarray(data)
+    data = np.ma.getdata(data).astype(np.float64)
+    invalid = invalid | ~np.isfinite(data)
+    ny, nx = data.shape
+    with np.errstate(invalid='ignore'):
+        if interp == 'linear' and nx > 1 and ny > 1:
+            valid = (sx >= 0) & (sx <= nx - 1) & (sy >= 0) & \
+                    (sy <= ny - 1)
+            x0 = np.clip(np.floor(np.where(valid, sx, 0)), 0,
+                         nx - 2).astype(np.int64)
+            y0 = np.clip(np.floor(np.where(valid, sy, 0)), 0,
+                         ny - 2).astype(np.int64)
+            wx = np.where(valid, sx, 0) - x0
+            wy = np.where(valid, sy, 0) - y0
+            values = 0.
+            for dj, di, w in [(0, 0, (1 - wx) * (1 - wy)),
+                              (0, 1, wx * (1 - wy)),
+                              (1, 0, (1 - wx) * wy),
+                              (1, 1, wx * wy)]:
+                values = values + w * data[y0 + dj, x0 + di]
+                valid &= ~invalid[y0 + dj, x0 + di]
+        else:
+            xi = np.rint(np.where(np.isfinite(sx), sx, -1))
+            yi = np.rint(np.where(np.isfinite(sy), sy, -1))
+            valid = (xi >= 0) & (xi < nx) & (yi >= 0) & (yi < ny)
+            xi = np.where(valid, xi, 0).astype(np.int64)
+            yi = np.where(valid, yi, 0).astype(np.int64)
+            values = data[yi, xi]
+            valid &= ~invalid[yi, xi]
+    return window, values, valid
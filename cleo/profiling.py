@@ -0,0 +1,239 @@
+"""Opt-in instrumentation of the rendering stages.
+
+Usage::
+
+    from cleo import profiling
+    with profiling.Recorder() as rec:
+        m.set_data(data, crs=grid)
+        m.visualize()
+    print(rec.to_json())
+
+When no Recorder is active, the instrumented code only pays for one
+function call and one test per stage.
+
+If tracemalloc is tracing (see Recorder), each record also has the
+memory of the stage:
+  - peak_bytes: the highest memory use during the stage, above the memory
+    in use at its start, i.e. what the stage needed (Python >= 3.9)
+  - retained_bytes: the memory still in use at the end of the stage, above
+    the memory in use at its start (negative if the stage freed memory)
+tracemalloc traces the whole process: stages running in other threads at
+the same time are counted too.
+
+Copyright: Fabien Maussion, 2014-2015
+
+License: GPLv3+
+"""
+from __future__ import division, absolute_import, unicode_literals
+# Builtins
+import json
+import time
+import threading
+from collections import OrderedDict
+from timeit import default_timer
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover (py2)
+    tracemalloc = None
+# Python >= 3.9 only
+_reset_peak = getattr(tracemalloc, 'reset_peak', None)
+# External libs
+# Locals
+
+try:
+    _cpu_time = time.process_time
+except AttributeError:  # pragma: no cover (py2)
+    _cpu_time = time.clock
+
+# The active recorders
+_recorders = []
+# Stack of the running stages (per thread)
+_local = threading.local()
+
+
+class _NullStage(object):
+    """What stage() returns when nobody is listening."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def add(self, **info):
+        pass
+
+_null_stage = _NullStage()
+
+
+class _Stage(object):
+    """Measures a stage and sends the result to the recorders."""
+
+    def __init__(self, name, info):
+        self.name = name
+        self.info = info
+
+    def add(self, **info):
+        """Add information to the record (e.g. array sizes)."""
+        self.info.update(info)
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1].name if stack else None
+        self._mem = None
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if _reset_peak is not None:
+                # the running stages keep their peak before it is reset
+                _update_peaks(stack, peak)
+                _reset_peak()
+            self._mem = self._peak = current
+        stack.append(self)
+        self._cpu = _cpu_time()
+        self._wall = default_timer()
+        return self
+
+    def __exit__(self, *args):
+        wall = default_timer() - self._wall
+        cpu = _cpu_time() - self._cpu
+        _local.stack.pop()
+        record = OrderedDict([('stage', self.name),
+                              ('parent', self.parent),
+                              ('wall_time', wall),
+                              ('cpu_time', cpu)])
+        if self._mem is not None:
+            current, peak = tracemalloc.get_traced_memory()
+            if _reset_peak is not None:
+                self._peak = max(self._peak, peak)
+                _update_peaks(_local.stack, self._peak)
+                record['peak_bytes'] = self._peak - self._mem
+            record['retained_bytes'] = current - self._mem
+        record.update(self.info)
+        for rec in list(_recorders):
+            rec._add(record)
+        return False
+
+
+def _update_peaks(stack, peak):
+    """Report a memory peak to the running stages."""
+    for s in stack:
+        if s._mem is not None:
+            s._peak = max(s._peak, peak)
+
+
+def stage(name, **info):
+    """Context manager measuring a stage of the rendering.
+
+    Parameters
+    ----------
+    name: the name of the stage (e.g. 'Map.to_rgb')
+    info: any additional information to record
+
+    The returned object has an add() method to add information to the
+    record from within the stage.
+    """
+
+    if not _recorders:
+        return _null_stage
+    return _Stage(name, info)
+
+
+def array_info(a):
+    """The shape, dtype and size of an array, for the records."""
+    try:
+        return dict(shape=list(a.shape), dtype=str(a.dtype), nbytes=a.nbytes)
+    except AttributeError:
+        return dict()
+
+
+class Recorder(object):
+    """Records wall time, CPU time and memory of the rendering stages.
+
+    A Recorder is active within its context (or between start() and stop()).
+    Each measured stage produces a record (a dict) which is appended to the
+    records list and sent to the callback, if any.
+    """
+
+    def __init__(self, callback=None, trace_memory=False):
+        """Instanciate.
+
+        Parameters
+        ----------
+        callback: a function called with each new record
+        trace_memory: trace the memory allocations with tracemalloc (this
+        slows down the code significantly). If tracemalloc is already
+        tracing, the memory is recorded anyway.
+        """
+
+        self.callback = callback
+        self.trace_memory = trace_memory
+        self.records = []
+        self._started_tracing = False
+
+    def _add(self, record):
+        self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def start(self):
+        """Start recording."""
+        if self.trace_memory and tracemalloc is not None and \
+                not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        _recorders.append(self)
+
+    def stop(self):
+        """Stop recording."""
+        if self in _recorders:
+            _recorders.remove(self)
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+        return False
+
+    def summary(self):
+        """Number of calls, total times and retained memory, and largest
+        memory peak per stage."""
+
+        out = OrderedDict()
+        for r in self.records:
+            s = out.setdefault(r['stage'], OrderedDict([('calls', 0),
+                                                        ('wall_time', 0.),
+                                                        ('cpu_time', 0.)]))
+            s['calls'] += 1
+            s['wall_time'] += r['wall_time']
+            s['cpu_time'] += r['cpu_time']
+            if 'retained_bytes' in r:
+                s['retained_bytes'] = s.get('retained_bytes', 0) + \
+                                      r['retained_bytes']
+            if 'peak_bytes' in r:
+                s['peak_bytes'] = max(s.get('peak_bytes', 0),
+                                      r['peak_bytes'])
+        return out
+
+    def report(self):
+        """The records and their summary, as a dict."""
+        return OrderedDict([('summary', self.summary()),
+                            ('records', self.records)])
+
+    def to_json(self, path=None, **kwargs):
+        """The report as JSON string, or written to a file if path is set.
+
+        kwargs are passed to json.dumps()
+        """
+        kwargs.setdefault('indent', 2)
+        out = json.dumps(self.report(), **kwargs)
+        if path is None:
+            return out
+        with open(path, 'w') as f:
+            f.write(out)
@@ -0,0 +1,197 @@
+"""Save a configured Map to disk and load it back quickly.
+
+A Map template is a directory containing:
+  - one .npy file per array (data, slope, shape vertices, lon/lat corners,
+    ...), which are memory-mapped at load time
+  - a small pickle file (meta.pkl) with everything else (grid definition,
+    levels, colormap, tick labels, plotting keywords...)
+
+Loading a template does not redo any of the expensive setup (regridding,
+shapefile reading and transformation, tick computations, hillshading), and
+the memory-mapped arrays are shared between the processes which load the
+same template.
+
+Copyright: Fabien Maussion, 2014-2015
+
+License: GPLv3+
+"""
+from __future__ import division, absolute_import, unicode_literals
+# Builtins
+import os
+from six.moves import cPickle as pickle
+# External libs
+import numpy as np
+import pyproj
+import salem
+# Locals
+from cleo.graphics import Map, _collection_to_arrays, _collection_from_arrays
+from cleo.shapes import _write_atomic
+
+# Increase this when the format changes
+FORMAT_VERSION = 1
+
+# Map attributes which are never saved (caches, shared memory handles)
+_SKIP = set(['_render_cache', '_shared_memory'])
+
+
+def grid_to_dict(grid):
+    """The parameters needed to rebuild a salem.Grid."""
+
+    cg = grid.corner_grid
+    return dict(proj=cg.proj.srs, nx=cg.nx, ny=cg.ny, dx=cg.dx, dy=cg.dy,
+                x0=cg.x0, y0=cg.y0, pixel_ref=grid.pixel_ref)
+
+
+def grid_from_dict(d):
+    """Rebuild a salem.Grid out of grid_to_dict()."""
+
+    corner = (d['x0'], d['y0'])
+    kwargs = dict(nxny=(d['nx'], d['ny']), dxdy=(d['dx'], d['dy']),
+                  proj=pyproj.Proj(d['proj']), pixel_ref='corner')
+    if d['dy'] < 0:
+        kwargs['ul_corner'] = corner
+    else:
+        kwargs['ll_corner'] = corner
+    grid = salem.Grid(**kwargs)
+    if d['pixel_ref'] == 'center':
+        grid = grid.center_grid
+    return grid
+
+
+def _map_state(m):
+    """Split the state of a Map in metadata (picklable) and arrays.
+
+    Masked arrays are split in two arrays: the data and the mask (with the
+    suffix '.mask').
+    """
+
+    # The graticule is computed lazily: we want it in the template
+    m._pixcorner_ll
+    # Wait for the contours if they are computed in the background
+    m._contourf_geometry
+
+    meta = dict(version=FORMAT_VERSION, attrs=dict(), arrays=dict(),
+                collections=[])
+    arrays = dict()
+
+    def _add_array(name, a):
+        a = np.asanyarray(a)
+        if np.ma.isMaskedArray(a):
+            arrays[name + '.mask'] = np.ma.getmaskarray(a)
+            a = np.ma.getdata(a)
+        arrays[name] = a
+
+    for k, v in m.__dict__.items():
+        if k in _SKIP:
+            continue
+        if k == 'grid':
+            meta['grid'] = grid_to_dict(v)
+        elif k == '_collections':
+            for i, col in enumerate(v):
+                kind, style, carrays = _collection_to_arrays(col)
+                names = dict()
+                for an, a in carrays.items():
+                    names[an] = 'col{}_{}'.format(i, an)
+                    _add_array(names[an], a)
+                meta['collections'].append((kind, style, names))
+        elif isinstance(v, np.ndarray):
+            _add_array(k, v)
+            meta['arrays'][k] = [k, np.ma.isMaskedArray(v)]
+        elif isinstance(v, tuple) and len(v) > 0 and \
+                all(isinstance(a, np.ndarray) for a in v):
+            names = []
+            for i, a in enumerate(v):
+                names.append(['{}_{}'.format(k, i), np.ma.isMaskedArray(a)])
+                _add_array(names[-1][0], a)
+            meta['arrays'][k] = names
+        else:
+            meta['attrs'][k] = v
+    return meta, arrays
+
+
+def _map_from_state(meta, get_array):
+    """Rebuild a Map out of _map_state().
+
+    get_array is a function returning the array of a given name.
+    """
+
+    if meta['version'] != FORMAT_VERSION:
+        raise ValueError('Template format {} not supported (expected {}).'
+                         .format(meta['version'], FORMAT_VERSION))
+
+    def _get(name, masked):
+        a = get_array(name)
+        if masked:
+            a = np.ma.masked_array(a, mask=get_array(name + '.mask'))
+        return a
+
+    # No call to __init__, that's the point
+    m = Map.__new__(Map)
+    m.__dict__.update(meta['attrs'])
+    m.invalidate()
+    m.grid = grid_from_dict(meta['grid'])
+    for k, v in meta['arrays'].items():
+        if isinstance(v[0], list):
+            setattr(m, k, tuple(_get(n, mk) for n, mk in v))
+        else:
+            setattr(m, k, _get(*v))
+    m._collections = []
+    for kind, style, names in meta['collections']:
+        carrays = dict((an, get_array(n)) for an, n in names.items())
+        m._collections.append(_collection_from_arrays(kind, style,
+                                                      **carrays))
+    return m
+
+
+def save_map(m, path):
+    """Save a Map template to a directory.
+
+    Parameters
+    ----------
+    m: the cleo.Map to save
+    path: the directory where to write the files (created if needed).
+    Existing files will be replaced (it is safe to save a template which
+    is in use).
+    """
+
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+    # The files are replaced, never rewritten: processes which have the
+    # old arrays memory-mapped keep them
+    meta, arrays = _map_state(m)
+    for name, a in arrays.items():
+        _write_atomic(os.path.join(path, name + '.npy'),
+                      lambda f: np.save(f, a))
+    # written last
+    _write_atomic(os.path.join(path, 'meta.pkl'),
+                  lambda f: pickle.dump(meta, f,
+                                        protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def load_map(path, mmap=True):
+    """Load a Map template written by save_map().
+
+    Parameters
+    ----------
+    path: the template directory
+    mmap: memory-map the arrays instead of reading them. The arrays are
+    mapped in copy-on-write mode: modifying them does not alter the files.
+
+    Returns
+    -------
+    a cleo.Map
+    """
+
+    with open(os.path.join(path, 'meta.pkl'), 'rb') as f:
+        meta = pickle.load(f)
+
+    mmap_mode = 'c' if mmap else None
+
+    def get_array(name):
+        return np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+
+    return _map_from_state(meta, get_array)
@@ -0,0 +1,317 @@
+"""A compact binary format for the shapes shipped with cleo.
+
+The geometries of a shapefile are compiled once into a directory of .npy
+files, in the user cache directory ($XDG_CACHE_HOME/cleo, or ~/.cache/cleo).
+An up-to-date compiled directory next to the shapefile (e.g. shipped with
+the package) is used instead, but cleo never writes there:
+  - vertices.npy: the (lon, lat) of all vertices, (N, 2) float64
+  - rings.npy: the offsets of the rings (or lines) in vertices
+  - parts.npy: the offsets of the parts in rings. A part is a line, or a
+    polygon: its exterior ring followed by its holes (multi-geometries are
+    split in several parts)
+  - bbox.npy: the (lon_min, lat_min, lon_max, lat_max) of each part
+  - meta.json: the kind of geometry and the source file signature
+
+The arrays are memory-mapped at load time. The shapefiles are parsed with
+numpy only (geometries only, no attributes): neither geopandas nor fiona
+are needed.
+
+Copyright: Fabien Maussion, 2014-2015
+
+License: GPLv3+
+"""
+from __future__ import division, absolute_import, unicode_literals
+# Builtins
+import os
+import io
+import json
+import struct
+import tempfile
+import hashlib
+# External libs
+import numpy as np
+# Locals
+
+try:
+    _replace = os.replace
+except AttributeError:  # pragma: no cover (py2, fine on posix only)
+    _replace = os.rename
+
+# Increase this when the format changes
+FORMAT_VERSION = 1
+
+# Shapefile geometry types (with their Z and M variants)
+_KINDS = {3: 'line', 13: 'line', 23: 'line',
+          5: 'polygon', 15: 'polygon', 25: 'polygon'}
+
+_ARRAYS = ['vertices', 'rings', 'parts', 'bbox']
+
+
+def read_shp(path):
+    """Reads the geometries of a .shp file.
+
+    Only (Multi)LineStrings and (Multi)Polygons are supported. The z and m
+    values are ignored.
+
+    Parameters
+    ----------
+    path: path to the .shp file
+
+    Returns
+    -------
+    a dict with the kind of geometry ('line' or 'polygon') and the arrays
+    described in the module documentation
+    """
+
+    with open(path, 'rb') as f:
+        buf = f.read()
+    if struct.unpack_from('>i', buf, 0)[0] != 9994:
+        raise ValueError('{} is not a shapefile.'.format(path))
+    shptype = struct.unpack_from('<i', buf, 32)[0]
+    if shptype not in _KINDS:
+        raise NotImplementedError('Shape type {} not supported.'
+                                  .format(shptype))
+
+    vertices = []
+    rings = []
+    first_rings = []
+    nrings = 0
+    nverts = 0
+    pos = 100
+    while pos + 8 <= len(buf):
+        length = struct.unpack_from('>i', buf, pos + 4)[0] * 2
+        rec = pos + 8
+        pos = rec + length
+        if struct.unpack_from('<i', buf, rec)[0] == 0:
+            # null shape
+            continue
+        nparts, npoints = struct.unpack_from('<2i', buf, rec + 36)
+        if nparts == 0 or npoints == 0:
+            continue
+        parts = np.frombuffer(buf, dtype='<i4', count=nparts,
+                              offset=rec + 44)
+        points = np.frombuffer(buf, dtype='<f8', count=npoints * 2,
+                               offset=rec + 44 + 4 * nparts)
+        vertices.append(points.reshape((npoints, 2)))
+        rings.append(parts.astype(np.int64) + nverts)
+        first_rings.append(nrings)
+        nverts += npoints
+        nrings += nparts
+
+    kind = _KINDS[shptype]
+    if nrings == 0:
+        return dict(kind=kind, vertices=np.zeros((0, 2)),
+                    rings=np.zeros(1, dtype=np.int64),
+                    parts=np.zeros(1, dtype=np.int64),
+                    bbox=np.zeros((0, 4)))
+    vertices = np.ascontiguousarray(np.concatenate(vertices),
+                                    dtype=np.float64)
+    rings = np.append(np.concatenate(rings), nverts)
+
+    # A new part starts with each feature, and with each exterior ring
+    # (clockwise, i.e. negative area) of the polygons
+    starts = np.zeros(nrings, dtype=bool)
+    starts[first_rings] = True
+    if kind == 'polygon':
+        x, y = vertices[:, 0], vertices[:, 1]
+        cross = np.append(x[:-1] * y[1:] - x[1:] * y[:-1], 0)
+        # shoelace formula (the rings are closed). The cross product
+        # joining a ring to the next one must not be summed
+        area = np.add.reduceat(cross, rings[:-1]) - cross[rings[1:] - 1]
+        starts |= area < 0
+    else:
+        starts[:] = True
+    parts = np.append(np.flatnonzero(starts), nrings)
+    return dict(kind=kind, vertices=vertices, rings=rings,
+                parts=parts.astype(np.int64),
+                bbox=_parts_bbox(vertices, rings, parts))
+
+
+def _parts_bbox(vertices, rings, parts):
+    """The bounding box of each part."""
+    vstart = rings[parts[:-1]]
+    return np.stack([np.minimum.reduceat(vertices[:, 0], vstart),
+                     np.minimum.reduceat(vertices[:, 1], vstart),
+                     np.maximum.reduceat(vertices[:, 0], vstart),
+                     np.maximum.reduceat(vertices[:, 1], vstart)], axis=1)
+
+
+def from_geometries(geoms):
+    """The arrays of read_shp() out of shapely geometries.
+
+    The coordinates are kept as they are (no assumption is made on their
+    reference system).
+
+    Parameters
+    ----------
+    geoms: iterable of shapely (Multi)LineStrings or (Multi)Polygons
+
+    Returns
+    -------
+    a dict as returned by read_shp(). The kind is None if there is no
+    geometry.
+    """
+
+    kind = None
+    vertices = []
+    lengths = []
+    nrings = [0]
+    for geom in geoms:
+        if geom is None or geom.is_empty:
+            continue
+        for g in (geom if 'Multi' in geom.type else [geom]):
+            if g.type == 'Polygon':
+                gkind = 'polygon'
+                rings = [g.exterior] + list(g.interiors)
+            elif g.type == 'LineString':
+                gkind = 'line'
+                rings = [g]
+            else:
+                raise NotImplementedError(g.type)
+            if kind is None:
+                kind = gkind
+            elif kind != gkind:
+                raise ValueError('Lines and polygons cannot be mixed.')
+            for r in rings:
+                vertices.append(np.asarray(r.coords)[:, :2])
+                lengths.append(len(vertices[-1]))
+            nrings.append(nrings[-1] + len(rings))
+
+    if kind is None:
+        return dict(kind=None, vertices=np.zeros((0, 2)),
+                    rings=np.zeros(1, dtype=np.int64),
+                    parts=np.zeros(1, dtype=np.int64),
+                    bbox=np.zeros((0, 4)))
+    vertices = np.ascontiguousarray(np.concatenate(vertices),
+                                    dtype=np.float64)
+    rings = np.append(0, np.cumsum(lengths)).astype(np.int64)
+    parts = np.asarray(nrings, dtype=np.int64)
+    return dict(kind=kind, vertices=vertices, rings=rings, parts=parts,
+                bbox=_parts_bbox(vertices, rings, parts))
+
+
+def _signature(path):
+    """Identifies a version of the source file."""
+    st = os.stat(path)
+    return [FORMAT_VERSION, st.st_size, int(st.st_mtime)]
+
+
+def _cache_dir():
+    """The user cache directory of cleo."""
+    base = os.environ.get('XDG_CACHE_HOME', None)
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'cleo')
+
+
+def _compiled_dir(path):
+    """Where to store the compiled shapes of a shapefile (in the user
+    cache directory)."""
+
+    base = os.path.splitext(os.path.abspath(path))[0]
+    h = hashlib.md5(base.encode('utf-8')).hexdigest()
+    return os.path.join(_cache_dir(), 'shapes',
+                        os.path.basename(base) + '_' + h + '.cshp')
+
+
+def _read_meta(outdir, path):
+    """The meta of a compiled directory if it is up to date, else None."""
+
+    fmeta = os.path.join(outdir, 'meta.json')
+    if not os.path.exists(fmeta):
+        return None
+    with io.open(fmeta) as f:
+        meta = json.loads(f.read())
+    if meta['source'] != _signature(path):
+        return None
+    return meta
+
+
+def _write_atomic(path, write):
+    """Writes a file through a temporary file, renamed over the old one.
+
+    The old file is never truncated: processes which have it memory-mapped
+    keep reading the old content.
+    """
+
+    dirname, basename = os.path.split(path)
+    fd, tmp = tempfile.mkstemp(prefix=basename + '.', suffix='.tmp',
+                               dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        _replace(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def compile_shapes(path, outdir=None):
+    """Compiles a shapefile to the cleo binary format.
+
+    It is safe to recompile while other processes are using the files.
+
+    Parameters
+    ----------
+    path: path to the .shp file
+    outdir: where to write the files (default: in the user cache
+    directory)
+
+    Returns
+    -------
+    the path to the compiled directory
+    """
+
+    if outdir is None:
+        outdir = _compiled_dir(path)
+    try:
+        os.makedirs(outdir)
+    except OSError:
+        # another process might have been faster
+        if not os.path.isdir(outdir):
+            raise
+
+    shapes = read_shp(path)
+    for k in _ARRAYS:
+        _write_atomic(os.path.join(outdir, k + '.npy'),
+                      lambda f: np.save(f, shapes[k]))
+    # written last: the directory is valid only if meta.json is there
+    meta = dict(kind=shapes['kind'], source=_signature(path))
+    _write_atomic(os.path.join(outdir, 'meta.json'),
+                  lambda f: f.write(json.dumps(meta).encode('utf-8')))
+    return outdir
+
+
+def load_shapes(path, mmap=True):
+    """Loads the geometries of a shapefile, compiling it if needed.
+
+    The compiled files are re-used as long as the shapefile is unchanged.
+    Compiled files next to the shapefile are used if they are up to date,
+    otherwise those of the user cache directory (compiled if needed).
+
+    Parameters
+    ----------
+    path: path to the .shp file
+    mmap: memory-map the arrays instead of reading them
+
+    Returns
+    -------
+    a dict as returned by read_shp()
+    """
+
+    # read only
+    outdir = os.path.splitext(os.path.abspath(path))[0] + '.cshp'
+    meta = _read_meta(outdir, path)
+    if meta is None:
+        outdir = _compiled_dir(path)
+        meta = _read_meta(outdir, path)
+    if meta is None:
+        compile_shapes(path, outdir=outdir)
+        meta = _read_meta(outdir, path)
+
+    out = dict(kind=meta['kind'])
+    mmap_mode = 'r' if mmap else None
+    for k in _ARRAYS:
+        out[k] = np.load(os.path.join(outdir, k + '.npy'),
+                         mmap_mode=mmap_mode)
+    return out
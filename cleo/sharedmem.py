@@ -0,0 +1,174 @@
+"""Share the large static arrays of a Map between processes.
+
+The owner process configures a Map once and puts it in shared memory::
+
+    shared = SharedMap(m)
+    # give shared.spec to the workers (it is picklable)
+
+and each worker gets its own Map, whose slope, shape vertices and lon/lat
+corner coordinates are read-only views on the shared memory block::
+
+    m = attach_map(spec)
+
+The block is freed when the owner calls shared.unlink(), when the SharedMap
+is garbage collected, or at exit.
+Requires python 3.8 or later.
+
+Copyright: Fabien Maussion, 2014-2015
+
+License: GPLv3+
+"""
+from __future__ import division, absolute_import, unicode_literals
+# Builtins
+import weakref
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # pragma: no cover (py < 3.8)
+    shared_memory = None
+# External libs
+import numpy as np
+# Locals
+from cleo import serialize
+
+# Alignment of the arrays in the shared block (bytes)
+_ALIGN = 64
+
+
+def _is_static(name):
+    """Is this array of the map state worth sharing?"""
+    return name == 'slope' or name.startswith('_ll_corners_') or \
+        name.startswith('col')
+
+
+def _unlink(shm):
+    """Free a shared memory block (must not hold a ref to its owner)."""
+    shm.close()
+    shm.unlink()
+
+
+def _check_available():
+    if shared_memory is None:
+        raise NotImplementedError('Shared memory requires python 3.8 or '
+                                  'later.')
+
+
+class SharedMap(object):
+    """Owner of a shared memory block holding the static arrays of a Map.
+
+    The arrays (slope, shape vertices, lon/lat pixel corners) are copied
+    into a single named shared memory block. The map itself is left
+    untouched. All the rest of the map state is in the spec attribute,
+    which is what the workers need to call attach_map().
+    """
+
+    def __init__(self, m, name=None):
+        """Instanciate.
+
+        Parameters
+        ----------
+        m: the cleo.Map to share
+        name: the name of the shared memory block (default: random)
+        """
+
+        _check_available()
+        meta, arrays = serialize._map_state(m)
+
+        layout = dict()
+        local = dict()
+        size = 0
+        for k, a in arrays.items():
+            if not _is_static(k):
+                local[k] = a
+                continue
+            layout[k] = (size, a.shape, a.dtype.str)
+            size += -(-a.nbytes // _ALIGN) * _ALIGN
+
+        self.shm = shared_memory.SharedMemory(name=name, create=True,
+                                              size=max(size, 1))
+        for k, (offset, shape, dtype) in layout.items():
+            out = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf,
+                             offset=offset)
+            out[...] = arrays[k]
+            del out
+
+        self.spec = dict(meta=meta, local=local, block=self.shm.name,
+                         layout=layout)
+        # called once: by unlink(), at garbage collection or at exit
+        self._finalizer = weakref.finalize(self, _unlink, self.shm)
+
+    @property
+    def name(self):
+        """The name of the shared memory block."""
+        return self.spec['block']
+
+    @property
+    def nbytes(self):
+        """The size of the shared memory block."""
+        return self.shm.size
+
+    def unlink(self):
+        """Free the shared memory block.
+
+        Workers which are attached keep their views valid until they exit,
+        but no new worker can attach.
+        """
+
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.unlink()
+        return False
+
+
+def _attach(name):
+    """Attach to a block without letting python free it at our exit."""
+
+    try:
+        # python >= 3.13
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except (ImportError, AttributeError):  # pragma: no cover
+            pass
+        return shm
+
+
+def attach_map(spec):
+    """Make a Map out of the spec of a SharedMap.
+
+    The static arrays of the returned map are read-only views on the
+    shared memory block: they cannot be modified in place, but methods
+    which replace them (e.g. set_topography) are fine.
+
+    Parameters
+    ----------
+    spec: the spec attribute of a SharedMap
+
+    Returns
+    -------
+    a cleo.Map
+    """
+
+    _check_available()
+    shm = _attach(spec['block'])
+    layout = spec['layout']
+    local = spec['local']
+
+    def get_array(name):
+        if name in local:
+            return local[name]
+        offset, shape, dtype = layout[name]
+        out = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+        out.flags.writeable = False
+        return out
+
+    m = serialize._map_from_state(spec['meta'], get_array)
+    # keep the block alive as long as the map
+    m._shared_memory = shm
+    return m
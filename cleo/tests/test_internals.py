@@ -2,18 +2,35 @@ from __future__ import division
 
 import unittest
 import warnings
+import os
 from numpy.testing.utils import assert_array_equal, assert_allclose
 
+import io
 import time
 import copy
+import shutil
+import tempfile
+import json
+import pickle
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import matplotlib as mpl
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 from cleo import DataLevels
 from cleo import Map
+from cleo.utils import LRUCache, non_overlapping
+from cleo.tiles import tile_grid, TileRenderer, make_wsgi_app
+from cleo.animation import MapAnimation
+from cleo.mosaic import Mosaic
+from cleo.shapes import read_shp, load_shapes, compile_shapes
+from cleo import profiling
+from cleo.serialize import save_map, load_map
+from cleo.sharedmem import SharedMap, attach_map
 import cleo
 
+import salem
 from salem import Grid
 from salem import wgs84
 from salem.utils import empty_cache
@@ -21,6 +38,22 @@ from salem.grids import local_mercator_grid
 
 do_test_caching = False
 
+
+class LazyArray(object):
+    """Array read only when sliced, counting the values read."""
+
+    def __init__(self, a):
+        self.a = a
+        self.shape = a.shape
+        self.ndim = a.ndim
+        self.nread = 0
+
+    def __getitem__(self, item):
+        out = self.a[item]
+        self.nread += out.size
+        return out
+
+
 class TestColors(unittest.TestCase):
 
     def test_extendednorm(self):
@@ -105,6 +138,72 @@ class TestColors(unittest.TestCase):
         ref = np.where(ref == cm.N-1, cm.N, ref)
         np.testing.assert_array_equal(ref, mynorm(x))
 
+    def test_lookup(self):
+
+        cm = mpl.colors.LinearSegmentedColormap.from_list('br',
+                                                          ['blue', 'red'])
+        cm.set_under('pink')
+        cm.set_over('black')
+        cm.set_bad('white')
+        mynorm = cleo.colors.ExtendedNorm([1, 2, 3, 4], cm.N, extend='both')
+        x = np.ma.masked_invalid(np.append(np.random.randn(100) * 2 + 2,
+                                           np.NaN)).reshape((101, 1))
+        idx = mynorm(x)
+        self.assertTrue(np.ma.is_masked(idx))
+        assert_array_equal(cleo.colors.lookup(cm, idx), cm(idx))
+        out = cleo.colors.lookup(cm, idx, dtype=np.float32)
+        self.assertEqual(out.dtype, np.float32)
+        assert_array_equal(out, cm(idx).astype(np.float32))
+        # other than indices: delegated to the colormap
+        assert_array_equal(cleo.colors.lookup(cm, [0.1, 0.5]),
+                           cm([0.1, 0.5]))
+
+    def test_extendednorm_nomask(self):
+
+        cm = mpl.cm.get_cmap('jet')
+        x = np.random.randn(100) * 10 - 5
+        for extend in ['neither', 'both', 'min', 'max']:
+            mynorm = cleo.colors.ExtendedNorm([1, 2, 3, 4], cm.N,
+                                              extend=extend)
+            # Valid data goes through the fast path: no mask
+            out = mynorm(x)
+            self.assertFalse(isinstance(out, np.ma.MaskedArray))
+            # Same results than with the masked path
+            xm = np.ma.masked_invalid(np.append(x, np.NaN))
+            outm = mynorm(xm)
+            self.assertTrue(isinstance(outm, np.ma.MaskedArray))
+            assert_array_equal(out, outm[:-1])
+            self.assertTrue(outm.mask[-1])
+
+    def test_get_norm(self):
+
+        cm = mpl.cm.get_cmap('jet')
+        norm = cleo.colors.get_norm([1, 2, 3], cm.N, extend='both')
+        self.assertTrue(cleo.colors.get_norm(np.array([1., 2., 3.]), cm.N,
+                                             extend='both') is norm)
+        self.assertFalse(cleo.colors.get_norm([1, 2, 3], cm.N) is norm)
+        self.assertFalse(cleo.colors.get_norm([1, 2, 4], cm.N,
+                                              extend='both') is norm)
+        ref = cleo.colors.ExtendedNorm([1, 2, 3], cm.N, extend='both')
+        x = np.random.randn(100) * 2 + 2
+        assert_array_equal(norm(x), ref(x))
+
+        # Shared by the DataLevels with the same levels
+        dl1 = DataLevels(np.arange(10), levels=[0, 3, 6], cmap=cm)
+        dl2 = DataLevels(np.arange(10) + 0.5, levels=[0, 3, 6], cmap=cm)
+        self.assertEqual(dl1.extend, dl2.extend)
+        self.assertTrue(dl1.norm is dl2.norm)
+        self.assertFalse(dl1.norm is DataLevels(np.arange(10), cmap=cm,
+                                                levels=[0, 3, 5]).norm)
+
+        # But not by the colorbars, which may modify their norm
+        fig = mpl.figure.Figure()
+        cb = dl1.colorbarbase(fig.add_subplot(1, 1, 1))
+        self.assertFalse(cb.norm is dl1.norm)
+        cb.norm.vmin = -10
+        self.assertEqual(dl2.norm.vmin, 0)
+
+
 class TestGraphics(unittest.TestCase):
 
     def test_datalevels_output(self):
@@ -201,6 +300,66 @@ class TestGraphics(unittest.TestCase):
         self.assertTrue(len(x) == len(r))
         assert_array_equal(r, cm([0, 1]))
 
+    def test_datalevels_nomask(self):
+
+        cm = mpl.colors.ListedColormap(['white', 'blue', 'red', 'black'])
+        x = [-1, 0.9, 1.2, 2, 999, 0.8]
+
+        # No invalid data: no mask
+        c = DataLevels(levels=[0, 1, 2], data=x, cmap=cm)
+        self.assertFalse(isinstance(c.data, np.ma.MaskedArray))
+        assert_array_equal(c.to_rgb(), cm([0, 1, 2, 3, 3, 1]))
+        c.set_data(np.ma.masked_array(x))
+        self.assertFalse(isinstance(c.data, np.ma.MaskedArray))
+        assert_array_equal(c.to_rgb(), cm([0, 1, 2, 3, 3, 1]))
+
+        # Invalid data: mask
+        cm.set_bad('pink')
+        c.set_data(x + [np.NaN])
+        self.assertTrue(isinstance(c.data, np.ma.MaskedArray))
+        assert_array_equal(c.to_rgb()[:-1], cm([0, 1, 2, 3, 3, 1]))
+        assert_array_equal(c.to_rgb()[-1], mpl.colors.to_rgba('pink'))
+
+    def test_map_data_copy(self):
+
+        g = Grid(nxny=(5, 4), dxdy=(1, 1), ll_corner=(0, 0), proj=wgs84,
+                 pixel_ref='corner')
+        c = Map(g, nx=5, countries=False)
+        a = np.arange(20.).reshape((4, 5))
+        c.set_data(a)
+        self.assertFalse(isinstance(c.data, np.ma.MaskedArray))
+        self.assertFalse(np.may_share_memory(c.data, a))
+
+        # The caller's array is not modified by the overplots
+        ref = a.copy()
+        c.set_data(np.zeros((4, 5)), crs=g, overplot=True)
+        assert_array_equal(a, ref)
+        assert_array_equal(c.data, 0)
+
+    def test_add_values(self):
+
+        # Small grid: one text per (valid) pixel, in a single artist
+        a = np.ma.masked_array(np.arange(9.).reshape((3, 3)))
+        a[0, 0] = np.ma.masked
+        fig = mpl.figure.Figure(figsize=(6, 4))
+        ax = fig.add_subplot(1, 1, 1)
+        DataLevels(data=a).visualize(ax=ax, add_values=True)
+        self.assertEqual(len(ax.texts), 0)
+        col = [c for c in ax.collections if
+               isinstance(c, mpl.collections.PathCollection)]
+        self.assertEqual(len(col), 1)
+        self.assertEqual(len(col[0].get_paths()), 8)
+        assert_array_equal(col[0].get_offsets()[0], [1, 0])
+
+        # Large grid: decimated to what fits in the figure
+        fig = mpl.figure.Figure(figsize=(6, 4))
+        ax = fig.add_subplot(1, 1, 1)
+        DataLevels(data=np.random.rand(200, 300)).visualize(ax=ax,
+                                                              add_values=True)
+        col = [c for c in ax.collections if
+               isinstance(c, mpl.collections.PathCollection)]
+        self.assertTrue(0 < len(col[0].get_paths()) < 200)
+
     def test_map(self):
 
         a = np.zeros((4, 5))
@@ -283,6 +442,475 @@ class TestGraphics(unittest.TestCase):
         # but I think it is out of my scope
         # assert_array_equal(rgb1, rgb2)
 
+    def test_map_float32(self):
+
+        g = Grid(nxny=(5, 4), dxdy=(1, 1), ll_corner=(0.5, 0.5), proj=wgs84,
+                 pixel_ref='center')
+        a = np.arange(20.).reshape((4, 5)) / 5
+        topo = np.random.RandomState(0).rand(4, 5) * 1000
+        cmap = mpl.cm.get_cmap('jet')
+
+        rgbs = []
+        for dtype in [None, np.float32]:
+            c = Map(g, ny=400, countries=False, dtype=dtype)
+            c.set_cmap(cmap)
+            # (no data value close to a level: they would be binned
+            # differently in float32)
+            c.set_plot_params(levels=[0, 1.03125, 2.03125, 3.03125])
+            c.set_data(a, crs=g, interp='linear')
+            c.set_topography(topo, crs=g, interp='linear')
+            rgbs.append(c.to_rgb())
+            if dtype is not None:
+                self.assertEqual(c.data.dtype, np.float32)
+                self.assertEqual(c.slope.dtype, np.float32)
+                self.assertEqual(rgbs[-1].dtype, np.float32)
+
+        self.assertEqual(rgbs[0].dtype, np.float64)
+        # Differences are below what can be seen on a 8-bit image
+        assert_allclose(rgbs[0], rgbs[1], atol=1. / 255)
+
+    def test_lonlat_edges(self):
+
+        for order in ['ll', 'ul']:
+            grid = local_mercator_grid(center_ll=(11.38, 47.26),
+                                       extent=(2000000, 2000000),
+                                       order=order)
+            m = Map(grid, countries=False)
+            # The full coordinates are not needed for the setup
+            self.assertTrue(m._ll_corners is None)
+            edges = m._pixcorner_ll_edges
+            xx, yy = grid.center_grid.regrid(nx=500).pixcorner_ll_coordinates
+            assert_allclose(edges['row0'][0], xx[0, :])
+            assert_allclose(edges['row1'][1], yy[-1, :])
+            assert_allclose(edges['col0'][1], yy[:, 0])
+            assert_allclose(edges['col1'][0], xx[:, -1])
+            assert_allclose(m._ll_minmax(), [xx.min(), xx.max(),
+                                             yy.min(), yy.max()])
+            ticks = m.xtick_val, m.ytick_val
+            assert_allclose(m._pixcorner_ll[0], xx)
+
+            # Same results from the full arrays
+            m._ll_edges = None
+            m.set_lonlat_contours()
+            self.assertEqual((m.xtick_val, m.ytick_val), ticks)
+
+        m = Map(grid, countries=False, dtype=np.float32)
+        self.assertEqual(m._pixcorner_ll[0].dtype, np.float32)
+        self.assertEqual(m._pixcorner_ll_edges['row0'][0].dtype, np.float32)
+
+    def test_points(self):
+
+        g = Grid(nxny=(5, 4), dxdy=(10, 10), ll_corner=(-20, -15),
+                 proj=wgs84, pixel_ref='corner')
+        c = Map(g, ny=4, countries=False)
+        x, y = np.meshgrid(np.linspace(-19, 29, 100),
+                           np.linspace(-14, 24, 100))
+        c.set_points(x.flatten(), y.flatten(), s=4, color='red')
+        c.set_points([0, 1], [0, 1], s=4, color='red')
+        c.set_points([0, 1], [0, 1], s=10, marker='s', text='Hi')
+        c.set_points([0, 1], [0, 1], s=[10, 20])
+        self.assertEqual(len(c._points), 3)
+        self.assertEqual(len(c._points[0][0]), 100 * 100 + 2)
+        self.assertEqual(len(c._text), 1)
+        assert_allclose(c._points[1][0], [1.5, 1.6])
+        assert_allclose(c._points[1][1], [1, 1.1])
+
+        fig = mpl.figure.Figure()
+        ax = fig.add_subplot(1, 1, 1)
+        c.plot(ax)
+        scatters = [col for col in ax.collections if
+                    isinstance(col, mpl.collections.PathCollection)]
+        self.assertEqual(len(scatters), 3)
+        self.assertEqual(len(ax.texts), 1)
+
+        c.set_points()
+        self.assertEqual(len(c._points), 0)
+        c.set_points([0, 1], [0, 1])
+        c.set_geometry()
+        self.assertEqual(len(c._points), 0)
+
+    def test_geometries(self):
+
+        import shapely.geometry as shpg
+
+        g = Grid(nxny=(5, 4), dxdy=(10, 10), ll_corner=(-20, -15),
+                 proj=wgs84, pixel_ref='corner')
+        c = Map(g, ny=4, countries=False)
+        s = np.array([(-5, -10), (0., -5), (-5, 0.), (-10, -5)])
+        for i in range(50):
+            p = shpg.Polygon(s + i * 0.1, [s / 4 + i * 0.1])
+            c.set_geometry(p, facecolor='red', edgecolor='k', linewidth=3)
+            c.set_geometry(shpg.LineString(s + i * 0.1), color='pink')
+            c.set_geometry(shpg.LineString(s + i * 0.1), marker='o')
+        c.set_geometry(shpg.MultiPoint([(1, 1), (2, 2)]), color='red')
+        c.set_geometry(shpg.Point(3, 3), color='red')
+        self.assertEqual(len(c._geometries), 3)
+        self.assertEqual([len(items) for _, _, items in c._geometries],
+                         [50, 50, 50])
+        self.assertEqual(len(c._points), 1)
+        self.assertEqual(len(c._points[0][0]), 3)
+
+        fig = mpl.figure.Figure()
+        ax = fig.add_subplot(1, 1, 1)
+        c.plot(ax)
+        patches = [col for col in ax.collections if
+                   isinstance(col, mpl.collections.PatchCollection)]
+        self.assertEqual(len(patches), 1)
+        self.assertEqual(len(patches[0].get_paths()), 50)
+        lines = [col for col in ax.collections if
+                 isinstance(col, mpl.collections.LineCollection)]
+        # polygon outlines and lines (not the contours: not in the map)
+        self.assertEqual(sorted(len(l.get_paths()) for l in lines
+                                if len(l.get_paths()) >= 50), [50, 100])
+        # lines with markers are drawn at once, separated by NaNs
+        self.assertEqual(len(ax.lines), 1)
+        xy = ax.lines[0].get_xydata()
+        self.assertEqual(np.sum(np.isnan(xy[:, 0])), 49)
+        assert_allclose(xy[~np.isnan(xy[:, 0])],
+                        np.concatenate(c._geometries[2][2]))
+
+        c.set_geometry()
+        self.assertEqual(len(c._geometries), 0)
+
+    def test_clip_geometries(self):
+
+        import shapely.geometry as shpg
+
+        g = Grid(nxny=(5, 4), dxdy=(10, 10), ll_corner=(-20, -15),
+                 proj=wgs84, pixel_ref='corner')
+        c = Map(g, ny=4, countries=False)
+        xmin, ymin, xmax, ymax = c._clip_extent()
+
+        # Out of sight
+        c.set_geometry(shpg.box(100, 0, 110, 10), facecolor='red')
+        c.set_geometry(shpg.LineString([(100, 0), (110, 10)]))
+        c.set_points([100, 110], [0, 10])
+        self.assertEqual(len(c._geometries), 0)
+        self.assertEqual(len(c._points), 0)
+
+        # Entirely visible: untouched
+        p = shpg.box(0, 0, 1, 1)
+        self.assertTrue(c._clip_geometry(p)[0] is p)
+        c.set_geometry(shpg.box(-10, -10, 0, 0), facecolor='red')
+
+        # Partly visible: trimmed
+        c.set_geometry(shpg.box(-10, -10, 100, 0), facecolor='red')
+        c.set_geometry(shpg.MultiPolygon([shpg.box(-10, -10, 0, 0),
+                                          shpg.box(100, 0, 110, 10)]),
+                       facecolor='red')
+        c.set_geometry(shpg.LineString([(-10, -10), (100, 0)]), color='k')
+        c.set_points([0, 100], [0, 10], color='k')
+        _, _, items = c._geometries[0]
+        self.assertEqual(len(items), 3)
+        self.assertTrue(np.max(items[1][1][0][:, 0]) <= xmax + 1e-9)
+        _, _, items = c._geometries[1]
+        self.assertTrue(np.max(items[0][:, 0]) <= xmax + 1e-9)
+        self.assertEqual(len(c._points[0][0]), 1)
+
+    def test_downsample(self):
+
+        g = Grid(nxny=(5, 4), dxdy=(1, 1), ll_corner=(0, 0), proj=wgs84,
+                 pixel_ref='corner')
+        a = np.random.RandomState(0).rand(800, 1000)
+        for origin in ['ll', 'ul']:
+            if origin == 'ul':
+                g = Grid(nxny=(5, 4), dxdy=(1, -1), ul_corner=(0, 4),
+                         proj=wgs84, pixel_ref='corner')
+            c = Map(g, nx=1000, countries=False)
+            c.set_data(a)
+            fig = mpl.figure.Figure(figsize=(2, 2), dpi=50)
+            ax = fig.add_subplot(1, 1, 1)
+            c.plot(ax)
+            img = ax.images[0]
+            FigureCanvasAgg(fig).draw()
+            bbox = img.get_window_extent()
+            self.assertTrue(img.get_array().shape[0] >= bbox.height)
+            self.assertTrue(img.get_array().shape[1] < 1000 / 2)
+            # Same place as the full image
+            ylim = (-0.5, 799.5) if c.origin == 'lower' else (799.5, -0.5)
+            assert_allclose(img.get_extent(), (-0.5, 999.5) + ylim)
+
+        # Block average
+        rgb = c.to_rgb()
+        out = cleo.graphics.downsample_to_axes(ax, rgb)
+        fx, fy = int(1000 // bbox.width), int(800 // bbox.height)
+        assert_allclose(out[1, 2], rgb[fy:2*fy, 2*fx:3*fx].mean(axis=(0, 1)),
+                        rtol=1e-6)
+
+        # With the size of the image in the draw, not in plot()
+        nx = img.get_array().shape[1]
+        fig.savefig(io.BytesIO(), dpi=150)
+        self.assertTrue(img.get_array().shape[1] > 2 * nx)
+        ax.set_xlim(0, 250)
+        ax.set_ylim(0, 200)
+        fig.canvas.draw()
+        self.assertTrue(img.get_array().shape[1] > 2 * nx)
+
+        # Transparent pixels do not bleed
+        rgba = np.zeros((4, 4, 4))
+        rgba[:, :2] = [0, 0, 1, 1]
+        rgba[:, 2:] = [1, 1, 1, 0]
+        rgba[:, 1] = [1, 1, 1, 0]
+        out = cleo.graphics.downsample(rgba, 2, 2)
+        assert_allclose(out[:, 0], [[0, 0, 1, 0.5]] * 2)
+        assert_allclose(out[:, 1], [[0, 0, 0, 0]] * 2)
+        assert_allclose(cleo.graphics.downsample(rgba[..., :3], 2, 1)[0, 0],
+                        [0.5, 0.5, 1])
+
+        # Opt-out
+        c.set_downsample(False)
+        fig = mpl.figure.Figure(figsize=(2, 2), dpi=50)
+        ax = fig.add_subplot(1, 1, 1)
+        c.plot(ax)
+        FigureCanvasAgg(fig).draw()
+        self.assertEqual(ax.images[-1].get_array().shape[:2], (800, 1000))
+
+    def test_aggregation(self):
+
+        g = Grid(nxny=(5, 4), dxdy=(1, 1), ll_corner=(0, 0), proj=wgs84,
+                 pixel_ref='corner')
+        src = Grid(nxny=(50, 40), dxdy=(0.1, 0.1), ll_corner=(0, 0),
+                   proj=wgs84, pixel_ref='corner')
+        c = Map(g, nx=5, countries=False)
+        a = np.random.RandomState(0).rand(40, 50)
+        blocks = a.reshape((4, 10, 5, 10))
+
+        for crs in [src, None]:
+            c.set_data(a, crs=crs, interp='mean')
+            assert_allclose(c.data, blocks.mean(axis=(1, 3)))
+            c.set_data(a, crs=crs, interp='max')
+            assert_allclose(c.data, blocks.max(axis=(1, 3)))
+
+        # Categories
+        cat = np.zeros((40, 50), dtype=int)
+        cat[:, :24] = 2
+        cat[:7, :] = 3
+        c.set_data(cat, crs=src, interp='mode')
+        ref = np.zeros((4, 5))
+        ref[:, :2] = 2
+        ref[0, :] = 3
+        assert_array_equal(c.data, ref)
+        # the smallest value on ties
+        cat[10:15, :] = 1
+        c.set_data(cat, crs=src, interp='mode')
+        ref[1, :] = [1, 1, 1, 0, 0]
+        assert_array_equal(c.data, ref)
+
+        # Invalid data is ignored, empty pixels are masked
+        ref = blocks.mean(axis=(1, 3))
+        a = a.copy()
+        a[:10, :10] = np.NaN
+        a[:10, 10:20] = 1
+        a[:10, 10] = np.NaN
+        c.set_data(a, crs=src, interp='mean')
+        self.assertTrue(c.data.mask[0, 0])
+        assert_allclose(c.data[0, 1], 1)
+        assert_allclose(c.data[1:], ref[1:])
+
+        # The plans are computed once
+        n = len(cleo.graphics._aggregation_plans)
+        c.set_data(a, crs=src, interp='max')
+        self.assertTrue(c.data.mask[0, 0])
+        self.assertEqual(len(cleo.graphics._aggregation_plans), n)
+
+    def test_lazy_data(self):
+
+        # (no pixel center on the data pixel edges)
+        g = Grid(nxny=(50, 40), dxdy=(0.1, 0.1), ll_corner=(2.01, 2.01),
+                 proj=wgs84, pixel_ref='corner')
+        src = Grid(nxny=(400, 300), dxdy=(0.025, 0.025), ll_corner=(0, 0),
+                   proj=wgs84, pixel_ref='corner')
+        c = Map(g, nx=50, countries=False)
+        a = np.random.RandomState(0).rand(1, 300, 400)
+
+        for interp in ['nearest', 'linear', 'mean']:
+            c.set_data(a, crs=src, interp=interp)
+            ref = c.data.copy()
+            for chunk in [cleo.graphics._LAZY_CHUNK, 1000]:
+                cleo.graphics._LAZY_CHUNK = chunk
+                lazy = LazyArray(a)
+                try:
+                    c.set_data(lazy, crs=src, interp=interp)
+                finally:
+                    cleo.graphics._LAZY_CHUNK = 2**22
+                # Only the data covering the map is read
+                self.assertTrue(lazy.nread < a.size / 2)
+                assert_array_equal(np.ma.getmaskarray(c.data),
+                                   np.ma.getmaskarray(ref))
+                assert_allclose(c.data, ref)
+
+        # Same grid: everything is read
+        a = np.random.RandomState(0).rand(40, 50)
+        lazy = LazyArray(a)
+        c.set_data(lazy)
+        self.assertEqual(lazy.nread, a.size)
+        assert_allclose(c.data, a)
+        self.assertRaises(ValueError, c.set_data, LazyArray(np.ones((2, 2,
+                                                                     2))))
+
+    def test_render_cache(self):
+
+        g = Grid(nxny=(5, 4), dxdy=(1, 1), ll_corner=(0, 0), proj=wgs84,
+                 pixel_ref='corner')
+        c = Map(g, ny=4, countries=False)
+        a = np.arange(20.).reshape((4, 5))
+        c.set_data(a)
+
+        rgb = c.to_rgb(copy=False)
+        self.assertTrue(c.to_rgb(copy=False) is rgb)
+        self.assertFalse(rgb.flags.writeable)
+        # The callers get their own image by default
+        out = c.to_rgb()
+        self.assertTrue(out.flags.writeable)
+        out[:] = 0
+        assert_array_equal(c.to_rgb(), rgb)
+        png = c.to_png()
+        self.assertTrue(png.startswith(b'\x89PNG'))
+        self.assertTrue(c.to_png() is png)
+
+        # Any change of the inputs invalidates the cache
+        for func, arg in [(c.set_data, a * 2),
+                          (c.set_levels, [0, 10, 20, 40]),
+                          (c.set_cmap, mpl.cm.get_cmap('jet')),
+                          (c.set_topography, a)]:
+            func(arg)
+            rgb2 = c.to_rgb(copy=False)
+            self.assertFalse(rgb2 is rgb)
+            self.assertTrue(c.to_rgb(copy=False) is rgb2)
+            rgb = rgb2
+        self.assertFalse(c.to_png() is png)
+        # The levels getter does not count as a change
+        c.levels
+        self.assertTrue(c.to_rgb(copy=False) is rgb)
+
+        # In-place changes of the colormap are noticed
+        cm = mpl.colors.LinearSegmentedColormap.from_list('test', ['r', 'b'])
+        c.set_cmap(cm)
+        c.set_data(np.ma.masked_less(a, 5))
+        rgb = c.to_rgb(copy=False)
+        cm.set_bad('green')
+        self.assertFalse(c.to_rgb(copy=False) is rgb)
+        self.assertFalse(np.array_equal(c.to_rgb(), rgb))
+        rgb = c.to_rgb(copy=False)
+
+        # Explicit invalidation
+        c.invalidate()
+        self.assertFalse(c.to_rgb(copy=False) is rgb)
+        assert_array_equal(c.to_rgb(copy=False), rgb)
+
+        # Memory cap
+        c.set_render_cache(max_bytes=0)
+        self.assertFalse(c.to_rgb(copy=False) is c.to_rgb(copy=False))
+        self.assertTrue(c.to_rgb(copy=False).flags.writeable)
+
+    def test_snapshot(self):
+
+        grid = local_mercator_grid(center_ll=(-20, 40), extent=(2000000,
+                                                                 1500000))
+        m = Map(grid, nx=100, countries=False)
+        m.set_shapefile(oceans=True)
+        m.set_points([-20, -22], [40, 41], text=['a', 'b'])
+        m.set_labels([-19, -21], [39, 42], ['c', 'd'])
+        m.set_lonlat_contours(interval=5)
+        data = np.random.RandomState(0).rand(m.grid.ny, m.grid.nx)
+        m.set_data(data)
+        m.set_plot_params(nlevels=8)
+
+        snap = m.snapshot()
+        assert_array_equal(snap.to_rgb(), m.to_rgb())
+        self.assertFalse(snap.to_rgb().flags.writeable)
+        self.assertFalse(snap.data.flags.writeable)
+        assert_array_equal(snap.levels, m.levels)
+        self.assertEqual(snap.extend, m.extend)
+        self.assertTrue(snap.to_png() is snap.to_png())
+
+        # Frozen, and independant of the map
+        self.assertRaises(AttributeError, snap.set_data, data)
+        self.assertRaises(AttributeError, snap.set_shapefile)
+        rgb = snap.to_rgb().copy()
+        m.set_data(data * 2)
+        m.set_shapefile()
+        assert_array_equal(snap.to_rgb(), rgb)
+
+        # Concurrent rendering gives the same figures
+        ref = snap.render_png(title='snap')
+        pool = ThreadPool(4)
+        try:
+            out = pool.map(lambda i: snap.render_png(title='snap'), range(8))
+        finally:
+            pool.close()
+            pool.join()
+        for png in out:
+            self.assertEqual(png, ref)
+        fig = snap.render()
+        self.assertTrue(len(fig.axes[0].collections) > 0)
+
+    def test_contourf(self):
+
+        g = Grid(nxny=(5, 4), dxdy=(10, 10), ll_corner=(-20, -15),
+                 proj=wgs84, pixel_ref='corner')
+        c = Map(g, ny=40, countries=False)
+        y, x = np.mgrid[0:40, 0:50]
+        a = np.sin(x / 8.) * np.cos(y / 6.)
+        kw = dict(levels=[-0.5, 0, 0.5], colors='none', hatches=['xx', '..'])
+
+        c.set_contourf(a, **kw)
+        paths = c._contourf_paths
+        self.assertEqual(len(paths), 2)
+        self.assertEqual([p[2]['hatch'] for p in paths], ['xx', '..'])
+
+        # Same in the background
+        c.set_contourf(a, background=True, **kw)
+        for (v1, c1, _), (v2, c2, _) in zip(paths, c._contourf_geometry):
+            assert_allclose(v1, v2)
+            assert_array_equal(c1, c2)
+        self.assertTrue(c._contourf_thread is None)
+
+        # The contours are re-used by each plot
+        geom = c._contourf_geometry
+        for figsize in [(4, 3), (8, 6)]:
+            fig = mpl.figure.Figure(figsize=figsize)
+            ax = fig.add_subplot(1, 1, 1)
+            c.plot(ax)
+            self.assertEqual(len(ax.patches), 2)
+        self.assertTrue(c._contourf_geometry is geom)
+
+        c.set_contourf()
+        self.assertTrue(c._contourf_geometry is None)
+
+    def test_labels(self):
+
+        g = Grid(nxny=(5, 4), dxdy=(10, 10), ll_corner=(-20, -15),
+                 proj=wgs84, pixel_ref='corner')
+        c = Map(g, ny=4, countries=False)
+
+        # Many labels at the same place: the one with the highest priority
+        c.set_labels(np.zeros(100), np.zeros(100),
+                     ['Label {}'.format(i) for i in range(100)],
+                     priority=np.arange(100))
+        # Far enough from each other
+        c.set_labels([-15, 15], [-10, 20], ['A', 'B'], fontsize=8)
+        # Out of sight
+        c.set_labels([100], [0], ['C'])
+        self.assertEqual(len(c._labels), 2)
+
+        fig = mpl.figure.Figure(figsize=(6, 5))
+        ax = fig.add_subplot(1, 1, 1)
+        c.plot(ax)
+        labels, = [a for a in ax.artists if hasattr(a, 'texts')]
+        FigureCanvasAgg(fig).draw()
+        self.assertEqual(sorted(t.get_text() for t in labels.texts),
+                         ['A', 'B', 'Label 99'])
+
+        # Culled with the layout of the draw, not the one of plot()
+        ax.set_position([0.1, 0.1, 0.05, 0.05])
+        fig.canvas.draw()
+        self.assertEqual(sorted(t.get_text() for t in labels.texts),
+                         ['A', 'Label 99'])
+
+        c.set_labels()
+        self.assertEqual(len(c._labels), 0)
+
     def test_caching(self):
 
         if not do_test_caching:
@@ -312,4 +940,696 @@ class TestGraphics(unittest.TestCase):
         c = Map(grid)
 
         # Assigning wrongly shhaped data should, however
-        self.assertRaises(ValueError, c.set_data, np.zeros((3, 8)))
\ No newline at end of file
+        self.assertRaises(ValueError, c.set_data, np.zeros((3, 8)))
+
+class TestUtils(unittest.TestCase):
+
+    def test_lru_cache(self):
+
+        c = LRUCache(maxsize=2)
+        c['a'] = 1
+        c['b'] = 2
+        self.assertEqual(c['a'], 1)
+        c['c'] = 3
+        # b was the least recently used
+        self.assertTrue('b' not in c)
+        self.assertEqual(len(c), 2)
+        self.assertEqual(c.get('b', 'no'), 'no')
+        c.clear()
+        self.assertEqual(len(c), 0)
+
+    def test_non_overlapping(self):
+
+        boxes = [[0, 0, 2, 1], [1, 0, 3, 1], [2, 0, 4, 1], [10, 10, 11, 11]]
+        assert_array_equal(non_overlapping(boxes), [0, 2, 3])
+        assert_array_equal(non_overlapping(boxes, priority=[0, 1, 0, 0]),
+                           [1, 3])
+        self.assertEqual(len(non_overlapping([])), 0)
+
+        # No kept box overlaps another one
+        xy = np.random.rand(500, 2) * 100
+        boxes = np.hstack([xy, xy + [3, 1]])
+        keep = boxes[non_overlapping(boxes, priority=np.random.rand(500))]
+        for b in keep:
+            overlaps = (b[0] < keep[:, 2]) & (keep[:, 0] < b[2]) & \
+                       (b[1] < keep[:, 3]) & (keep[:, 1] < b[3])
+            self.assertEqual(np.sum(overlaps), 1)
+
+
+class TestShapes(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.xdg = os.environ.get('XDG_CACHE_HOME', None)
+        os.environ['XDG_CACHE_HOME'] = os.path.join(self.testdir, 'cache')
+
+    def tearDown(self):
+        if self.xdg is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = self.xdg
+        shutil.rmtree(self.testdir)
+
+    def test_compile(self):
+
+        for name, kind in [('oceans', 'polygon'), ('rivers', 'line')]:
+            fs = os.path.join(self.testdir, name + '.shp')
+            shutil.copyfile(cleo.files[name], fs)
+            ref = read_shp(fs)
+            self.assertEqual(ref['kind'], kind)
+
+            # Structure
+            v, rings, parts = ref['vertices'], ref['rings'], ref['parts']
+            self.assertEqual(rings[0], 0)
+            self.assertEqual(rings[-1], len(v))
+            self.assertEqual(parts[-1], len(rings) - 1)
+            self.assertTrue(np.all(np.diff(rings) > 0))
+            self.assertTrue(np.all(np.diff(parts) > 0))
+            self.assertEqual(len(ref['bbox']), len(parts) - 1)
+            for i in [0, len(parts) - 2]:
+                pv = v[rings[parts[i]]:rings[parts[i+1]]]
+                assert_allclose(ref['bbox'][i, :2], pv.min(axis=0))
+                assert_allclose(ref['bbox'][i, 2:], pv.max(axis=0))
+            if kind == 'polygon':
+                assert_array_equal(v[rings[:-1]], v[rings[1:] - 1])
+
+            # Compiled once, then re-used until the source changes
+            sh = load_shapes(fs)
+            cdir = cleo.shapes._compiled_dir(fs)
+            self.assertTrue(cdir.startswith(os.path.join(self.testdir,
+                                                         'cache', 'cleo')))
+            self.assertTrue(os.path.exists(os.path.join(cdir, 'meta.json')))
+            # nothing is written next to the shapefile
+            self.assertFalse(os.path.exists(os.path.join(self.testdir,
+                                                         name + '.cshp')))
+            self.assertIsInstance(sh['vertices'], np.memmap)
+            self.assertEqual(sh['kind'], kind)
+            for k in ['vertices', 'rings', 'parts', 'bbox']:
+                assert_array_equal(sh[k], ref[k])
+            mtime = os.path.getmtime(os.path.join(cdir, 'meta.json'))
+            load_shapes(fs, mmap=False)
+            self.assertEqual(os.path.getmtime(os.path.join(cdir,
+                                                           'meta.json')),
+                             mtime)
+            st = os.stat(fs)
+            os.utime(fs, (st.st_atime, st.st_mtime + 10))
+            meta = json.loads(open(os.path.join(cdir, 'meta.json')).read())
+            self.assertNotEqual(meta['source'][2], int(st.st_mtime) + 10)
+            load_shapes(fs)
+            meta = json.loads(open(os.path.join(cdir, 'meta.json')).read())
+            self.assertEqual(meta['source'][2], int(st.st_mtime) + 10)
+
+            # Recompiling never touches the files which are in use
+            fv = os.path.join(cdir, 'vertices.npy')
+            ino = os.stat(fv).st_ino
+            compile_shapes(fs)
+            self.assertNotEqual(os.stat(fv).st_ino, ino)
+            assert_array_equal(sh['vertices'], ref['vertices'])
+            self.assertEqual(sorted(os.listdir(cdir)),
+                             ['bbox.npy', 'meta.json', 'parts.npy',
+                              'rings.npy', 'vertices.npy'])
+
+            # Compiled files next to the shapefile are used (read only)
+            shutil.rmtree(cdir)
+            pdir = os.path.join(self.testdir, name + '.cshp')
+            compile_shapes(fs, outdir=pdir)
+            sh = load_shapes(fs)
+            self.assertEqual(os.path.dirname(sh['vertices'].filename), pdir)
+            self.assertFalse(os.path.exists(cdir))
+
+    def test_map(self):
+
+        grid = local_mercator_grid(center_ll=(11.38, 47.26),
+                                   extent=(2000000, 2000000))
+        m = Map(grid, nx=200, countries=False)
+
+        # Same lines as the ones projected feature per feature by salem
+        fs = cleo.files['rivers']
+        ref = []
+        for g in salem.utils.read_shapefile_to_grid(fs, m.grid).geometry:
+            ref.extend(np.asarray(l.coords) for l in m._clip_geometry(g))
+        kind, lines = m._project_shapes(load_shapes(fs))
+        self.assertEqual(kind, 'line')
+        self.assertEqual(len(lines), len(ref))
+        assert_allclose(np.concatenate(lines), np.concatenate(ref))
+        kind, lines = m._project_shapes(*m._read_shapefile(fs))
+        self.assertEqual(len(lines), len(ref))
+        assert_allclose(np.concatenate(lines), np.concatenate(ref))
+
+        # In chunks
+        chunk = cleo.graphics._TRANSFORM_CHUNK
+        cleo.graphics._TRANSFORM_CHUNK = 1000
+        try:
+            kind, lines = m._project_shapes(load_shapes(fs))
+        finally:
+            cleo.graphics._TRANSFORM_CHUNK = chunk
+        assert_allclose(np.concatenate(lines), np.concatenate(ref))
+
+        m.set_shapefile(oceans=True)
+        self.assertEqual(len(m._collections), 1)
+        paths = m._collections[0].get_paths()
+        self.assertTrue(len(paths) > 0)
+        xmin, ymin, xmax, ymax = m._clip_extent()
+        v = np.concatenate([p.vertices for p in paths])
+        self.assertTrue(np.all((v[:, 0] >= xmin) & (v[:, 0] <= xmax)))
+        self.assertTrue(np.all((v[:, 1] >= ymin) & (v[:, 1] <= ymax)))
+
+    def test_unprojectable(self):
+
+        # The global ocean has vertices which cannot be projected on a
+        # transverse mercator: it is clipped in lon, lat first
+        grid = local_mercator_grid(center_ll=(-20, 40),
+                                   extent=(2000000, 1500000))
+        m = Map(grid, nx=100, countries=False)
+        shp = load_shapes(cleo.files['oceans'])
+        x, _ = m.grid.transform(shp['vertices'][:, 0],
+                                shp['vertices'][:, 1], crs=wgs84)
+        self.assertFalse(np.all(np.isfinite(np.ma.filled(x, np.NaN))))
+
+        m.set_shapefile(oceans=True)
+        paths = m._collections[0].get_paths()
+        self.assertTrue(len(paths) > 0)
+        xmin, ymin, xmax, ymax = m._clip_extent()
+        v = np.concatenate([p.vertices for p in paths])
+        self.assertTrue(np.all(np.isfinite(v)))
+        self.assertTrue(np.all((v[:, 0] >= xmin) & (v[:, 0] <= xmax)))
+        self.assertTrue(np.all((v[:, 1] >= ymin) & (v[:, 1] <= ymax)))
+        # the map is mostly ocean
+        self.assertTrue(v[:, 0].min() <= xmin + 1)
+        self.assertTrue(v[:, 0].max() >= xmax - 1)
+
+
+class TestTiles(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_tile_grid(self):
+
+        g = tile_grid(0, 0, 0)
+        self.assertEqual((g.nx, g.ny), (256, 256))
+        ex = g.extent_in_crs(crs=wgs84)
+        assert_allclose(ex[:2], [-180, 180])
+        assert_allclose(ex[2:], [-85.0511, 85.0511], atol=1e-4)
+
+        g = tile_grid(1, 1, 0, size=128)
+        self.assertEqual((g.nx, g.ny), (128, 128))
+        ex = g.extent_in_crs(crs=wgs84)
+        assert_allclose(ex[:3], [0, 180, 0], atol=1e-7)
+
+        self.assertRaises(ValueError, tile_grid, 1, 2, 0)
+
+    def test_renderer(self):
+
+        g = Grid(nxny=(5, 4), dxdy=(1, 1), ll_corner=(0, 40), proj=wgs84,
+                 pixel_ref='corner')
+        m = Map(g, ny=40, countries=False)
+        m.set_data(np.arange(20.).reshape((4, 5)), crs=g)
+        m.set_cmap(mpl.cm.get_cmap('jet'))
+
+        r = TileRenderer(m, cache_dir=self.testdir)
+        # zoom 5 tile containing lon 2, lat 42
+        z, x, y = 5, 16, 11
+
+        rgb = r.to_rgb(z, x, y)
+        self.assertEqual(rgb.shape, (256, 256, 4))
+        # Outside of the map is transparent, inside not
+        self.assertTrue(np.any(rgb[..., 3] == 0))
+        self.assertTrue(np.any(rgb[..., 3] == 1))
+        # Same colors as the map
+        mc = m.to_rgb()
+        self.assertTrue(np.all(np.in1d(rgb[rgb[..., 3] == 1][:, 0],
+                                       mc[..., 0])))
+
+        png = r.render(z, x, y)
+        self.assertTrue(png.startswith(b'\x89PNG'))
+        self.assertTrue(r.render(z, x, y) is png)
+        path = os.path.join(self.testdir, r.version, '5', '16', '11.png')
+        self.assertTrue(os.path.exists(path))
+
+        # Another process reads from disk
+        r2 = TileRenderer(m, cache_dir=self.testdir)
+        self.assertEqual(r2.render(z, x, y), png)
+
+        # Server threads rendering the same tiles at once
+        r4 = TileRenderer(m, cache_dir=self.testdir, cache_size=2)
+        tiles = [(z, x + i % 3, y) for i in range(24)]
+        pool = ThreadPool(8)
+        try:
+            out = pool.map(lambda t: r4.render(*t), tiles)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(out[0], png)
+        self.assertEqual(out[3], png)
+        self.assertFalse(any(f.endswith('.tmp') for f in
+                             os.listdir(os.path.dirname(path))))
+
+        # Missing data and topography: same as the map
+        mt = copy.copy(m)
+        mt._versions = dict(m._versions)
+        mt.invalidate()
+        mt.set_data(np.ma.masked_less(np.arange(20.).reshape((4, 5)), 5),
+                    crs=g)
+        mt.set_topography(np.random.RandomState(0).rand(40, 50))
+        rgbt = TileRenderer(mt).to_rgb(z, x, y)
+        assert_array_equal(rgbt[..., 3], rgb[..., 3])
+        mc = mt.to_rgb()
+        for i in [0, 1, 2]:
+            self.assertTrue(np.all(np.in1d(rgbt[rgbt[..., 3] == 1][:, i],
+                                           mc[..., i])))
+
+        # Other data, other tiles
+        m.set_data(np.arange(20.).reshape((4, 5))[::-1], crs=g)
+        r3 = TileRenderer(m, cache_dir=self.testdir)
+        self.assertNotEqual(r3.version, r.version)
+        self.assertNotEqual(r3.render(z, x, y), png)
+        self.assertTrue(os.path.exists(path))
+
+        # Reset empties the caches
+        r2.reset()
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(r2.version, r3.version)
+
+        # WSGI
+        app = make_wsgi_app(r)
+        status = []
+        def start_response(s, headers):
+            status.append(s)
+        out = app({'PATH_INFO': '/5/16/11.png'}, start_response)
+        self.assertEqual(status[-1], '200 OK')
+        self.assertEqual(out, [png])
+        app({'PATH_INFO': '/5/99/11.png'}, start_response)
+        self.assertEqual(status[-1], '404 Not Found')
+        app({'PATH_INFO': '/favicon.ico'}, start_response)
+        self.assertEqual(status[-1], '404 Not Found')
+
+    def test_renderer_source(self):
+
+        g = Grid(nxny=(5, 4), dxdy=(1, 1), ll_corner=(0, 40), proj=wgs84,
+                 pixel_ref='corner')
+        m = Map(g, ny=40, countries=False)
+        m.set_data(np.arange(20.).reshape((4, 5)), crs=g)
+        cm = mpl.colors.ListedColormap(['white', 'blue', 'red', 'black'])
+        m.set_cmap(cm)
+        m.set_plot_params(levels=[0, 5, 10, 15, 20])
+
+        # A checkerboard, finer than the map
+        src = Grid(nxny=(500, 400), dxdy=(0.01, 0.01), ll_corner=(0, 40),
+                   proj=wgs84, pixel_ref='corner')
+        data = (np.indices((400, 500)).sum(axis=0) % 2) * 10 + 1.
+        lazy = LazyArray(data)
+        r = TileRenderer(m, data=lazy, crs=src, version='v1')
+        self.assertEqual(r.version, TileRenderer(m, data=data, crs=src,
+                                                 version='v1').version)
+        self.assertNotEqual(r.version, TileRenderer(m).version)
+        # Lazy arrays are not read to compute the version
+        lazy.nread = 0
+        r0 = TileRenderer(m, data=lazy, crs=src)
+        r0.reset()
+        self.assertEqual(lazy.nread, 0)
+        self.assertNotEqual(r0.version, r.version)
+        self.assertEqual(TileRenderer(m, data=lazy, crs=src,
+                                      hash_source=True).version,
+                         TileRenderer(m, data=data, crs=src).version)
+        self.assertEqual(lazy.nread, data.size)
+        self.assertNotEqual(TileRenderer(m, data=data * 2, crs=src).version,
+                            TileRenderer(m, data=data, crs=src).version)
+        mm = os.path.join(self.testdir, 'src.npy')
+        np.save(mm, data)
+        v1 = TileRenderer(m, data=np.load(mm, mmap_mode='r'), crs=src).version
+        st = os.stat(mm)
+        os.utime(mm, (st.st_atime, st.st_mtime + 10))
+        self.assertNotEqual(TileRenderer(m, data=np.load(mm, mmap_mode='r'),
+                                         crs=src).version, v1)
+        lazy.nread = 0
+
+        # zoom 12 tile containing lon 2.005, lat 42.005
+        lon, lat, z = 2.005, 42.005, 12
+        n = 2 ** z
+        x = int((lon + 180) / 360 * n)
+        lr = np.radians(lat)
+        y = int((1 - np.log(np.tan(lr) + 1 / np.cos(lr)) / np.pi) / 2 * n)
+        rgb = r.to_rgb(z, x, y)
+        self.assertTrue(np.all(rgb[..., 3] == 1))
+        # the two colors of the checkerboard, where the map has only one
+        colors = np.unique(rgb[..., :3].reshape((-1, 3)), axis=0)
+        assert_allclose(colors, np.unique([cm(0)[:3], cm(2)[:3]], axis=0))
+        changes = np.sum(np.diff(rgb[0, :, 1]) != 0)
+        self.assertTrue(changes > 4)
+        mrgb = TileRenderer(m).to_rgb(z, x, y)
+        self.assertTrue(np.sum(np.diff(mrgb[0, :, 1]) != 0) < 2)
+        # only the data covering the tile is read
+        self.assertTrue(0 < lazy.nread < data.size / 100)
+
+        # Same pixels than the source
+        tg = tile_grid(z, x, y).center_grid
+        lons, lats = tg.ll_coordinates
+        i, j = src.center_grid.transform(lons, lats, crs=wgs84, nearest=True)
+        ref = DataLevels(data[j, i], levels=m.levels, cmap=cm).to_rgb()
+        assert_array_equal(rgb, ref)
+
+        # Outside of the source data
+        rgb = r.to_rgb(5, 0, 0)
+        self.assertTrue(np.all(rgb[..., 3] == 0))
+
+
+class TestMosaic(unittest.TestCase):
+
+    def test_mosaic(self):
+
+        g = Grid(nxny=(10, 8), dxdy=(1, 1), ll_corner=(0, 0), proj=wgs84,
+                 pixel_ref='corner')
+        t1 = Grid(nxny=(4, 4), dxdy=(1, 1), ll_corner=(2, 2), proj=wgs84,
+                  pixel_ref='corner')
+        t2 = Grid(nxny=(4, 4), dxdy=(1, 1), ll_corner=(4, 3), proj=wgs84,
+                  pixel_ref='corner')
+        t3 = Grid(nxny=(3, 3), dxdy=(1, 1), ll_corner=(100, 50), proj=wgs84,
+                  pixel_ref='corner')
+        d2 = np.full((4, 4), 2.)
+        d2[0, 0] = np.NaN
+        tiles = [(np.ones((4, 4)), t1), (d2, t2), (np.ones((3, 3)), t3)]
+
+        ref = np.zeros((8, 10))
+        ref[2:6, 2:6] = 1
+        ref[3:7, 4:8] += 2
+        ref[3, 4] -= 2
+        count = np.zeros((8, 10))
+        count[2:6, 2:6] = 1
+        count[3:7, 4:8] += 1
+        count[3, 4] -= 1
+        for interp in ['nearest', 'linear']:
+            first = Mosaic(g, rule='first', interp=interp)
+            last = Mosaic(g, rule='last', interp=interp)
+            mean = Mosaic(g, rule='mean', interp=interp)
+            for t in tiles:
+                first.add(*t)
+            last.add_many(tiles, processes=2)
+            mean.add_many(tiles)
+            assert_array_equal(first.count, count)
+            assert_array_equal(last.count, count)
+            assert_array_equal(mean.data.mask, count == 0)
+            assert_allclose(first.data.filled(0), np.where(ref > 2, 1, ref))
+            assert_allclose(last.data.filled(0), np.where(ref > 2, 2, ref))
+            assert_allclose(mean.data.filled(0), np.where(ref > 2, 1.5, ref))
+
+        # The plans are kept
+        self.assertEqual(len(mean._plans), 3)
+        mean.reset()
+        self.assertTrue(np.all(mean.data.mask))
+        self.assertEqual(len(mean._plans), 3)
+
+        self.assertRaises(ValueError, Mosaic, g, rule='max')
+        self.assertRaises(ValueError, mean.add, np.ones((3, 4)), t1)
+
+
+class TestAnimation(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_animation(self):
+
+        g = Grid(nxny=(5, 4), dxdy=(1, 1), ll_corner=(0, 40), proj=wgs84,
+                 pixel_ref='corner')
+        m = Map(g, ny=40, countries=False)
+        m.set_cmap(mpl.cm.get_cmap('jet'))
+        frames = [np.arange(20.).reshape((4, 5)) * i for i in range(1, 4)]
+        m.set_data(frames[-1], crs=g)
+        ref = m.data.copy()
+
+        anim = MapAnimation(m, crs=g)
+        self.assertEqual(anim.map.extend, 'neither')
+        naxes = len(anim.fig.axes)
+        image = anim.image
+
+        rgbas = list(anim.iter_rgba(frames))
+        self.assertEqual(len(rgbas), 3)
+        self.assertEqual(rgbas[0].dtype, np.uint8)
+        self.assertEqual(rgbas[0].shape[-1], 4)
+        self.assertFalse(np.all(rgbas[0] == rgbas[-1]))
+
+        # The artists are reused
+        self.assertEqual(len(anim.fig.axes), naxes)
+        self.assertEqual(len(anim.ax.images), 1)
+        self.assertTrue(anim.ax.images[0] is image)
+        assert_array_equal(image.get_array(), anim.map.to_rgb())
+
+        # The map itself is not modified
+        self.assertTrue(m._levels is None)
+        self.assertTrue(m._extend is None)
+        anim.update(frames[0])
+        assert_array_equal(m.data, ref)
+        self.assertFalse(np.all(m.to_rgb() == anim.map.to_rgb()))
+
+        # Without colorbar
+        anim2 = MapAnimation(m, crs=g, addcbar=False)
+        self.assertEqual(len(anim2.fig.axes), naxes - 1)
+
+        files = anim.save_frames(iter(frames), self.testdir,
+                                 titles=['a', 'b', 'c'])
+        self.assertEqual(len(files), 3)
+        for f in files:
+            self.assertTrue(os.path.exists(f))
+        self.assertEqual(anim.ax.get_title(), 'c')
+
+    def test_prefetch(self):
+
+        g = Grid(nxny=(5, 4), dxdy=(1, 1), ll_corner=(0, 40), proj=wgs84,
+                 pixel_ref='corner')
+        m = Map(g, ny=40, countries=False)
+        frames = [np.arange(20.).reshape((4, 5)) * i for i in range(1, 6)]
+        m.set_data(frames[-1], crs=g)
+        anim = MapAnimation(m, crs=g)
+        ref = list(anim.iter_rgba(frames))
+
+        # Same frames, also if they are read by functions
+        loaders = [(lambda f=f: f) for f in frames]
+        for prefetch in [1, 3, 10]:
+            rgbas = list(anim.iter_rgba(loaders, prefetch=prefetch))
+            self.assertEqual(len(rgbas), len(ref))
+            for r1, r2 in zip(rgbas, ref):
+                assert_array_equal(r1, r2)
+
+        # Back-pressure: the frames are not read too much in advance
+        read = []
+
+        def frame_iter():
+            for i, f in enumerate(frames):
+                read.append(i)
+                yield f
+        it = anim.iter_rgba(frame_iter(), prefetch=2)
+        next(it)
+        self.assertTrue(len(read) <= 4)
+        it.close()
+
+        # Errors are raised
+        def fail():
+            raise RuntimeError('read error')
+        it = anim.iter_rgba([frames[0], fail], prefetch=2)
+        next(it)
+        self.assertRaises(RuntimeError, next, it)
+
+        # asyncio
+        try:
+            import asyncio
+        except ImportError:  # pragma: no cover (py2)
+            return
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            pipe = anim.pipeline(frames)
+            rgbas = []
+            while True:
+                try:
+                    rgbas.append(loop.run_until_complete(pipe.__anext__()))
+                except StopAsyncIteration:
+                    break
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+        self.assertEqual(len(rgbas), len(ref))
+        assert_array_equal(rgbas[-1], ref[-1])
+        self.assertEqual(len(list(anim.pipeline(frames))), len(ref))
+
+
+class TestProfiling(unittest.TestCase):
+
+    def test_recorder(self):
+
+        # Nothing happens when no one is listening
+        self.assertTrue(profiling.stage('dummy') is profiling._null_stage)
+
+        g = Grid(nxny=(5, 4), dxdy=(1, 1), ll_corner=(0, 40), proj=wgs84,
+                 pixel_ref='corner')
+        m = Map(g, ny=40, countries=False)
+
+        records = []
+        with profiling.Recorder(callback=records.append) as rec:
+            m.set_data(np.arange(20.).reshape((4, 5)), crs=g)
+            m.set_topography(np.arange(20.).reshape((4, 5)), crs=g)
+            m.to_rgb()
+        m.to_rgb()
+
+        stages = [r['stage'] for r in rec.records]
+        self.assertEqual(stages, ['Map._check_data', 'Map._check_data',
+                                  'Map.set_topography.gradient',
+                                  'DataLevels.norm', 'DataLevels.colormap',
+                                  'DataLevels.to_rgb', 'Map.shading',
+                                  'Map.to_rgb'])
+        self.assertEqual(records, rec.records)
+        r = rec.records[0]
+        self.assertEqual(r['shape'], [40, 50])
+        self.assertTrue(r['wall_time'] >= 0)
+        self.assertEqual(rec.records[3]['parent'], 'DataLevels.to_rgb')
+        self.assertEqual(rec.summary()['Map._check_data']['calls'], 2)
+
+        report = json.loads(rec.to_json())
+        self.assertEqual(len(report['records']), 8)
+        self.assertTrue(profiling.stage('dummy') is profiling._null_stage)
+
+    def test_memory(self):
+
+        if profiling.tracemalloc is None:
+            return
+        n = 2**20
+        keep = []
+        with profiling.Recorder(trace_memory=True) as rec:
+            big = np.ones(4 * n)
+            with profiling.stage('outer'):
+                with profiling.stage('inner'):
+                    a = np.ones(n)
+                    del a
+                with profiling.stage('inner'):
+                    keep.append(np.ones(n // 2))
+            del big
+        inner1, inner2, outer = rec.records
+        self.assertEqual(inner1['stage'], 'inner')
+        self.assertEqual(outer['stage'], 'outer')
+        # net memory
+        self.assertTrue(abs(inner1['retained_bytes']) < n)
+        self.assertTrue(inner2['retained_bytes'] >= 4 * n)
+        self.assertTrue(outer['retained_bytes'] >= 4 * n)
+        if profiling._reset_peak is None:
+            self.assertFalse('peak_bytes' in outer)
+            return
+        # the peaks of the stages, not of the whole tracing
+        self.assertTrue(8 * n <= inner1['peak_bytes'] < 9 * n)
+        self.assertTrue(4 * n <= inner2['peak_bytes'] < 5 * n)
+        self.assertTrue(8 * n <= outer['peak_bytes'] < 9 * n)
+        s = rec.summary()['inner']
+        self.assertEqual(s['peak_bytes'], inner1['peak_bytes'])
+
+
+class TestSerialize(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_save_load(self):
+
+        grid = local_mercator_grid(center_ll=(-20, 40), extent=(2000000,
+                                                                 1500000))
+        m = Map(grid, nx=100, countries=False)
+        m.set_shapefile(oceans=True)
+        m.set_shapefile(rivers=True)
+        m.set_lonlat_contours(interval=5)
+        topo = np.random.RandomState(0).rand(m.grid.ny, m.grid.nx)
+        m.set_topography(topo)
+        data = np.arange(m.grid.nx * m.grid.ny * 1.)
+        data = data.reshape((m.grid.ny, m.grid.nx))
+        data[:10, :10] = np.NaN
+        m.set_data(data)
+        m.set_cmap(mpl.cm.get_cmap('viridis'))
+        m.set_plot_params(nlevels=12)
+
+        save_map(m, self.testdir)
+        for mmap in [True, False]:
+            m2 = load_map(self.testdir, mmap=mmap)
+            self.assertEqual((m2.grid.nx, m2.grid.ny), (m.grid.nx, m.grid.ny))
+            assert_allclose(m2.grid.extent, m.grid.extent)
+            self.assertEqual(m2.origin, m.origin)
+            assert_array_equal(m2.to_rgb(), m.to_rgb())
+            assert_array_equal(m2.slope, m.slope)
+            self.assertTrue(np.ma.is_masked(m2.data))
+            self.assertEqual(m2.xtick_val, m.xtick_val)
+            self.assertEqual(m2.ytick_val, m.ytick_val)
+            assert_array_equal(m2._pixcorner_ll[0], m._pixcorner_ll[0])
+            self.assertEqual(len(m2._collections), len(m._collections))
+            for c1, c2 in zip(m._collections, m2._collections):
+                self.assertEqual(type(c1), type(c2))
+                p1 = np.concatenate([p.vertices for p in c1.get_paths()])
+                p2 = np.concatenate([p.vertices for p in c2.get_paths()])
+                assert_allclose(p1, p2)
+                assert_array_equal(c1.get_facecolor(), c2.get_facecolor())
+                assert_array_equal(c1.get_edgecolor(), c2.get_edgecolor())
+
+        # The template is not modified by the map
+        m2 = load_map(self.testdir)
+        m2.data[:] = 0
+        m2 = load_map(self.testdir)
+        assert_array_equal(m2.data, m.data)
+
+        # Saving again does not touch the files which are in use
+        ino = os.stat(os.path.join(self.testdir, 'slope.npy')).st_ino
+        m.set_topography(topo * 2)
+        save_map(m, self.testdir)
+        self.assertNotEqual(os.stat(os.path.join(self.testdir,
+                                                 'slope.npy')).st_ino, ino)
+        self.assertFalse(np.array_equal(m2.slope, m.slope))
+        assert_array_equal(load_map(self.testdir).slope, m.slope)
+        self.assertFalse(any(f.endswith('.tmp')
+                             for f in os.listdir(self.testdir)))
+
+
+class TestSharedMem(unittest.TestCase):
+
+    def test_shared_map(self):
+
+        grid = local_mercator_grid(center_ll=(-20, 40), extent=(2000000,
+                                                                 1500000))
+        m = Map(grid, nx=100, countries=False)
+        m.set_shapefile(oceans=True)
+        topo = np.random.RandomState(0).rand(m.grid.ny, m.grid.nx)
+        m.set_topography(topo)
+        m.set_data(topo)
+
+        with SharedMap(m) as shared:
+            spec = pickle.loads(pickle.dumps(shared.spec))
+            self.assertTrue(shared.nbytes >= m.slope.nbytes)
+            m2 = attach_map(spec)
+            assert_array_equal(m2.slope, m.slope)
+            assert_array_equal(m2._pixcorner_ll[1], m._pixcorner_ll[1])
+            assert_array_equal(m2.to_rgb(), m.to_rgb())
+            self.assertFalse(m2.slope.flags.writeable)
+            self.assertFalse(m2._pixcorner_ll[0].flags.writeable)
+            self.assertTrue(m2.data.flags.writeable)
+            p1 = m._collections[0].get_paths()[0].vertices
+            p2 = m2._collections[0].get_paths()[0].vertices
+            assert_array_equal(p1, p2)
+
+            # Snapshots share the handle on the block
+            snap = m2.snapshot()
+            self.assertTrue(snap._shared_memory is m2._shared_memory)
+            assert_array_equal(snap.to_rgb(), m.to_rgb())
+            self.assertTrue(len(snap.render_png()) > 0)
+            name = shared.name
+
+        # The block is gone
+        self.assertRaises(Exception, attach_map, spec)
+        self.assertEqual(spec['block'], name)
+
+        # Also when the owner is garbage collected
+        shared = SharedMap(m)
+        spec = shared.spec
+        del shared
+        self.assertRaises(Exception, attach_map, spec)
@@ -0,0 +1,398 @@
+"""Rendering of XYZ web-mercator tiles out of a Map.
+
+Copyright: Fabien Maussion, 2014-2015
+
+License: GPLv3+
+"""
+from __future__ import division, absolute_import, unicode_literals
+# Builtins
+import io
+import os
+import re
+import hashlib
+import threading
+import warnings
+# External libs
+import numpy as np
+import matplotlib as mpl
+import pyproj
+import salem
+# Locals
+from cleo import utils
+from cleo.graphics import (DataLevels, shade_rgb, _data_window,
+                           _grid_window, _remove_alpha)
+from cleo.mosaic import _remap_plan, _resample
+from cleo.shapes import _write_atomic
+
+# The web mercator projection (EPSG:3857)
+wmerc = pyproj.Proj('+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 '
+                    '+lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m '
+                    '+nadgrids=@null +wktext +no_defs')
+
+# Half the extent of the web mercator world (m)
+_origin = 20037508.342789244
+
+
+def tile_grid(z, x, y, size=256):
+    """The salem.Grid of a XYZ web-mercator tile.
+
+    Parameters
+    ----------
+    z: the zoom level
+    x: the tile column (from the west)
+    y: the tile row (from the north)
+    size: the number of pixels of a tile side
+    """
+
+    n = 2 ** z
+    if not ((0 <= x < n) and (0 <= y < n)):
+        raise ValueError('Tile {}/{}/{} does not exist.'.format(z, x, y))
+    tile_size = 2 * _origin / n
+    dxy = tile_size / size
+    return salem.Grid(nxny=(size, size), dxdy=(dxy, -dxy),
+                      ul_corner=(-_origin + x * tile_size,
+                                 _origin - y * tile_size),
+                      proj=wmerc, pixel_ref='corner')
+
+
+class TileRenderer(object):
+    """Renders PNG tiles out of a configured Map.
+
+    The renderer takes a snapshot of the map's data, levels, colormap and
+    shading at instanciation: later changes to the map are not seen until
+    reset() is called. The colors are thus the same on all tiles, whatever
+    part of the data they show.
+
+    By default, the tiles show the map's data, which has the resolution of
+    the map. Give the source data and its grid to remap it on each tile
+    instead: the tiles then keep the details of the data at all zoom
+    levels. Only the part of the source data covering the tile is read, so
+    that lazy arrays (xarray, netCDF4 variables...) can be used.
+
+    Three caches avoid to redo the work for repeated tiles:
+      - the remap plans (the pixels to pick for each tile pixel) are kept
+        in memory
+      - the encoded PNGs are kept in an in-memory LRU cache
+      - if a cache_dir is given, the PNGs are also written to disk and read
+        back from there (possibly by another process). The tiles are stored
+        in a sub-directory named after the version of the renderer, which
+        changes with the data and the plotting parameters.
+    """
+
+    def __init__(self, template, data=None, crs=None, interp='nearest',
+                 size=256, cache_size=1024, plan_cache_size=256,
+                 cache_dir=None, version=None, hash_source=False):
+        """Instanciate.
+
+        Parameters
+        ----------
+        template: the cleo.Map to render
+        data: the source data (2d, optional): remapped on each tile instead
+        of the map's data. It is not copied: call reset() if it changes
+        crs: the salem.Grid of the source data
+        interp: 'nearest' (default) or 'linear', the interpolation of the
+        source data
+        size: the number of pixels of a tile side
+        cache_size: the maximum number of PNGs to keep in memory
+        plan_cache_size: the maximum number of remap plans to keep in memory
+        cache_dir: a directory where to store the tiles (optional)
+        version: a string identifying the source data (optional, e.g. a
+        file modification date). By default, the source data is identified
+        by its content if it is a numpy array in memory, and by its type,
+        shape, dtype and file (name and modification time, when it has
+        one) otherwise
+        hash_source: identify the source data by its content even if it is
+        a lazy array (this reads all of it, at each reset())
+        """
+
+        if data is not None and not isinstance(crs, salem.Grid):
+            raise ValueError('The source data needs a salem.Grid.')
+        self.template = template
+        self.size = size
+        self.cache_dir = cache_dir
+        self._source = data
+        self._source_grid = crs
+        self._source_version = version
+        self._hash_source = hash_source
+        self.interp = interp
+        # the caches are shared by the server threads
+        self._tiles = utils.LRUCache(cache_size)
+        self._plans = utils.LRUCache(plan_cache_size)
+        self._lock = threading.Lock()
+        self._snapshot()
+
+    def _snapshot(self):
+        """Copy what is needed for the rendering out of the template."""
+
+        m = self.template
+        self.grid = m.grid.center_grid
+        self._rgb = m._rgb
+        self._data = m.data
+        self._slope = m.slope
+        self._relief_factor = getattr(m, 'relief_factor', 0.7)
+        # the levels are computed once for all tiles
+        self._levels = m.levels
+        self._extend = m.extend
+        self._cmap = m.cmap
+        self._dtype = m.dtype
+        self.version = self._version()
+
+    def _version(self):
+        """A hash of everything which makes the tiles."""
+
+        h = hashlib.md5()
+
+        def _update(*items):
+            for item in items:
+                if isinstance(item, np.ndarray):
+                    for a in [np.ma.getdata(item), np.ma.getmask(item)]:
+                        h.update(np.ascontiguousarray(a).view(np.uint8))
+                else:
+                    h.update(repr(item).encode('utf-8'))
+
+        if not self._cmap._isinit:
+            self._cmap._init()
+        _update(utils.grid_key(self.grid), self.size, self._relief_factor,
+                np.asarray(self._levels), self._extend, str(self._dtype),
+                self._cmap._lut, self._slope is not None, self.interp)
+        for a in [self._rgb, self._slope]:
+            if a is not None:
+                _update(a)
+        if self._source is None:
+            if self._rgb is None:
+                _update(self._data)
+        else:
+            _update(utils.grid_key(self._source_grid))
+            if self._source_version is not None:
+                _update(self._source_version)
+            else:
+                src = self._source
+                in_memory = isinstance(src, np.ndarray) and \
+                    not isinstance(src, np.memmap)
+                if in_memory or self._hash_source:
+                    _update(np.asanyarray(utils.materialize(
+                        src[(slice(None),) * src.ndim])))
+                else:
+                    _update(*_source_key(src))
+        return h.hexdigest()[:16]
+
+    def reset(self):
+        """Take a new snapshot of the template and empty the tile caches.
+
+        The tiles of the previous version are removed from the disk cache.
+        """
+
+        old = self.version
+        self._snapshot()
+        with self._lock:
+            self._tiles.clear()
+        if self.cache_dir is not None:
+            vdir = os.path.join(self.cache_dir, old)
+            if os.path.isdir(vdir):
+                for root, _, files in os.walk(vdir):
+                    for f in files:
+                        if f.endswith('.png'):
+                            os.remove(os.path.join(root, f))
+
+    def _plan(self, z, x, y):
+        """The flat index of the map pixels to pick for each tile pixel."""
+
+        key = (z, x, y)
+        with self._lock:
+            plan = self._plans.get(key)
+        if plan is None:
+            g = tile_grid(z, x, y, size=self.size).center_grid
+            tx, ty = g.xy_coordinates
+            i, j = self.grid.transform(tx, ty, crs=wmerc, nearest=True)
+            i = np.asarray(i, dtype=np.int64)
+            j = np.asarray(j, dtype=np.int64)
+            valid = (i >= 0) & (i < self.grid.nx) & (j >= 0) & \
+                    (j < self.grid.ny)
+            idx = np.where(valid, j * self.grid.nx + i, 0)
+            plan = (idx, valid)
+            with self._lock:
+                self._plans[key] = plan
+        return plan
+
+    def _source_plan(self, z, x, y):
+        """The window of the source data covering a tile, and the remap
+        plan of this window on the tile (see cleo.mosaic)."""
+
+        key = ('source', z, x, y)
+        with self._lock:
+            plan = self._plans.get(key)
+        if plan is None:
+            g = tile_grid(z, x, y, size=self.size)
+            j0, j1, i0, i1 = _data_window(g, self._source_grid)
+            wgrid = _grid_window(self._source_grid, i0, i1, j0, j1)
+            plan = ((slice(j0, j1), slice(i0, i1)), _remap_plan(g, wgrid))
+            with self._lock:
+                self._plans[key] = plan
+        return plan
+
+    def _remap(self, data, plan):
+        """Pick the tile pixels out of a map array."""
+
+        idx, valid = plan
+        shp = idx.shape + data.shape[2:]
+        flat = np.ma.getdata(data).reshape((-1, ) + data.shape[2:])
+        out = flat[idx.ravel()].reshape(shp)
+        mask = ~valid
+        if np.ma.is_masked(data):
+            mask |= np.ma.getmaskarray(data).ravel()[idx]
+        return out, mask
+
+    def _remap_source(self, z, x, y):
+        """Read the source data covering a tile and remap it."""
+
+        window, plan = self._source_plan(z, x, y)
+        src = self._source
+        lead = (0,) * (src.ndim - 2)
+        data = utils.materialize(src[lead + window])
+        win, values, valid = _resample(data, plan, interp=self.interp)
+        out = np.zeros((self.size, self.size))
+        mask = np.ones((self.size, self.size), dtype=bool)
+        if win is not None:
+            j0, j1, i0, i1 = win
+            out[j0:j1, i0:i1] = np.where(valid, values, 0)
+            mask[j0:j1, i0:i1] = ~valid
+        return out, mask
+
+    def to_rgb(self, z, x, y):
+        """The RGBA image of a tile (no cache involved)."""
+
+        plan = self._plan(z, x, y)
+        if self._source is None and self._rgb is not None:
+            rgb, mask = self._remap(self._rgb, plan)
+            alpha = (~mask).astype(rgb.dtype)
+            rgb = np.dstack((rgb, alpha))
+        else:
+            if self._source is None:
+                data, mask = self._remap(self._data, plan)
+            else:
+                data, mask = self._remap_source(z, x, y)
+            if np.any(mask):
+                data = np.ma.masked_array(data, mask=mask)
+            with warnings.catch_warnings():
+                # the levels are those of the full map: all is fine
+                warnings.simplefilter('ignore', RuntimeWarning)
+                dl = DataLevels(data, levels=self._levels,
+                                extend=self._extend, cmap=self._cmap,
+                                dtype=self._dtype)
+                rgb = dl.to_rgb()
+        if self._slope is not None:
+            # like the map, but what is outside of it stays transparent
+            slope, _ = self._remap(self._slope, plan)
+            _remove_alpha(rgb)
+            shade_rgb(rgb, slope, relief_factor=self._relief_factor)
+            rgb[~plan[1], 3] = 0
+        return rgb
+
+    def _disk_path(self, z, x, y):
+        return os.path.join(self.cache_dir, self.version, str(z), str(x),
+                            '{}.png'.format(y))
+
+    def render(self, z, x, y):
+        """The tile as PNG bytes (served from the caches if possible)."""
+
+        key = (z, x, y)
+        with self._lock:
+            png = self._tiles.get(key)
+        if png is not None:
+            return png
+
+        path = None
+        if self.cache_dir is not None:
+            path = self._disk_path(z, x, y)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    png = f.read()
+                with self._lock:
+                    self._tiles[key] = png
+                return png
+
+        buf = io.BytesIO()
+        mpl.image.imsave(buf, self.to_rgb(z, x, y), format='png')
+        png = buf.getvalue()
+        with self._lock:
+            self._tiles[key] = png
+
+        if path is not None:
+            # write atomically, other processes might be reading
+            dirname = os.path.dirname(path)
+            if not os.path.exists(dirname):
+                try:
+                    os.makedirs(dirname)
+                except OSError:
+                    # someone else was faster
+                    pass
+            _write_atomic(path, lambda f: f.write(png))
+        return png
+
+
+def _source_key(data):
+    """Cheap identification of a lazy array, without reading it: its type,
+    shape and dtype, and the name and modification time of its file."""
+
+    key = [type(data).__name__, tuple(data.shape),
+           str(getattr(data, 'dtype', None))]
+    path = getattr(data, 'filename', None)  # np.memmap
+    if path is None:
+        # xarray
+        encoding = getattr(data, 'encoding', None)
+        if isinstance(encoding, dict):
+            path = encoding.get('source', None)
+    if path is None and hasattr(data, 'group'):
+        # netCDF4 variable
+        try:
+            path = data.group().filepath()
+        except (AttributeError, ValueError):
+            pass
+    key.append(getattr(data, 'name', None))
+    if path is not None and os.path.exists(path):
+        key.extend([os.path.abspath(path), os.path.getmtime(path)])
+    return key
+
+
+_tile_path = re.compile(r'^/(\d+)/(\d+)/(\d+)\.png$')
+
+
+def make_wsgi_app(renderer):
+    """A WSGI application serving the tiles of a TileRenderer.
+
+    The tiles are available at /{z}/{x}/{y}.png
+    """
+
+    def app(environ, start_response):
+        match = _tile_path.match(environ.get('PATH_INFO', ''))
+        png = None
+        if match is not None:
+            z, x, y = [int(v) for v in match.groups()]
+            try:
+                png = renderer.render(z, x, y)
+            except ValueError:
+                pass
+        if png is None:
+            start_response(str('404 Not Found'),
+                           [(str('Content-Type'), str('text/plain'))])
+            return [b'Tile not found']
+        start_response(str('200 OK'),
+                       [(str('Content-Type'), str('image/png')),
+                        (str('Content-Length'), str(len(png)))])
+        return [png]
+
+    return app
+
+
+def serve(renderer, host='localhost', port=8000):
+    """Serve the tiles of a TileRenderer on a local HTTP server.
+
+    This is a simple, single threaded server for testing purposes. In
+    production, give make_wsgi_app(renderer) to a proper WSGI server.
+    """
+
+    from wsgiref.simple_server import make_server
+    httpd = make_server(host, port, make_wsgi_app(renderer))
+    print('Serving tiles on http://{}:{}/{{z}}/{{x}}/{{y}}.png'.format(host,
+                                                                      port))
+    httpd.serve_forever()
@@ -0,0 +1,215 @@
+"""Some useful functions.
+
+Copyright: Fabien Maussion, 2014-2015
+
+License: GPLv3+
+"""
+from __future__ import division
+# Builtins
+from collections import OrderedDict, deque
+from multiprocessing.pool import ThreadPool
+# External libs
+import numpy as np
+# Locals
+
+
+def has_invalid(data):
+    """Checks if an array has masked or non-finite values.
+
+    This avoids to allocate a full boolean mask in the (frequent) case where
+    all values are valid: the sum of an array is finite only if all its
+    elements are. An overflow gives a false positive, which is harmless
+    since the caller will then fall back to the masked way.
+    """
+
+    if np.ma.is_masked(data):
+        return True
+    data = np.ma.getdata(data)
+    if data.dtype.kind not in ['f', 'c']:
+        return False
+    with np.errstate(over='ignore', invalid='ignore'):
+        return not np.isfinite(np.sum(data))
+
+
+def lazy_masked_invalid(data):
+    """Like numpy.ma.masked_invalid, but the mask is only materialized
+    if there is something to mask. Otherwise, the plain array is returned.
+    """
+
+    if has_invalid(data):
+        return np.ma.masked_invalid(data, copy=False)
+    return np.ma.getdata(data)
+
+
+def is_lazy(data):
+    """Checks if an array is read only when sliced or converted (e.g. an
+    xarray.DataArray, a dask array or a netCDF4 variable)."""
+
+    return (not isinstance(data, np.ndarray) and hasattr(data, 'shape') and
+            hasattr(data, 'ndim') and hasattr(data, '__getitem__'))
+
+
+def materialize(data):
+    """Reads a (sliced) lazy array. Numpy and masked arrays are returned
+    as they are."""
+
+    if isinstance(data, np.ndarray):
+        return data
+    return np.asarray(data)
+
+
+def grid_outline(grid):
+    """The pixel corners along the four edges of a salem.Grid.
+
+    Returns the x, y coordinates (float arrays) of the corners in the
+    grid's corner_grid.
+    """
+
+    cg = grid.corner_grid
+    nx, ny = cg.nx, cg.ny
+    ex = np.concatenate([np.arange(nx + 1), np.full(ny + 1, nx),
+                         np.arange(nx + 1), np.zeros(ny + 1)])
+    ey = np.concatenate([np.zeros(nx + 1), np.arange(ny + 1),
+                         np.full(nx + 1, ny), np.arange(ny + 1)])
+    return ex.astype(float), ey.astype(float)
+
+
+def prefetch(func, items, ahead=2, threads=None):
+    """Like map(func, items), but the next results are computed in
+    background threads while the current one is used.
+
+    The items iterable is consumed at most `ahead` items in advance of the
+    results (back-pressure). The results come in the input order, and the
+    exceptions are raised when their result is reached.
+
+    Parameters
+    ----------
+    func: the function to apply (called in the background threads)
+    items: an iterable of items
+    ahead: the maximum number of results computed in advance
+    threads: the number of threads (default: ahead)
+    """
+
+    pool = ThreadPool(threads or max(1, ahead))
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) > ahead:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.close()
+        pool.join()
+
+
+def grid_key(grid):
+    """A hashable key identifying a salem.Grid (e.g. for caches)."""
+
+    cg = grid.corner_grid
+    return (cg.proj.srs, cg.nx, cg.ny, cg.dx, cg.dy, cg.x0, cg.y0)
+
+
+class LRUCache(object):
+    """A simple dict-like container with a least recently used policy.
+
+    Once maxsize items are stored, adding a new one discards the one
+    which has not been used for the longest time.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._d = OrderedDict()
+
+    def __len__(self):
+        return len(self._d)
+
+    def __contains__(self, key):
+        return key in self._d
+
+    def __getitem__(self, key):
+        value = self._d.pop(key)
+        self._d[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if self.maxsize <= 0:
+            return
+        if key in self._d:
+            self._d.pop(key)
+        elif len(self._d) >= self.maxsize:
+            self._d.popitem(last=False)
+        self._d[key] = value
+
+    def get(self, key, default=None):
+        """Returns the value if available (and marks it as used)."""
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def clear(self):
+        """Empty the cache."""
+        self._d.clear()
+
+
+def non_overlapping(boxes, priority=None):
+    """Greedy selection of boxes which do not overlap.
+
+    The boxes are considered by decreasing priority (in input order if
+    priority is None) and kept if they do not overlap any of the boxes
+    already kept. A grid index keeps the cost close to linear with the
+    number of boxes. Touching boxes do not overlap.
+
+    Parameters
+    ----------
+    boxes: (N, 4) array of (xmin, ymin, xmax, ymax)
+    priority: (N,) array, the larger the better
+
+    Returns
+    -------
+    the sorted indices of the kept boxes
+    """
+
+    boxes = np.asarray(boxes, dtype=np.float64).reshape((-1, 4))
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=int)
+    if priority is None:
+        order = np.arange(len(boxes))
+    else:
+        order = np.argsort(-np.asarray(priority, dtype=np.float64),
+                           kind='mergesort')
+
+    # Grid cells of the typical box size
+    cw = np.median(boxes[:, 2] - boxes[:, 0])
+    ch = np.median(boxes[:, 3] - boxes[:, 1])
+    cw = cw if cw > 0 else 1.
+    ch = ch if ch > 0 else 1.
+    x0, y0 = boxes[:, 0].min(), boxes[:, 1].min()
+    i0 = np.floor((boxes[:, 0] - x0) / cw).astype(int)
+    i1 = np.floor((boxes[:, 2] - x0) / cw).astype(int)
+    j0 = np.floor((boxes[:, 1] - y0) / ch).astype(int)
+    j1 = np.floor((boxes[:, 3] - y0) / ch).astype(int)
+
+    cells = dict()
+    keep = []
+    for k in order:
+        bx0, by0, bx1, by1 = boxes[k]
+        cellids = [(i, j) for i in range(i0[k], i1[k] + 1)
+                   for j in range(j0[k], j1[k] + 1)]
+        overlaps = False
+        for c in cellids:
+            for o in cells.get(c, ()):
+                ox0, oy0, ox1, oy1 = boxes[o]
+                if bx0 < ox1 and ox0 < bx1 and by0 < oy1 and oy0 < by1:
+                    overlaps = True
+                    break
+            if overlaps:
+                break
+        if overlaps:
+            continue
+        keep.append(k)
+        for c in cellids:
+            cells.setdefault(c, []).append(k)
+    return np.sort(np.asarray(keep, dtype=int))